@@ -1,15 +1,24 @@
+import time
+T_INICIO = time.perf_counter()  # para medir el primer pintado del rerun
 import streamlit as st
 import pandas as pd
-import gspread
-from google.oauth2.service_account import Credentials
 from datetime import datetime, date, timedelta
-import plotly.express as px
-import time
-from fpdf import FPDF
-import base64
+from concurrent.futures import ThreadPoolExecutor
 import pytz
 import uuid
-import bcrypt
+import re
+import bisect
+import unicodedata
+import threading
+import functools
+from contextlib import contextmanager
+import json
+import os
+import zipfile
+import io
+import storage
+# plotly, fpdf, gspread/google-auth y bcrypt se importan recién donde se usan:
+# la pantalla de login no debe pagar su carga.
 
 # ==========================================
 # 1. CONFIGURACIÓN GLOBAL
@@ -22,10 +31,15 @@ st.set_page_config(
 )
 
 # --- CARGAR CSS ---
-def local_css(file_name):
+@st.cache_data
+def _leer_css(file_name):
     try:
-        with open(file_name) as f: st.markdown(f'<style>{f.read()}</style>', unsafe_allow_html=True)
-    except: pass
+        with open(file_name) as f: return f.read()
+    except: return ""
+
+def local_css(file_name):
+    css = _leer_css(file_name)
+    if css: st.markdown(f'<style>{css}</style>', unsafe_allow_html=True)
 
 local_css("style.css")
 
@@ -56,6 +70,8 @@ GRUPOS_GEN = ["Infantil", "Prejuvenil", "Juvenil", "Adulto", "Senior", "Amateur"
 @st.cache_resource
 def get_client():
     try:
+        import gspread
+        from google.oauth2.service_account import Credentials
         creds_dict = dict(st.secrets["gcp_service_account"])
         creds = Credentials.from_service_account_info(creds_dict, scopes=["https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/drive"])
         return gspread.authorize(creds).open("BaseDatos_ClubArqueros")
@@ -63,65 +79,685 @@ def get_client():
         st.error(f"❌ Error crítico de conexión: {e}")
         st.stop()
 
-def get_df(sheet_name):
-    """Lectura segura con normalización de columnas y tipos"""
+# --- AJUSTES TÉCNICOS ---
+def get_ajuste(clave, default):
+    """Parámetro técnico desde secrets [ajustes], con valor por defecto"""
+    try: return type(default)(st.secrets["ajustes"][clave])
+    except: return default
+
+CACHE_TTL = get_ajuste("cache_ttl", 60)  # segundos que una hoja leída se sirve desde memoria
+
+# --- MOTOR DE ALMACENAMIENTO ---
+# [ajustes] almacen = "sheets" (default) | "sqlite" | "simulado"
+# Sheets y el simulado pasan por el planificador de cuota (cuota_lectura / cuota_escritura por minuto)
+def _crear_almacen():
+    if storage.ALMACEN_FORZADO is not None: return storage.ALMACEN_FORZADO
+    motor = get_ajuste("almacen", "sheets")
+    # Las hojas locales se crean vacías con su encabezado (en Sheets ya existen); los datos: "Importar desde Google Sheets"
+    if motor == "sqlite": return preparar_almacen(storage.AlmacenSQLite(get_ajuste("sqlite_path", "arqueros.db")))
+    if motor == "simulado":
+        base = preparar_almacen(storage.AlmacenSimulado(
+            latencia=get_ajuste("simulado_latencia", 0.3), jitter=get_ajuste("simulado_jitter", 0.2),
+            cuota_lectura=get_ajuste("simulado_cuota_lectura", 300), cuota_escritura=get_ajuste("simulado_cuota_escritura", 300)))
+    else: base = storage.AlmacenSheets(get_client())
+    plan = storage.Planificador(cuota_lectura=get_ajuste("cuota_lectura", 60), cuota_escritura=get_ajuste("cuota_escritura", 60),
+                                reintentos=get_ajuste("api_reintentos", 5))
+    return storage.AlmacenPlanificado(base, plan)
+
+@st.cache_resource
+def get_almacen():
+    # Toda llamada queda medida (latencia, filas, bytes, reintentos, errores): ver panel de rendimiento
+    return storage.AlmacenMedido(_crear_almacen())
+
+# --- MÉTRICAS (por rerun, por sesión y del proceso) ---
+def activar_metricas(nuevo_rerun=False):
+    """Fija los colectores de esta sesión en el hilo del script (también al re-ejecutar un fragmento)"""
+    if "_met_sesion" not in st.session_state: st.session_state["_met_sesion"] = storage.Metricas()
+    if nuevo_rerun or "_met_rerun" not in st.session_state: st.session_state["_met_rerun"] = storage.Metricas()
+    storage.fijar_metricas(st.session_state["_met_rerun"], st.session_state["_met_sesion"])
+
+@contextmanager
+def medir_seccion(nombre):
+    """Registra la duración del bloque como sección de la interfaz"""
+    t0 = time.perf_counter()
+    try: yield
+    finally: storage.registrar('seccion', nombre, (time.perf_counter() - t0) * 1000)
+
+# --- CACHÉ DE LECTURAS ---
+def _cache_hojas():
+    if "_cache_hojas" not in st.session_state: st.session_state["_cache_hojas"] = {}
+    return st.session_state["_cache_hojas"]
+
+def invalidar_cache(*sheet_names):
+    """Descarta las hojas indicadas para que la próxima lectura vaya a Sheets (en todas las sesiones)"""
+    cache = _cache_hojas()
+    for s in sheet_names: cache.pop(s, None)
+    _notificar_cambio(*sheet_names)
+
+def _numerizar(serie):
+    """Como get_all_records: las celdas que son números pasan a número, el resto queda igual"""
+    num = pd.to_numeric(serie, errors='coerce')
+    ok = num.notna() & (serie != "")
+    if not ok.any(): return serie
+    if ok.all(): return num
+    return serie.where(~ok, num).astype(object)
+
+COLS_ID = ['id', 'id_socio', 'id_entrenamiento', 'id_ref']
+
+# --- ESQUEMA TIPADO POR HOJA ---
+# Cada columna se convierte una sola vez, al leer, y el frame tipado es lo que
+# queda en caché. Las columnas listadas se garantizan aunque falten en la hoja;
+# las que no figuran se convierten como get_all_records (número si parece número).
+#   id: texto (comparaciones seguras) · txt: texto · cat: categórica
+#   int: entero nulable · monto: entero nulable (decimal si hace falta) · fecha: datetime
+ESQUEMAS = {
+    'entrenamientos_plantilla': {'id': 'id', 'sede': 'cat', 'dia': 'cat', 'horario': 'cat', 'grupo': 'cat',
+                                 'entrenador_asignado': 'txt', 'cupo_max': 'int'},
+    'inscripciones': {'id_socio': 'id', 'id_entrenamiento': 'id', 'nombre_alumno': 'txt'},
+    'listas': {'tipo': 'txt', 'valor': 'txt'},  # texto: data_editor muestra las categóricas como selectbox cerrado
+    'usuarios': {'user': 'txt', 'pass_hash': 'txt', 'rol': 'cat', 'nombre_completo': 'txt', 'sedes_acceso': 'txt', 'activo': 'int'},
+    'socios': {'id': 'id', 'nombre': 'txt', 'apellido': 'txt', 'dni': 'txt', 'sede': 'cat', 'grupo': 'cat', 'plan': 'cat',
+               'activo': 'int', 'tutor': 'txt', 'whatsapp': 'txt', 'email': 'txt', 'notas': 'txt', 'talle': 'txt',
+               'fecha_nacimiento': 'txt'},
+    'pagos': {'id': 'id', 'fecha_pago': 'fecha', 'id_socio': 'id', 'nombre_socio': 'txt', 'monto': 'monto', 'concepto': 'cat',
+              'metodo': 'cat', 'estado': 'cat', 'mes_cobrado': 'cat'},
+    'gastos': {'fecha': 'fecha', 'monto': 'monto', 'sede': 'cat'},
+    'asistencias': {'fecha': 'fecha', 'id_socio': 'id', 'sede': 'cat', 'grupo_turno': 'cat', 'estado': 'cat', 'nota': 'txt'},
+    'logs': {'id_ref': 'id', 'usuario': 'cat', 'accion': 'cat'},
+    'tarifas': {'concepto': 'txt', 'valor': 'monto'},
+    'config': {'clave': 'txt', 'valor': 'txt'},
+}
+
+def _tipar_col(serie, tipo):
+    if tipo == 'id': return serie.astype(str)
+    if tipo == 'txt': return serie.fillna("").astype(str)
+    if tipo == 'cat': return serie.fillna("").astype(str).astype('category')
+    if tipo == 'fecha': return pd.to_datetime(serie.replace("", None), errors='coerce')
+    num = pd.to_numeric(serie.astype(str).str.replace(r'[$\s]', '', regex=True).replace("", None), errors='coerce')
+    if tipo == 'monto' and not (num.dropna() % 1 == 0).all(): return num.astype('Float64')
+    return num.round().astype('Int64')
+
+def _tipar(sheet_name, df):
+    """Aplica ESQUEMAS[sheet_name] (y agrega las columnas que falten)"""
+    esquema = ESQUEMAS.get(_hoja_base(sheet_name), {})
+    for c in df.columns:
+        if c in esquema: df[c] = _tipar_col(df[c], esquema[c])
+        elif c in COLS_ID: df[c] = df[c].astype(str)
+        elif df[c].dtype == object: df[c] = _numerizar(df[c])
+    for c, tipo in esquema.items():
+        if c not in df.columns: df[c] = _tipar_col(pd.Series([""] * len(df), index=df.index, dtype=object), tipo)
+    return df
+
+def es_activo(v):
+    """activo == 1 tolerando nulos (pd.NA no se puede evaluar como bool)"""
+    return not pd.isna(v) and int(v) == 1
+
+def _valores_a_df(sheet_name, valores):
+    """Filas crudas del almacén -> (DataFrame tipado, encabezado). No toca session_state: se puede usar en hilos"""
+    df, enc = pd.DataFrame(), None
+    if len(valores) > 1:
+        n = len(valores[0])
+        df = pd.DataFrame([(f + [""] * n)[:n] for f in valores[1:]], columns=valores[0])
+    if not df.empty:
+        df.columns = df.columns.str.strip().str.lower()
+        enc = list(df.columns)
+        df = _tipar(sheet_name, df)
+    return df, enc
+
+# --- SINCRONIZACIÓN INCREMENTAL ---
+# Hojas que sólo crecen: al vencer se baja únicamente la cola nueva. Se vuelve
+# a leer completa si la última fila conocida cambió (hubo bajas), si otro
+# usuario editó filas (rev_<hoja> en config) o cada DELTA_RECARGA_TOTAL seg.
+HOJAS_DELTA = {"pagos", "asistencias", "logs"}
+DELTA_RECARGA_TOTAL = get_ajuste("delta_recarga_total", 900)
+
+def _revision(sheet_name):
+    return get_config_value(f"rev_{sheet_name}", 0) if sheet_name in HOJAS_DELTA else None
+
+def _nueva_revision():
+    """Revisión nueva sin leer la actual (sólo se compara por igualdad)"""
+    return int(f"{time.time_ns() // 10**6}{uuid.uuid4().int % 1000:03d}")
+
+def _subir_revision(sheet_name):
+    """Avisa a las demás sesiones que hubo ediciones/bajas y deben releer completa.
+    Las ediciones del diario la suben solas, una vez por drenado (ver get_replicador)"""
+    if sheet_name in HOJAS_DELTA: set_config_value(f"rev_{sheet_name}", _nueva_revision())
+
+def _base_delta(sheet_name, rev):
+    ent = _cache_hojas().get(sheet_name)
+    if (sheet_name in HOJAS_DELTA and ent and ent.get('n_filas') and ent.get('rev') == rev
+            and time.time() - ent['completa_ts'] < DELTA_RECARGA_TOTAL): return ent
+    return None
+
+def _recortar(fila):
+    fila = list(fila)
+    while fila and fila[-1] == "": fila.pop()
+    return fila
+
+def _bajar_hoja(alm, sheet_name, base=None):
+    """(df, encabezado, meta) desde el almacén; con `base` intenta traer sólo la cola. Sin session_state: apto para hilos"""
+    if base:
+        try:
+            # Se relee la última fila conocida para verificar que nada se corrió
+            cola = alm.leer_desde(sheet_name, base['n_filas'] + 1, len(base['enc_crudo']))
+            if cola and _recortar(cola[0]) == _recortar(base['ultima']):
+                nuevas = cola[1:]
+                meta = {k: base[k] for k in ('enc_crudo', 'ultima', 'n_filas', 'completa_ts')}
+                if not nuevas: return base['df'], None, dict(meta, cambio=False)
+                df_n, _ = _valores_a_df(sheet_name, [base['enc_crudo']] + nuevas)
+                df = pd.concat([base['df'], df_n], ignore_index=True)
+                for c, t in ESQUEMAS.get(_hoja_base(sheet_name), {}).items():
+                    if t == 'cat': df[c] = df[c].astype('category')  # categorías distintas -> object al concatenar
+                return df, None, dict(meta, ultima=nuevas[-1], n_filas=base['n_filas'] + len(nuevas), cambio=True)
+        except: pass
+    valores = alm.leer(sheet_name)
+    df, enc = _valores_a_df(sheet_name, valores)
+    meta = {'enc_crudo': valores[0] if valores else [], 'ultima': valores[-1] if len(valores) > 1 else None,
+            'n_filas': max(0, len(valores) - 1), 'completa_ts': time.time(), 'cambio': True}
+    return df, enc, meta
+
+def _guardar_en_cache(sheet_name, df, enc, meta=None, rev=None, vc=None):
+    meta = dict(meta or {'cambio': True})
+    cambio = meta.pop('cambio')
+    _cache_hojas()[sheet_name] = {'df': df, 'ts': time.time(), 'rev': rev, 'vc': vc, **meta}
+    if not cambio: return  # misma versión: los índices derivados siguen valiendo
+    if enc: _encabezados()[sheet_name] = enc
+    vers = _versiones()
+    vers[sheet_name] = vers.get(sheet_name, 0) + 1
+    _descartar_indices(sheet_name)
+
+# --- ALMACÉN COMPARTIDO ENTRE SESIONES ---
+# Una sola copia por hoja para todo el proceso: si diez profesores abren la
+# misma pantalla a la vez, baja una sola vez (candado por hoja) y el resto la
+# toma de acá. Cada hoja lleva un contador de versión; una escritura desde
+# cualquier sesión lo sube y vence la copia, y las demás sesiones lo notan en
+# su próxima lectura. Con [ajustes] feed_cambios = "ruta.db" los avisos se
+# comparten además entre réplicas del mismo host (storage.FeedCambios).
+FEED_INTERVALO = get_ajuste("feed_intervalo", 2.0)  # segundos entre consultas al feed
+
+@st.cache_resource
+def _compartido():
+    """Compartido por todo el proceso: {hoja: entrada}, versiones y candados de descarga"""
+    return {'lock': threading.Lock(), 'hojas': {}, 'version': {}, 'bloqueos': {}, 'feed_visto': {}, 'feed_ts': 0.0}
+
+@st.cache_resource
+def _feed_cambios():
+    ruta = get_ajuste("feed_cambios", "")
+    if not ruta: return None
+    try: return storage.FeedCambios(ruta)
+    except: return None
+
+def _bloqueo_hoja(comp, sheet_name):
+    with comp['lock']: return comp['bloqueos'].setdefault(sheet_name, threading.Lock())
+
+def _vigente(ent, rev):
+    return ent is not None and time.time() - ent['ts'] < CACHE_TTL and ent.get('rev') == rev
+
+def _descargar_compartida(alm, sheet_name, rev, base=None, comp=None):
+    """(df, enc, meta, versión) pasando por la copia del proceso. Sin session_state: apto para hilos (pasar `comp`)"""
+    comp = comp or _compartido()
+    with _bloqueo_hoja(comp, sheet_name):
+        ent = comp['hojas'].get(sheet_name)
+        if _vigente(ent, rev):  # otra sesión la bajó mientras esperábamos el candado
+            return ent['df'], ent['enc'], dict(ent['meta'], cambio=False), ent['version']
+        # La copia vencida del proceso sirve de base para traer sólo la cola
+        if ent and sheet_name in HOJAS_DELTA and ent.get('rev') == rev and ent['meta'].get('n_filas') \
+                and time.time() - ent['meta']['completa_ts'] < DELTA_RECARGA_TOTAL:
+            base = dict(ent['meta'], df=ent['df'])
+        df, enc, meta = _bajar_hoja(alm, sheet_name, base)
+        enc = enc or (ent['enc'] if ent else None)
+        with comp['lock']:
+            v = comp['version'].get(sheet_name, 0)
+            if ent is None or meta['cambio']: v = comp['version'][sheet_name] = v + 1
+            m = {k: meta[k] for k in ('enc_crudo', 'ultima', 'n_filas', 'completa_ts')}
+            comp['hojas'][sheet_name] = {'df': df, 'enc': enc, 'meta': m, 'rev': rev, 'ts': time.time(), 'version': v}
+        return df, enc, meta, v
+
+def _notificar_cambio(*sheet_names, publicar=True, comp=None, feed=None):
+    """Sube la versión y vence la copia compartida; con feed, avisa a las otras réplicas. Desde hilos: pasar comp y feed"""
+    comp = comp or _compartido()
+    with comp['lock']:
+        for s in sheet_names:
+            comp['version'][s] = comp['version'].get(s, 0) + 1
+            if s in comp['hojas']: comp['hojas'][s]['ts'] = 0
+    feed = (feed or _feed_cambios()) if publicar else None
+    if feed and sheet_names:
+        try:
+            vistas = feed.publicar(sheet_names)
+            with comp['lock']: comp['feed_visto'].update(vistas)  # no re-vencer por el propio aviso
+        except: pass
+
+def _sincronizar_feed():
+    """Como mucho cada FEED_INTERVALO: vence lo que otra réplica haya escrito"""
+    feed, comp = _feed_cambios(), _compartido()
+    if feed is None or time.time() - comp['feed_ts'] < FEED_INTERVALO: return
+    comp['feed_ts'] = time.time()
+    try: versiones = feed.versiones()
+    except: return
+    with comp['lock']:
+        nuevas = [h for h, v in versiones.items() if v > comp['feed_visto'].get(h, 0)]
+        comp['feed_visto'].update(versiones)
+    if nuevas:
+        get_replicador().cortar(*nuevas)  # otra réplica pudo correr filas: las anotadas se verifican
+        _notificar_cambio(*nuevas, publicar=False)
+
+def _version_compartida(sheet_name):
+    return _compartido()['version'].get(sheet_name, 0)
+
+def _adoptar_compartida(sheet_name, rev):
+    """Toma la copia vigente del proceso si es más nueva que la de la sesión"""
+    ent = _compartido()['hojas'].get(sheet_name)
+    if not _vigente(ent, rev): return None
+    propia = _cache_hojas().get(sheet_name)
+    cambio = not (propia and propia.get('vc') == ent['version'])
+    _guardar_en_cache(sheet_name, ent['df'], ent['enc'], dict(ent['meta'], cambio=cambio), rev, ent['version'])
+    _cache_hojas()[sheet_name]['ts'] = ent['ts']  # vence junto con la copia del proceso
+    return ent['df']
+
+# --- INSTANTÁNEA LOCAL EN DISCO (arranque en frío) ---
+# Cada hoja descargada se guarda como Arrow/Feather + sello JSON. Una sesión
+# nueva (o un proceso recién desplegado) la lee mapeada en memoria al instante
+# y la revalida contra el almacén en un hilo de fondo. Requiere pyarrow; sin
+# él la app funciona igual, sólo que sin instantáneas.
+SNAPSHOT_DIR = get_ajuste("snapshot_dir", ".snapshots")
+SNAPSHOT_CADA = get_ajuste("snapshot_cada", 120)  # seg mínimos entre reescrituras de una misma hoja
+SNAPSHOT_FORMATO = 4  # subir al cambiar ESQUEMAS: las instantáneas guardan los tipos
+HOJAS_SIN_SNAPSHOT = {"usuarios"}  # hashes de contraseñas: no van a disco y el login las lee siempre del almacén
+
+def _feather():
     try:
-        ws = get_client().worksheet(sheet_name)
-        data = ws.get_all_records()
-        df = pd.DataFrame(data)
-        if not df.empty:
-            df.columns = df.columns.str.strip().str.lower()
-            
-            # Conversión de IDs a String para comparaciones seguras
-            cols_id = ['id', 'id_socio', 'id_entrenamiento', 'id_ref']
-            for c in cols_id:
-                if c in df.columns:
-                    df[c] = df[c].astype(str)
-
-            # Garantizar columnas mínimas
-            req = {
-                'entrenamientos_plantilla': ['id', 'sede', 'dia', 'horario', 'grupo', 'entrenador_asignado', 'cupo_max'],
-                'inscripciones': ['id_socio', 'id_entrenamiento', 'nombre_alumno'],
-                'listas': ['tipo', 'valor'],
-                'usuarios': ['user', 'pass_hash', 'rol', 'nombre_completo', 'sedes_acceso', 'activo'],
-                'socios': ['id', 'nombre', 'apellido', 'dni', 'sede', 'grupo', 'plan', 'activo'],
-                'pagos': ['id', 'id_socio', 'monto', 'mes_cobrado', 'estado']
-            }
-            if sheet_name in req:
-                for c in req[sheet_name]: 
-                    if c not in df.columns: df[c] = ""
-        return df
-    except: return pd.DataFrame()
+        import pyarrow.feather as feather
+        return feather
+    except ImportError: return None
 
-def save_row(sheet_name, data):
-    try: get_client().worksheet(sheet_name).append_row(data)
+@st.cache_resource
+def _estado_snapshots():
+    """Compartido por todo el proceso: revalidaciones en curso y snapshots escritos"""
+    return {'lock': threading.Lock(), 'en_curso': set(), 'escritos': {}}
+
+def _ruta_snapshot(sheet_name, ext):
+    return os.path.join(SNAPSHOT_DIR, f"{sheet_name}.{ext}")
+
+def _escribir_snapshot(sheet_name, df, sello):
+    """Escritura atómica del frame + sello. Sin session_state: apto para hilos"""
+    feather = _feather()
+    if feather is None or df is None or df.empty or sheet_name in HOJAS_SIN_SNAPSHOT: return
+    try:
+        os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+        plano = df.copy()
+        for c in plano.columns:
+            if plano[c].dtype == object: plano[c] = plano[c].astype(str)  # columnas mixtas -> texto
+        # Sin compresión para poder mapearlo en memoria al leer
+        feather.write_feather(plano, _ruta_snapshot(sheet_name, "arrow.tmp"), compression='uncompressed')
+        os.replace(_ruta_snapshot(sheet_name, "arrow.tmp"), _ruta_snapshot(sheet_name, "arrow"))
+        with open(_ruta_snapshot(sheet_name, "json.tmp"), "w") as f: json.dump(sello, f)
+        os.replace(_ruta_snapshot(sheet_name, "json.tmp"), _ruta_snapshot(sheet_name, "json"))
     except: pass
 
-def save_rows_bulk(sheet_name, data_list):
-    try: 
-        get_client().worksheet(sheet_name).append_rows(data_list)
-        return True
-    except: return False
+def _sello(sheet_name, enc, meta, rev, nombre_almacen):
+    return {'formato': SNAPSHOT_FORMATO, 'almacen': nombre_almacen, 'hoja': sheet_name, 'ts': time.time(),
+            'enc': enc, 'rev': rev, **{k: meta.get(k) for k in ('enc_crudo', 'ultima', 'n_filas', 'completa_ts')}}
 
-def delete_row_by_condition(sheet_name, col_name, val):
-    ws = get_client().worksheet(sheet_name)
+def _programar_snapshot(sheet_name, df, sello):
+    est = _estado_snapshots()
+    with est['lock']:
+        if time.time() - est['escritos'].get(sheet_name, 0) < SNAPSHOT_CADA: return
+        est['escritos'][sheet_name] = time.time()
+    threading.Thread(target=_escribir_snapshot, args=(sheet_name, df, sello), daemon=True).start()
+
+def _leer_snapshot(sheet_name):
+    if sheet_name in HOJAS_SIN_SNAPSHOT:
+        for ext in ("arrow", "json"):  # las de versiones anteriores se borran
+            try: os.remove(_ruta_snapshot(sheet_name, ext))
+            except OSError: pass
+        return None
+    feather = _feather()
+    if feather is None: return None
     try:
-        cell = ws.find(str(val)) 
-        ws.delete_rows(cell.row)
+        with open(_ruta_snapshot(sheet_name, "json")) as f: sello = json.load(f)
+        if sello.get('formato') != SNAPSHOT_FORMATO or sello.get('almacen') != get_almacen().nombre: return None
+        df = feather.read_table(_ruta_snapshot(sheet_name, "arrow"), memory_map=True).to_pandas()
+        # Arrow conserva categorías, enteros nulables y fechas; sólo se retipan las columnas mixtas
+        esquema = ESQUEMAS.get(_hoja_base(sheet_name), {})
+        for c in df.columns:
+            if df[c].dtype == object and c not in esquema and c not in COLS_ID: df[c] = _numerizar(df[c])
+        return df, sello
+    except: return None
+
+def _revalidar_en_fondo(sheet_name, rev):
+    """Baja la hoja en un hilo (prioridad FONDO) y la publica en la copia compartida para que la adopten las sesiones"""
+    est = _estado_snapshots()
+    with est['lock']:
+        if sheet_name in est['en_curso']: return
+        est['en_curso'].add(sheet_name)
+    alm, base, enc, comp = get_almacen(), _base_delta(sheet_name, rev), _encabezados().get(sheet_name), _compartido()
+    nombre_alm = alm.nombre
+    def tarea():
+        try:
+            with storage.prioridad(storage.FONDO): df, enc_n, meta, _ = _descargar_compartida(alm, sheet_name, rev, base, comp)
+            if meta['cambio']: _escribir_snapshot(sheet_name, df, _sello(sheet_name, enc_n or enc, meta, rev, nombre_alm))
+        except: pass
+        finally:
+            with est['lock']: est['en_curso'].discard(sheet_name)
+    threading.Thread(target=tarea, daemon=True).start()
+
+def _cargar_desde_snapshot(sheet_name):
+    """Primera lectura de la sesión: sirve la instantánea en disco y revalida en fondo. None si no hay"""
+    if sheet_name in _versiones(): return None  # la sesión ya leyó/escribió esta hoja: no servir algo más viejo
+    snap = _leer_snapshot(sheet_name)
+    if snap is None: return None
+    df, sello = snap
+    meta = {k: sello.get(k) for k in ('enc_crudo', 'ultima', 'n_filas', 'completa_ts')}
+    _guardar_en_cache(sheet_name, df, sello.get('enc'), dict(meta, cambio=True), sello.get('rev'), _version_compartida(sheet_name))
+    _cache_hojas()[sheet_name]['origen'] = 'snapshot'
+    _revalidar_en_fondo(sheet_name, _revision(sheet_name))
+    return df
+
+def _tras_descarga(sheet_name, df, enc, meta, rev, vc=None):
+    nuevo = meta.get('cambio', True)  # la descarga trajo datos nuevos
+    propia = _cache_hojas().get(sheet_name)
+    cambio = nuevo or propia is None or propia.get('vc') != vc
+    _guardar_en_cache(sheet_name, df, enc, dict(meta, cambio=cambio), rev, vc)
+    if nuevo and _feather() is not None:
+        _programar_snapshot(sheet_name, df, _sello(sheet_name, enc or _encabezados().get(sheet_name), meta, rev, get_almacen().nombre))
+
+def _df_hoja(sheet_name):
+    """Frame cacheado SIN copiar (sólo lectura); lo descarga si venció. None si falla"""
+    # Leer lo propio: aplica antes lo pendiente de ESTA hoja, poco rato y sin reintentos (config: ver get_config_value)
+    if sheet_name != "config": flush_escrituras(sheet_name, espera=LECTURA_ESPERA)
+    _sincronizar_feed()
+    ent = _cache_hojas().get(sheet_name)
+    # Vale la copia de la sesión mientras no venza y nadie haya escrito la hoja desde entonces
+    if ent and time.time() - ent['ts'] < CACHE_TTL and ent.get('vc') == _version_compartida(sheet_name):
+        storage.registrar('cache', 'hojas', True)
+        return ent['df']
+    storage.registrar('cache', 'hojas', False)
+    try:
+        rev = _revision(sheet_name)
+        df = _adoptar_compartida(sheet_name, rev)
+        storage.registrar('cache', 'compartida', df is not None)
+        if df is not None: return df
+        if ent is None and sheet_name not in _compartido()['hojas']:
+            df = _cargar_desde_snapshot(sheet_name)
+            storage.registrar('cache', 'snapshot', df is not None)
+            if df is not None: return df
+        df, enc, meta, vc = _descargar_compartida(get_almacen(), sheet_name, rev, _base_delta(sheet_name, rev))
+        _tras_descarga(sheet_name, df, enc, meta, rev, vc)
+        return df
+    except: return None
+
+# --- PRECARGA EN PARALELO ---
+PREFETCH_HILOS = get_ajuste("prefetch_hilos", 4)  # descargas simultáneas (cuidar la cuota de lectura)
+
+def hojas_de_rol(rol):
+    """Hojas que puede necesitar cada rol según su menú"""
+    hojas = {"config", "listas", "pagos", "gastos", "socios", "tarifas"}
+    if rol in ["Administrador", "Profesor", "Entrenador"]:
+        hojas |= {"entrenamientos_plantilla", "inscripciones", "asistencias", "logs"}
+    if rol == "Administrador": hojas.add("usuarios")
+    return sorted(hojas)
+
+def precargar_hojas(sheet_names, prio=storage.INTERACTIVA):
+    """Descarga en paralelo las hojas vencidas y las deja en la caché de la sesión (y en la copia del proceso)"""
+    _sincronizar_feed()
+    cache, comp = _cache_hojas(), _compartido()
+    vencidas = [s for s in sheet_names if not (s in cache and time.time() - cache[s]['ts'] < CACHE_TTL
+                                               and cache[s].get('vc') == _version_compartida(s))]
+    if not vencidas: return
+    flush_escrituras(*[s for s in vencidas if s != "config"], espera=LECTURA_ESPERA)
+    revs = {s: _revision(s) for s in vencidas}
+    vencidas = [s for s in vencidas if _adoptar_compartida(s, revs[s]) is None]  # otra sesión ya la bajó
+    vencidas = [s for s in vencidas if s in cache or s in comp['hojas'] or _cargar_desde_snapshot(s) is None]
+    if not vencidas: return
+    alm = get_almacen()
+    bases = {s: _base_delta(s, revs[s]) for s in vencidas}
+    # Los hilos sólo leen, convierten y publican en la copia del proceso; la caché (session_state) se escribe desde el hilo del script
+    met = storage.metricas_activas()
+    def bajar(h):
+        with storage.prioridad(prio), storage.midiendo(*met): return _descargar_compartida(alm, h, revs[h], bases[h], comp)
+    with ThreadPoolExecutor(max_workers=max(1, PREFETCH_HILOS)) as ex:
+        futs = {s: ex.submit(bajar, s) for s in vencidas}
+    for s, f in futs.items():
+        try:
+            df, enc, meta, vc = f.result()
+            _tras_descarga(s, df, enc, meta, revs[s], vc)
+        except: pass
+
+def get_df(sheet_name):
+    """Lectura segura con normalización de columnas y tipos (cacheada por CACHE_TTL)"""
+    df = _df_hoja(sheet_name)
+    return df.copy() if df is not None else pd.DataFrame()
+
+def df_fresco(sheet_name):
+    """Lectura directa del almacén, sin cachés ni instantánea (p. ej. usuarios al autenticar). Si falla, lanza"""
+    flush_escrituras(sheet_name, espera=LECTURA_ESPERA)
+    return _valores_a_df(sheet_name, get_almacen().leer(sheet_name))[0]
+
+# --- ÍNDICES DERIVADOS (se recalculan sólo si cambia la versión de sus hojas) ---
+def _versiones():
+    if "_ver_hojas" not in st.session_state: st.session_state["_ver_hojas"] = {}
+    return st.session_state["_ver_hojas"]
+
+def version_hoja(sheet_name):
+    """Contador que sube cada vez que la hoja se vuelve a descargar"""
+    return _versiones().get(sheet_name)
+
+def derivado(nombre, sheet_names, construir):
+    """Memoiza construir() mientras las hojas de origen no cambien de versión"""
+    if "_derivados" not in st.session_state: st.session_state["_derivados"] = {}
+    memo = st.session_state["_derivados"]
+    for s in sheet_names: _df_hoja(s)  # refresca las vencidas antes de comparar
+    vers = tuple(version_hoja(s) for s in sheet_names)
+    acierto = nombre in memo and memo[nombre][0] == vers
+    storage.registrar('cache', 'derivados', acierto)
+    if acierto: return memo[nombre][1]
+    val = construir()
+    memo[nombre] = (vers, val)
+    return val
+
+# --- ÍNDICE DE FILAS (clave -> nº de fila en la hoja) ---
+# Reemplaza ws.find(): se arma con los datos que get_df ya descargó y se
+# corrige en cada alta/baja, así las escrituras van directo a la fila.
+COL_CLAVE = {'config': 'clave'}
+
+def _indices_filas():
+    if "_indices_filas" not in st.session_state: st.session_state["_indices_filas"] = {}
+    return st.session_state["_indices_filas"]
+
+def _descartar_indices(sheet_name):
+    idxs = _indices_filas()
+    for k in [k for k in idxs if k[0] == sheet_name]: del idxs[k]
+
+def _indice(sheet_name, col):
+    idxs = _indices_filas()
+    if (sheet_name, col) not in idxs:
+        # El sello se toma ANTES de leer: si una baja lo sube después, las filas anotadas con él se verifican al aplicarse
+        sello = get_replicador().sello(sheet_name)
+        df = get_df(sheet_name)
+        if df.empty or col not in df.columns: return None
+        claves = df[col].astype(str).tolist()
+        filas = range(2, len(claves) + 2)  # fila 1 = encabezado
+        # Invertido para que, ante claves repetidas, gane la primera (como find)
+        idxs[(sheet_name, col)] = {'pos': list(df.columns).index(col), 'mapa': dict(zip(claves[::-1], filas[::-1])), 'sello': sello}
+    return idxs.get((sheet_name, col))
+
+def buscar_fila(sheet_name, val, col=None):
+    """Nº de fila de la clave en la hoja; relee una vez si no aparece"""
+    col = col or COL_CLAVE.get(sheet_name, 'id')
+    for intento in range(2):
+        idx = _indice(sheet_name, col)
+        if idx and str(val) in idx['mapa']: return idx['mapa'][str(val)]
+        if intento == 0: invalidar_cache(sheet_name); _descartar_indices(sheet_name)
+    return None
+
+def _indice_agregadas(sheet_name, filas, fila_ini):
+    if fila_ini is None: _descartar_indices(sheet_name); return
+    for idx in [v for k, v in _indices_filas().items() if k[0] == sheet_name]:
+        for i, f in enumerate(filas):
+            if len(f) > idx['pos']: idx['mapa'].setdefault(str(f[idx['pos']]), fila_ini + i)
+
+def _indice_borrada(sheet_name, fila):
+    for idx in [v for k, v in _indices_filas().items() if k[0] == sheet_name]:
+        idx['mapa'] = {c: (r - 1 if r > fila else r) for c, r in idx['mapa'].items() if r != fila}
+        idx['sello'] = [idx['sello'][0], idx['sello'][1] + 1]  # ya contempla la baja propia
+
+# --- ESQUEMA DE COLUMNAS (posición física en la hoja) ---
+# Se usa el encabezado real leído de la hoja; este orden es el respaldo
+# cuando todavía no se leyó o la columna tiene otro nombre. También es el
+# encabezado con que se crean las hojas en los almacenes locales.
+COLUMNAS = {
+    'usuarios': ['id', 'user', 'pass_hash', 'rol', 'nombre_completo', 'sedes_acceso', 'activo'],
+    'socios': ['id', 'fecha_alta', 'nombre', 'apellido', 'dni', 'fecha_nacimiento', 'tutor', 'whatsapp', 'email',
+               'sede', 'plan', 'notas', 'usuario_alta', 'activo', 'talle', 'grupo', 'peso', 'altura'],
+    'pagos': ['id', 'fecha_pago', 'id_socio', 'nombre_socio', 'monto', 'concepto', 'metodo', 'nota', 'estado',
+              'usuario', 'mes_cobrado'],
+    'gastos': ['fecha', 'concepto', 'monto', 'sede'],
+    'asistencias': ['fecha', 'hora', 'id_socio', 'nombre_alumno', 'sede', 'grupo_turno', 'estado', 'nota'],
+    'logs': ['fecha', 'usuario', 'id_ref', 'accion', 'detalle'],
+    'inscripciones': ['id', 'id_socio', 'nombre_alumno', 'id_entrenamiento', 'fecha'],
+    'entrenamientos_plantilla': ['id', 'sede', 'dia', 'horario', 'grupo', 'entrenador_asignado', 'cupo_max'],
+    'listas': ['tipo', 'valor'],
+    'tarifas': ['concepto', 'valor'],
+    'config': ['clave', 'valor'],
+}
+
+def preparar_almacen(alm):
+    """Crea las hojas que falten con su encabezado: así la primera alta no queda como encabezado"""
+    for h, enc in COLUMNAS.items(): alm.asegurar_hoja(h, enc)
+    return alm
+
+def importar_desde_sheets():
+    """Reemplaza las hojas del almacén local por las de la planilla de Google (particiones incluidas); devuelve {hoja: filas}"""
+    origen, alm, rep = storage.AlmacenSheets(get_client()), get_almacen(), get_replicador()
+    with rep.lock:  # nada del diario se aplica a medio importar
+        rep.drenar()
+        copiadas = storage.copiar_almacen(origen, alm, list(COLUMNAS))
+        invalidar_cache("config")
+        parts = [hoja_particion(h, a) for h in HOJAS_ARCHIVO for a in anios_archivados(h)]  # según la config importada
+        copiadas.update(storage.copiar_almacen(origen, alm, parts))
+        rep.cortar(*copiadas)
+    for h in copiadas: _descartar_indices(h)
+    invalidar_cache(*copiadas)
+    return copiadas
+
+def _encabezados():
+    if "_encabezados" not in st.session_state: st.session_state["_encabezados"] = {}
+    return st.session_state["_encabezados"]
+
+def col_idx(sheet_name, col):
+    """Índice (1-based) de la columna en la hoja, por nombre o número"""
+    if isinstance(col, int): return col
+    enc = _encabezados().get(sheet_name, [])
+    if col in enc: return enc.index(col) + 1
+    return COLUMNAS[sheet_name].index(col) + 1
+
+def actualizar_fila(sheet_name, id_row, valores):
+    """Anota en el diario varias columnas {col: valor} de una fila (se aplican en un único batch_update)"""
+    try:
+        col = COL_CLAVE.get(sheet_name, 'id')
+        fila = buscar_fila(sheet_name, id_row, col)
+        if fila is None: return False
+        idx = _indice(sheet_name, col)
+        _registrar_escritura(sheet_name, 'actualizar', {'col': idx['pos'] + 1, 'clave': str(id_row), 'fila': fila, 'sello': idx['sello'],
+                                                        'valores': {col_idx(sheet_name, c): _a_celda(v) for c, v in valores.items()}})
         return True
     except: return False
+    finally: invalidar_cache(sheet_name)
+
+# --- DIARIO DE ESCRITURAS (write-ahead) ---
+# Toda escritura se anota primero en un SQLite local (registrada = en disco) y
+# recién después va al almacén, en orden: desde un hilo de fondo que junta las
+# altas de FLUSH_VENTANA en un solo append por hoja, o antes de leer una hoja
+# con escrituras pendientes (sólo las de esa hoja y como mucho LECTURA_ESPERA
+# seg; así cada sesión lee lo propio). Si la API falla o
+# el proceso se reinicia a mitad de camino, lo pendiente se reenvía; un alta
+# cuyo envío quedó incierto se verifica contra la hoja antes de repetirla.
+# [ajustes] diario = "arqueros_diario.db"
+FLUSH_VENTANA = get_ajuste("flush_ventana", 2.0)  # segundos que el replicador junta altas antes de enviarlas
+LECTURA_ESPERA = get_ajuste("lectura_espera", 1.5)  # segundos que una lectura espera para aplicar lo propio
 
-def update_cell_val(sheet_name, id_row, col_idx, val):
-    ws = get_client().worksheet(sheet_name)
+@st.cache_resource
+def get_replicador():
+    # Con un almacén inyectado (benchmark) el diario vive en memoria
+    ruta = ":memory:" if storage.ALMACEN_FORZADO is not None else get_ajuste("diario", "arqueros_diario.db")
+    diario = storage.Diario(ruta)
+    diario.purgar(get_ajuste("diario_dias", 7))
+    comp, feed = _compartido(), _feed_cambios()
+
+    def al_editar(hojas):  # una vez por drenado, desde el hilo que drenó (sin session_state)
+        delta = sorted(set(hojas) & HOJAS_DELTA)
+        for h in delta: diario.registrar("config", 'upsert', _datos_config(f"rev_{h}", _nueva_revision()))
+        if delta: _notificar_cambio(*delta, comp=comp, feed=feed)  # que relean ya con la revisión nueva
+    return storage.Replicador(diario, get_almacen(), al_aplicar=lambda h: _notificar_cambio(h, comp=comp, feed=feed),
+                              al_editar=al_editar, ventana=FLUSH_VENTANA)
+
+def _registrar_escritura(sheet_name, tipo, datos, clave=None):
+    """Anota la operación en el diario y despierta al replicador. `clave`: idempotencia (no se anota dos veces). Devuelve su id"""
+    rep = get_replicador()
+    op = rep.diario.registrar(sheet_name, tipo, datos, clave)
+    rep.avisar()
+    return op
+
+def _a_celda(v):
+    """Tipos numpy/pandas -> nativos, para que la API (y el diario) los puedan serializar"""
+    if v is None or v is pd.NA or v is pd.NaT or (isinstance(v, float) and v != v): return ""
+    if isinstance(v, pd.Timestamp): return str(v.date()) if v == v.normalize() else str(v)
+    return v.item() if hasattr(v, 'item') else v
+
+def escrituras_pendientes():
+    return get_replicador().diario.abiertas_de()
+
+def flush_escrituras(*sheet_names, espera=None):
+    """Aplica ya lo pendiente del diario para las hojas indicadas (o todas).
+    Con `espera` (seg) no bloquea más que eso ni reintenta; si la base viene fallando ni lo intenta (sigue el fondo)"""
+    rep = get_replicador()
+    if not rep.diario.abiertas_de(*sheet_names) or (espera is not None and rep.ultimo_error): return
+    for hoja, lotes in rep.drenar(sheet_names, espera).items():
+        for filas, fila_ini in lotes: _indice_agregadas(hoja, filas, fila_ini)
+
+def aplicadas(ids, *sheet_names):
+    """Intenta aplicar ya lo de esas hojas y devuelve [aplicada por operación] de `ids` (las propias de quien guardó)"""
+    flush_escrituras(*sheet_names, espera=LECTURA_ESPERA)
+    abiertas = get_replicador().diario.abiertas_entre(ids)
+    return [i not in abiertas for i in ids]
+
+def save_row(sheet_name, data):
+    """Anota el alta en el diario; devuelve el id de la operación (ver aplicadas)"""
+    return _registrar_escritura(sheet_name, 'agregar', {'filas': [[_a_celda(v) for v in data]]})
+
+def guardar_lote(sheet_name, data_list, clave=None):
+    """Un solo append para todas las filas; devuelve [aplicada por fila] (las no aplicadas quedan en el diario)"""
+    if not data_list: return []
+    op = _registrar_escritura(sheet_name, 'agregar', {'filas': [[_a_celda(v) for v in f] for f in data_list]}, clave)
+    return aplicadas([op], sheet_name) * len(data_list)
+
+def save_rows_bulk(sheet_name, data_list):
+    return all(guardar_lote(sheet_name, data_list))
+
+def delete_row_by_condition(sheet_name, col_name, val):
     try:
-        cell = ws.find(str(id_row))
-        ws.update_cell(cell.row, col_idx, val)
+        fila = buscar_fila(sheet_name, val, col_name)
+        if fila is None: return False
+        # Una baja corre filas: si otra baja se aplicó desde que se armó el índice, el sello ya no coincide y se verifica la clave
+        idx = _indice(sheet_name, col_name)
+        _registrar_escritura(sheet_name, 'borrar', {'col': idx['pos'] + 1, 'clave': str(val), 'fila': fila, 'sello': idx['sello']})
+        _indice_borrada(sheet_name, fila)
         return True
     except: return False
+    finally: invalidar_cache(sheet_name)
+
+def update_cell_val(sheet_name, id_row, col, val):
+    return actualizar_fila(sheet_name, id_row, {col: val})
 
 def generate_id():
     return int(f"{int(time.time())}{uuid.uuid4().int % 1000}")
 
+def generar_ids(n):
+    """n IDs distintos con el mismo formato que generate_id, sin llamarla n veces"""
+    base, ancho = int(time.time()), max(3, len(str(n)))
+    off = uuid.uuid4().int % 10 ** ancho
+    return [int(f"{base}{(off + i) % 10 ** ancho:0{ancho}d}") for i in range(n)]
+
 def log_action(id_ref, accion, detalle, user):
     try: save_row("logs", [str(get_now_ar()), user, str(id_ref), accion, detalle])
     except: pass
@@ -134,8 +770,16 @@ def get_lista_opciones(tipo, default_list):
         if items: return sorted(list(set(items)))
     return default_list
 
+def _config_pendiente():
+    """{clave: valor} de config anotados en el diario y aún no aplicados: se leen sin drenar ni esperar a la base"""
+    rep = get_replicador()
+    if not rep.diario.abiertas_de("config"): return {}
+    return {op['datos']['clave']: op['datos']['valores']['2'] for op in rep.diario.pendientes(("config",)) if op['tipo'] == 'upsert'}
+
 def get_config_value(key, default_val):
     try:
+        pend = _config_pendiente()
+        if key in pend: return int(pend[key])
         df = get_df("config")
         if not df.empty and 'clave' in df.columns:
             res = df[df['clave'] == key]
@@ -143,89 +787,521 @@ def get_config_value(key, default_val):
     except: pass
     return default_val
 
+def _datos_config(key, value, idx=None):
+    return {'col': 1, 'clave': key, 'fila': idx['mapa'].get(str(key)) if idx else None, 'sello': idx['sello'] if idx else None,
+            'valores': {2: str(value)}, 'encabezado': ["clave", "valor"]}
+
 def set_config_value(key, value):
-    sh = get_client()
-    try: ws = sh.worksheet("config")
-    except: 
-        ws = sh.add_worksheet("config", 100, 2)
-        ws.append_row(["clave", "valor"])
-    try:
-        cell = ws.find(key)
-        ws.update_cell(cell.row, 2, str(value))
-    except: ws.append_row([key, str(value)])
+    _registrar_escritura("config", 'upsert', _datos_config(key, value, _indice("config", 'clave')))
+    invalidar_cache("config")
     return True
 
+# --- BÚSQUEDA DE SOCIOS (índice invertido) ---
+def normalizar_texto(v):
+    """Minúsculas y sin acentos; los números enteros sin '.0'"""
+    if isinstance(v, float) and v.is_integer(): v = int(v)
+    t = unicodedata.normalize('NFKD', str(v)).encode('ascii', 'ignore').decode('ascii')
+    return t.lower()
+
+def _trigramas(t):
+    return {t[i:i+3] for i in range(len(t) - 2)}
+
+class IndiceBusqueda:
+    """Tokens de nombre/apellido/dni/tutor/email/whatsapp -> socios, con búsqueda exacta, por prefijo y por trigramas"""
+    CAMPOS = ['nombre', 'apellido', 'dni', 'tutor', 'email', 'whatsapp']
+
+    def __init__(self, df):
+        self.ids = df['id'].tolist() if 'id' in df.columns else []
+        self.tokens = {}
+        campos = [df[c].tolist() for c in self.CAMPOS if c in df.columns]
+        for pos, valores in enumerate(zip(*campos)):
+            for v in valores:
+                t = normalizar_texto(v)
+                toks = set(re.findall(r'[a-z0-9]+', t))
+                digitos = re.sub(r'\D', '', t)  # DNI / teléfono escritos con puntos o guiones
+                if len(digitos) >= 5: toks.add(digitos)
+                for tok in toks: self.tokens.setdefault(tok, set()).add(pos)
+        self.vocab = sorted(self.tokens)
+        self.tri = {}
+        for tok in self.vocab:
+            for g in _trigramas(tok): self.tri.setdefault(g, set()).add(tok)
+
+    def _por_termino(self, term):
+        """pos -> puntaje para un término: 3 exacto, 2 prefijo, 1 contenido"""
+        res = {}
+        i = bisect.bisect_left(self.vocab, term)
+        while i < len(self.vocab) and self.vocab[i].startswith(term):
+            tok = self.vocab[i]
+            for pos in self.tokens[tok]: res[pos] = max(res.get(pos, 0), 3 if tok == term else 2)
+            i += 1
+        if len(term) >= 3:
+            cand = set.intersection(*[self.tri.get(g, set()) for g in _trigramas(term)])
+            for tok in cand:
+                if term in tok and not tok.startswith(term):
+                    for pos in self.tokens[tok]: res.setdefault(pos, 1)
+        return res
+
+    def buscar(self, texto):
+        """IDs de socios que contienen todos los términos, ordenados por relevancia"""
+        terms = re.findall(r'[a-z0-9]+', normalizar_texto(texto))
+        if not terms: return []
+        total = None
+        for term in terms:
+            r = self._por_termino(term)
+            total = r if total is None else {p: total[p] + r[p] for p in total.keys() & r.keys()}
+            if not total: return []
+        return [self.ids[p] for p in sorted(total, key=lambda p: (-total[p], p))]
+
+def get_indice_busqueda():
+    def construir():
+        df = _df_hoja("socios")
+        return IndiceBusqueda(df if df is not None else pd.DataFrame())
+    return derivado("busqueda_socios", ["socios"], construir)
+
+def buscar_socios(df, texto):
+    """Filtra df (socios) por el texto de búsqueda, ordenado por relevancia"""
+    ranking = {uid: i for i, uid in enumerate(get_indice_busqueda().buscar(texto))}
+    res = df[df['id'].isin(ranking.keys())]
+    return res.iloc[res['id'].map(ranking).argsort()]
+
 # --- LÓGICA DE NEGOCIO ---
-def check_horario_conflict(id_socio, dia, horario):
+# --- OCUPACIÓN DE HORARIOS (inscripciones por alumno/horario y por grupo) ---
+# Se arma por versión de inscripciones + plantilla y se corrige en cada alta o
+# baja, así el chequeo de choque y el cupo son búsquedas en diccionarios.
+def indice_ocupacion():
+    """{'horario': {(id_socio, dia, horario): id_entrenamiento}, 'grupos': {id_entrenamiento: {id_socio}},
+    'inscripcion': {id: (id_socio, id_entrenamiento)}, 'plantilla': {id_entrenamiento: (dia, horario, cupo_max)}}"""
+    def construir():
+        occ = {'horario': {}, 'grupos': {}, 'inscripcion': {}, 'plantilla': {}}
+        df_plant, df_insc = _df_hoja("entrenamientos_plantilla"), _df_hoja("inscripciones")
+        if df_plant is not None and not df_plant.empty:
+            cupos = df_plant['cupo_max'].astype(object).where(df_plant['cupo_max'].notna(), None)
+            occ['plantilla'] = {g: (str(d), str(h), c) for g, d, h, c in
+                                zip(df_plant['id'], df_plant['dia'], df_plant['horario'], cupos)}
+        if df_insc is not None and not df_insc.empty:
+            ids = df_insc['id'] if 'id' in df_insc.columns else [None] * len(df_insc)
+            for i, uid, gid in zip(ids, df_insc['id_socio'], df_insc['id_entrenamiento']): _ocupar(occ, i, uid, gid)
+        return occ
+    return derivado("ocupacion", ["inscripciones", "entrenamientos_plantilla"], construir)
+
+def _ocupar(occ, id_insc, id_socio, gid):
+    occ['grupos'].setdefault(gid, set()).add(id_socio)
+    if id_insc is not None: occ['inscripcion'][id_insc] = (id_socio, gid)
+    if gid in occ['plantilla']: occ['horario'][(id_socio, *occ['plantilla'][gid][:2])] = gid
+
+def ocupacion_alta(id_insc, id_socio, gid, occ=None):
+    """Registra una inscripción recién encolada (hasta que la hoja se vuelva a leer)"""
+    _ocupar(occ or indice_ocupacion(), str(id_insc), str(id_socio), str(gid))
+
+def ocupacion_baja(id_insc):
+    occ = indice_ocupacion()
+    uid, gid = occ['inscripcion'].pop(str(id_insc), (None, None))
+    if uid is None: return
+    occ['grupos'].get(gid, set()).discard(uid)
+    if gid in occ['plantilla']: occ['horario'].pop((uid, *occ['plantilla'][gid][:2]), None)
+
+# `occ`: el índice ya resuelto (un lote lo pide una vez en lugar de en cada chequeo)
+def alumnos_del_grupo(gid, occ=None):
+    return (occ or indice_ocupacion())['grupos'].get(str(gid), set())
+
+def cupo_libre(gid, occ=None):
+    """Lugares libres del grupo; None si no tiene cupo_max"""
+    occ = occ or indice_ocupacion()
+    cupo = occ['plantilla'].get(str(gid), (None, None, None))[2]
+    return None if cupo is None else int(cupo) - len(occ['grupos'].get(str(gid), ()))
+
+def check_horario_conflict(id_socio, dia, horario, occ=None):
     """Impide doble inscripción en mismo horario"""
-    df_insc = get_df("inscripciones")
-    df_plant = get_df("entrenamientos_plantilla")
-    if df_insc.empty or df_plant.empty: return False
+    return (str(id_socio), str(dia), str(horario)) in (occ or indice_ocupacion())['horario']
+
+def validar_inscripcion(id_socio, gid, en_lote=0, occ=None):
+    """Motivo por el que no se puede inscribir, o None. `en_lote`: lugares ya tomados por el lote en curso"""
+    occ = occ or indice_ocupacion()
+    dia, horario, _ = occ['plantilla'].get(str(gid), (None, None, None))
+    if str(id_socio) in alumnos_del_grupo(gid, occ): return "Ya está inscripto"
+    if dia is not None and check_horario_conflict(id_socio, dia, horario, occ): return "Conflicto Horario"
+    libre = cupo_libre(gid, occ)
+    if libre is not None and libre - en_lote <= 0: return "Cupo completo"
+    return None
+
+def inscribir_lote(gid, alumnos):
+    """Inscribe [(id_socio, nombre)] en el grupo con un solo append. Devuelve [(nombre, resultado)]"""
+    gid = str(gid)
+    reporte, filas = [], []
+    ids = iter(generar_ids(len(alumnos)))  # de una vez: generate_id en un bucle repite ids y una baja borraría otra inscripción
+    occ = indice_ocupacion()
+    for uid, nom in alumnos:
+        motivo = validar_inscripcion(uid, gid, len(filas), occ)
+        if motivo is None: filas.append([next(ids), str(uid), nom, gid, ""])
+        reporte.append([nom, motivo])
+    oks = iter(guardar_lote("inscripciones", filas))
+    for fila, r in zip(filas, [r for r in reporte if r[1] is None]):
+        ok = next(oks)
+        r[1] = "✅ Inscripto" if ok else "⚠️ En el diario (se reenvía)"
+        ocupacion_alta(fila[0], fila[1], gid, occ)  # anotada en el diario aunque la base no responda: el replicador la envía
+    return [tuple(r) for r in reporte]
+
+def fechas_de_clase(dia, desde, semanas=1):
+    """Fechas del rango [desde, desde + semanas) que caen en el día del grupo ("Miercoles" == "Miércoles"); [] si no se reconoce"""
+    dia = normalizar_texto(dia).strip()
+    fechas = [desde + timedelta(days=i) for i in range(7 * semanas)]
+    return [f for f in fechas if normalizar_texto(traducir_dia(f)) == dia]
+
+def asistencias_cargadas():
+    """{(fecha, id_socio, grupo_turno)} ya registradas, para no duplicar planillas"""
+    def construir():
+        df = _df_hoja("asistencias")
+        if df is None or df.empty: return set()
+        return set(zip(df['fecha'].dt.date, df['id_socio'], df['grupo_turno'].astype(str)))
+    return derivado("asistencias_cargadas", ["asistencias"], construir)
+
+def asistencia_lote(grp, grilla, motivos, user):
+    """grilla: {id_socio: (nombre, {fecha: presente})}. Un solo append; devuelve [(nombre, fecha, resultado)]"""
+    cargadas = asistencias_cargadas()
+    hora = get_now_ar().strftime("%H:%M")
+    reporte, filas = [], []
+    for uid, (nom, marcas) in grilla.items():
+        for f, presente in marcas.items():
+            if (f, str(uid), str(grp['grupo'])) in cargadas:
+                reporte.append([nom, f, "Ya cargada"]); continue
+            est = "Presente" if presente else "Ausente"
+            filas.append([str(f), hora, uid, nom, grp['sede'], grp['grupo'], est, "" if presente else motivos.get(uid, "")])
+            reporte.append([nom, f, None])
+    oks = iter(guardar_lote("asistencias", filas))
+    for r in reporte:
+        if r[2] is None: r[2] = "✅" if next(oks) else "⚠️ En el diario (se reenvía)"
+    if filas: log_action(str(grp['id']), "Asistencia Semanal", f"{len(filas)} registros", user)
+    return [tuple(r) for r in reporte]
+
+def socios_activos():
+    """[(id, 'nombre apellido')] de los activos, por versión de socios"""
+    def construir():
+        df = _df_hoja("socios")
+        if df is None or df.empty: return []
+        act = df[df['activo'] == 1]
+        return list(zip(act['id'], act['nombre'].astype(str) + " " + act['apellido'].astype(str)))
+    return derivado("socios_activos", ["socios"], construir)
+
+def cuotas_pendientes(df_soc, df_pag, df_tar, mes_target, precio_default=15000):
+    """Filas de 'Cuota Mensual' para los socios activos que aún no la tienen en mes_target"""
+    if df_soc.empty: return []
+    act = df_soc[df_soc['activo'] == 1]
+    if not df_pag.empty and {'mes_cobrado', 'concepto'} <= set(df_pag.columns):
+        ya = df_pag.loc[(df_pag['mes_cobrado'] == mes_target) & df_pag['concepto'].astype(str).str.contains("Cuota"), 'id_socio']
+        act = act[~act['id'].isin(ya)]
+    if act.empty: return []
     
-    mis_insc = df_insc[df_insc['id_socio'] == str(id_socio)]
-    if mis_insc.empty: return False
+    precio = precio_default
+    if not df_tar.empty and {'concepto', 'valor'} <= set(df_tar.columns):
+        tar = df_tar.drop_duplicates('concepto')[['concepto', 'valor']].rename(columns={'concepto': 'plan'})
+        precio = act[['plan']].merge(tar, on='plan', how='left')['valor'].fillna(precio_default).values
     
-    merged = pd.merge(mis_insc, df_plant, left_on='id_entrenamiento', right_on='id')
-    choque = merged[ (merged['dia'] == dia) & (merged['horario'] == horario) ]
-    return not choque.empty
+    filas = pd.DataFrame({
+        'id': generar_ids(len(act)), 'fecha_pago': str(get_today_ar()), 'id_socio': act['id'].values,
+        'nombre_socio': (act['nombre'].astype(str) + " " + act['apellido'].astype(str)).values,
+        'monto': precio, 'concepto': "Cuota Mensual", 'metodo': "Pendiente",
+        'nota': ("Plan: " + act['plan'].astype(str)).values, 'estado': "Pendiente", 'usuario': "System", 'mes_cobrado': mes_target
+    })
+    return filas.values.tolist()
+
+def generar_cuotas_periodo(df_soc, mes_target, periodo):
+    """Genera las cuotas del período una sola vez (marca 'cuotas_periodo' en config). (filas, [aplicada por fila]); None si ya estaba"""
+    if get_config_value("cuotas_periodo", 0) >= periodo: return None
+    filas = cuotas_pendientes(df_soc, get_df("pagos"), get_df("tarifas"), mes_target)
+    # Anotadas en el diario ya no se pierden: se marca el período aunque la base no haya respondido.
+    # La clave evita que otra sesión que llegue a la vez las vuelva a generar
+    oks = guardar_lote("pagos", filas, clave=f"cuotas_{periodo}")
+    set_config_value("cuotas_periodo", periodo)
+    return filas, oks
+
+def indice_estado_pagos():
+    """Estado de cobro precalculado por versión de 'pagos' (un groupby, no un filtro por fila)"""
+    def construir():
+        df = _df_hoja("pagos")
+        if df is None or df.empty: return {'estado': {}, 'deuda_id': {}, 'deuda_total': {}}
+        conf = (df['estado'] == 'Confirmado').groupby([df['id_socio'], df['mes_cobrado']], sort=False, observed=True).any()
+        pend = df[df['estado'] == 'Pendiente']
+        return {
+            # (id_socio, mes_cobrado) -> ✅ si hay alguno confirmado, 🔴 si sólo hay pendientes
+            'estado': dict(zip(conf.index, conf.map({True: "✅", False: "🔴"}))),
+            # (id_socio, mes_cobrado) -> id del primer pago pendiente (para cobrar la deuda existente)
+            'deuda_id': pend.drop_duplicates(['id_socio', 'mes_cobrado']).set_index(['id_socio', 'mes_cobrado'])['id'].to_dict(),
+            # id_socio -> monto total adeudado
+            'deuda_total': pend['monto'].astype('Float64').fillna(0).groupby(pend['id_socio']).sum().to_dict(),
+        }
+    return derivado("estado_pagos", ["pagos"], construir)
+
+def grilla_cobro(df_soc, mes_target, texto="", solo_deudores=False, orden="Planilla"):
+    """Socios activos del Listado de Cobro con su estado del mes (st_mes) y deuda total, filtrados y ordenados"""
+    idx_pag = indice_estado_pagos()
+    df_show = df_soc[df_soc['activo'] == 1]
+    if texto: df_show = buscar_socios(df_show, texto)
+    df_show = df_show.assign(st_mes=[idx_pag['estado'].get((i, mes_target), "⚪") for i in df_show['id']],
+                             deuda=df_show['id'].map(idx_pag['deuda_total']).fillna(0))
+    if solo_deudores: df_show = df_show[df_show['deuda'] > 0]
+    if orden == "Mayor deuda": df_show = df_show.sort_values('deuda', ascending=False, kind='stable')
+    return df_show
+
+# --- LIBRO DIARIO (ingresos/egresos por día, sede, estado y método) ---
+# Se arma una vez desde pagos + gastos y después sólo se le pliegan las filas
+# nuevas que trae la sincronización incremental. Los totales de un rango salen
+# de sumas prefijas (dos búsquedas binarias); los desgloses agrupan el libro
+# ya agregado (días × sede × método), nunca los pagos crudos.
+CLAVES_LIBRO = ['fecha', 'sede', 'tipo', 'estado', 'metodo']
+
+def _agregar_movimientos(sheet_name, df, sede_de):
+    """Filas crudas de pagos/gastos -> movimientos agregados por CLAVES_LIBRO"""
+    if df is None or df.empty: return pd.DataFrame(columns=CLAVES_LIBRO + ['monto', 'n'])
+    if _hoja_base(sheet_name) == "pagos":
+        mov = pd.DataFrame({'fecha': df['fecha_pago'].dt.normalize(), 'sede': df['id_socio'].map(sede_de),
+                            'tipo': "ingreso", 'estado': df['estado'].astype(str), 'metodo': df['metodo'].astype(str)})
+    else:
+        mov = pd.DataFrame({'fecha': df['fecha'].dt.normalize(), 'sede': df['sede'].astype(str), 'tipo': "egreso",
+                            'estado': "Confirmado", 'metodo': df['metodo'].astype(str) if 'metodo' in df.columns else ""})
+    mov['sede'] = mov['sede'].replace("", None).fillna("Sin sede")
+    mov['monto'] = df['monto'].astype('Float64').fillna(0).astype(float)
+    mov['n'] = 1
+    return mov.dropna(subset=['fecha']).groupby(CLAVES_LIBRO, as_index=False)[['monto', 'n']].sum()
+
+def _origen_libro(sheet_name):
+    # completa_ts sólo cambia con una relectura completa: si se mantiene, las filas nuevas están al final
+    ent = _cache_hojas().get(sheet_name)
+    return (ent.get('completa_ts'), len(ent['df'])) if ent else (None, 0)
+
+def libro_diario(desde=None):
+    """{'dias': libro agregado, 'acum': sumas prefijas diarias} al día con pagos y gastos.
+    Si `desde` cae en años archivados, suma también esas particiones de pagos (y las conserva)"""
+    hojas = {h: _df_hoja(h) for h in ["pagos", "gastos"] + (particiones("pagos", desde) if desde else [])}
+    df_soc = _df_hoja("socios")
+    ver_soc = version_hoja("socios")
+    libro = st.session_state.get("_libro") or {'partes': {}, 'origen': {}, 'ver_socios': None}
+    sede_de = None
+    cambio = False
+    for h, df in hojas.items():
+        ts, n = _origen_libro(h)
+        ts_ant, n_ant = libro['origen'].get(h, (None, 0))
+        if h in libro['partes'] and (ts, n) == (ts_ant, n_ant) and (h == "gastos" or ver_soc == libro['ver_socios']): continue
+        if sede_de is None:
+            sede_de = dict(zip(df_soc['id'], df_soc['sede'].astype(str))) if df_soc is not None and not df_soc.empty else {}
+        if (h in libro['partes'] and ts is not None and ts == ts_ant and n >= n_ant
+                and (h == "gastos" or ver_soc == libro['ver_socios'])):
+            nuevas = _agregar_movimientos(h, df.iloc[n_ant:], sede_de)  # sólo la cola
+            libro['partes'][h] = pd.concat([libro['partes'][h], nuevas], ignore_index=True).groupby(
+                CLAVES_LIBRO, as_index=False)[['monto', 'n']].sum()
+        else:
+            libro['partes'][h] = _agregar_movimientos(h, df, sede_de)
+        libro['origen'][h] = (ts, n)
+        cambio = True
+    libro['ver_socios'] = ver_soc
+    if cambio or 'dias' not in libro:
+        dias = pd.concat(list(libro['partes'].values()), ignore_index=True)
+        dias['fecha'] = pd.to_datetime(dias['fecha'])
+        ing = dias[(dias['tipo'] == "ingreso") & (dias['estado'] == "Confirmado")].groupby('fecha')['monto'].sum()
+        fact = dias[dias['tipo'] == "ingreso"].groupby('fecha')['monto'].sum()  # todo pago registrado, cualquier estado
+        pend = dias[(dias['tipo'] == "ingreso") & (dias['estado'] == "Pendiente")].groupby('fecha')['monto'].sum()
+        egr = dias[dias['tipo'] == "egreso"].groupby('fecha')['monto'].sum()
+        diario = pd.DataFrame({'ingresos': ing, 'facturado': fact, 'pendiente': pend, 'egresos': egr}).fillna(0).sort_index()
+        libro['dias'], libro['acum'] = dias, diario.cumsum()
+    st.session_state["_libro"] = libro
+    return libro
+
+def totales_rango(libro, desde, hasta):
+    """{'ingresos' (confirmados), 'facturado', 'pendiente', 'egresos'} entre dos fechas inclusive, por diferencia de sumas prefijas"""
+    acum = libro['acum']
+    i = acum.index.searchsorted(pd.Timestamp(desde), side='left')
+    j = acum.index.searchsorted(pd.Timestamp(hasta), side='right')
+    if j <= i: return {c: 0.0 for c in acum.columns}
+    tot = acum.iloc[j - 1] - (acum.iloc[i - 1] if i else 0)
+    return tot.to_dict()
+
+def movimientos_rango(libro, desde, hasta):
+    """Filas del libro (ya agregadas por día) dentro del rango, para los desgloses"""
+    dias = libro['dias']
+    return dias[(dias['fecha'] >= pd.Timestamp(desde)) & (dias['fecha'] <= pd.Timestamp(hasta))]
+
+def resumen_dashboard(libro, desde, hasta):
+    """Lo que muestra el Dashboard: {'tot': totales_rango, 'por_sede'/'por_metodo': cobrado, 'mensual': evolución por mes y tipo}"""
+    mov = movimientos_rango(libro, desde, hasta)
+    cobrado = mov[(mov['tipo'] == "ingreso") & (mov['estado'] == "Confirmado")]
+    mensual = libro['dias'].copy()
+    if not mensual.empty:
+        mensual['mes'] = mensual['fecha'].dt.strftime('%Y-%m')
+        mensual = mensual.groupby(['mes', 'tipo'], as_index=False)['monto'].sum()
+        mensual['tipo'] = mensual['tipo'].map({"ingreso": "Ingresos", "egreso": "Gastos"})
+    return {'tot': totales_rango(libro, desde, hasta), 'mensual': mensual,
+            'por_sede': cobrado.groupby('sede', as_index=False)['monto'].sum(),
+            'por_metodo': cobrado.groupby('metodo', as_index=False)['monto'].sum()}
+
+# --- HISTORIAL POR SOCIO (asistencias y logs particionados por alumno) ---
+# Un solo groupby por versión de las hojas: el perfil toma las posiciones del
+# alumno y sus agregados ya calculados, sin filtrar la hoja entera.
+ULTIMAS_AUSENCIAS = get_ajuste("ultimas_ausencias", 5)
+DIAS_SEMANA = ["Lunes", "Martes", "Miércoles", "Jueves", "Viernes", "Sábado", "Domingo"]
+
+def indice_historial():
+    """{'asist': {id: {'pos', 'tasa', 'presentes', 'total', 'dias', 'ausencias'}}, 'logs': {id: pos}} + los frames de origen"""
+    def construir():
+        df_a, df_l = _df_hoja("asistencias"), _df_hoja("logs")
+        res = {'asist': {}, 'logs': {}, 'df_a': df_a, 'df_l': df_l}
+        if df_a is not None and not df_a.empty:
+            orden = df_a['fecha'].sort_values(ascending=False, kind='stable').index  # más reciente primero
+            df_o = df_a.loc[orden]
+            pres = (df_o['estado'] == "Presente").astype(int)
+            tot = pres.groupby(df_o['id_socio'], sort=False).agg(['sum', 'count'])
+            dias = pd.crosstab(df_o['id_socio'], df_o['fecha'].dt.dayofweek.where(pres == 1)).rename(
+                columns=lambda d: DIAS_SEMANA[int(d)])
+            aus = df_o[df_o['estado'] == "Ausente"].groupby('id_socio', sort=False).head(ULTIMAS_AUSENCIAS)
+            aus_por = {k: v[['fecha', 'nota']] for k, v in aus.groupby('id_socio', sort=False)}
+            for uid, pos in df_o.groupby('id_socio', sort=False).indices.items():
+                p, t = tot.loc[uid, 'sum'], tot.loc[uid, 'count']
+                d = dias.loc[uid] if uid in dias.index else pd.Series(dtype=int)
+                res['asist'][uid] = {'pos': orden[pos], 'presentes': int(p), 'total': int(t), 'tasa': p / t if t else 0.0,
+                                     'dias': d[d > 0], 'ausencias': aus_por.get(uid, pd.DataFrame(columns=['fecha', 'nota']))}
+        if df_l is not None and not df_l.empty and 'id_ref' in df_l.columns:
+            res['logs'] = df_l.groupby('id_ref', sort=False).indices
+        return res
+    return derivado("historial", ["asistencias", "logs"], construir)
+
+# --- ARCHIVO POR AÑO (pagos, asistencias y logs) ---
+# Los años cerrados se mueven a particiones '{hoja}_{año}' del mismo almacén y
+# la hoja "caliente" queda con el año en curso (y los pagos aún pendientes).
+# Las pantallas del día a día sólo leen la caliente; las particiones se leen
+# cuando un rango de fechas o el historial de un perfil llega hasta ellas.
+# Config: archivo_desde_<hoja> / archivo_corte_<hoja> = años [desde, corte) archivados.
+HOJAS_ARCHIVO = {'pagos': 'fecha_pago', 'asistencias': 'fecha', 'logs': 'fecha'}  # hoja -> columna de fecha
+
+def _hoja_base(sheet_name):
+    """'pagos_2023' -> 'pagos' (las particiones usan el esquema de su hoja)"""
+    base, _, anio = sheet_name.rpartition("_")
+    return base if base in HOJAS_ARCHIVO and anio.isdigit() else sheet_name
+
+def hoja_particion(sheet_name, anio):
+    return f"{sheet_name}_{anio}"
+
+def anios_archivados(sheet_name):
+    desde = get_config_value(f"archivo_desde_{sheet_name}", 0)
+    return list(range(desde, get_config_value(f"archivo_corte_{sheet_name}", 0))) if desde else []
+
+def particiones(sheet_name, desde=None):
+    """Particiones que cubren desde la fecha `desde` (todas si None), la más nueva primero"""
+    return [hoja_particion(sheet_name, a) for a in reversed(anios_archivados(sheet_name)) if desde is None or a >= desde.year]
+
+def df_historico(sheet_name, desde=None):
+    """Hoja caliente + particiones alcanzadas por `desde`. Sin copiar: sólo lectura"""
+    parts = particiones(sheet_name, desde)
+    if len(parts) > 1: precargar_hojas(parts)
+    frames = [f for f in [_df_hoja(sheet_name)] + [_df_hoja(p) for p in parts] if f is not None and not f.empty]
+    if len(frames) <= 1: return frames[0] if frames else pd.DataFrame()
+    df = pd.concat(frames, ignore_index=True)
+    for c, t in ESQUEMAS.get(sheet_name, {}).items():
+        if t == 'cat' and c in df.columns: df[c] = df[c].astype('category')
+    return df
+
+def historial_archivado(sheet_name, col, uid):
+    """Filas de un socio en las particiones (asistencias por id_socio, logs por id_ref)"""
+    frames = [_df_hoja(p) for p in particiones(sheet_name)]
+    frames = [f[f[col] == str(uid)] for f in frames if f is not None and not f.empty and col in f.columns]
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+def _anio_archivable(sheet_name, enc, fila, corte):
+    """Año de la fila si está cerrada y es anterior a `corte`; None si queda en la hoja caliente"""
+    celda = lambda c: str(fila[enc.index(c)]) if c in enc and enc.index(c) < len(fila) else ""
+    if sheet_name == "pagos" and celda("estado") == "Pendiente": return None  # la deuda se cobra desde la caliente
+    v = celda(HOJAS_ARCHIVO[sheet_name]) or (str(fila[0]) if fila else "")
+    m = re.match(r'\s*(\d{4})-', v)
+    if m: anio = int(m.group(1))
+    else:
+        f = pd.to_datetime(v, errors='coerce', dayfirst=True)
+        if pd.isna(f): return None
+        anio = f.year
+    return anio if anio < corte else None
+
+def archivar_hoja(sheet_name, corte):
+    """Mueve las filas cerradas de años anteriores a `corte` a sus particiones; devuelve {año: filas}"""
+    rep = get_replicador()
+    with rep.lock:  # el replicador no aplica nada mientras tanto: lo que se escriba queda en el diario y va después
+        rep.drenar((sheet_name,))
+        if rep.diario.abiertas_de(sheet_name):
+            raise storage.ErrorAlmacen(f"{sheet_name}: hay escrituras sin aplicar ({rep.ultimo_error}); reintente más tarde")
+        por_anio = _mover_a_particiones(get_almacen(), sheet_name, corte)
+        if por_anio: rep.cortar(sheet_name)
+    if not por_anio: return {}
+    # 4) Recién ahora se publica el rango: un lector nunca ve la misma fila dos veces
+    previo = anios_archivados(sheet_name)
+    set_config_value(f"archivo_desde_{sheet_name}", min(por_anio) if not previo else min(previo[0], min(por_anio)))
+    set_config_value(f"archivo_corte_{sheet_name}", max(corte, previo[-1] + 1 if previo else 0))
+    _subir_revision(sheet_name)
+    _descartar_indices(sheet_name)
+    invalidar_cache(sheet_name, *[hoja_particion(sheet_name, a) for a in por_anio])
+    return {a: len(f) for a, f in sorted(por_anio.items())}
+
+def _mover_a_particiones(alm, sheet_name, corte):
+    """Copia las filas a las particiones y achica la caliente (con el replicador frenado); devuelve {año: [filas]}"""
+    valores = alm.leer(sheet_name)
+    if len(valores) < 2: return {}
+    enc, por_anio = valores[0], {}
+    for f in valores[1:]:
+        a = _anio_archivable(sheet_name, enc, f, corte)
+        if a: por_anio.setdefault(a, []).append(f)
+    if not por_anio: return {}
+    # 1) Copia a las particiones; si una corrida anterior se cortó, no duplica lo ya copiado.
+    #    Los años sin filas quedan como partición vacía para que leerlos no falle
+    for a in range(min(por_anio), corte): alm.asegurar_hoja(hoja_particion(sheet_name, a), enc)
+    for a, filas in sorted(por_anio.items()):
+        part = hoja_particion(sheet_name, a)
+        ya = {tuple(_recortar(f)) for f in alm.leer(part)[1:]}
+        nuevas = [f for f in filas if tuple(_recortar(f)) not in ya]
+        if nuevas: alm.agregar_filas(part, nuevas)
+    # 2) Respaldo de la caliente: en Sheets reemplazar es borrar + escribir y un corte a mitad la dejaría vacía
+    respaldo = f"{sheet_name}_respaldo"
+    alm.asegurar_hoja(respaldo, enc)
+    alm.reemplazar_hoja(respaldo, valores)
+    # 3) Achica la caliente; si falla la restaura (el respaldo queda por si tampoco se pudo)
+    try: alm.reemplazar_hoja(sheet_name, [enc] + [f for f in valores[1:] if not _anio_archivable(sheet_name, enc, f, corte)])
+    except Exception:
+        try: alm.reemplazar_hoja(sheet_name, valores)
+        except Exception: pass
+        raise
+    try: alm.reemplazar_hoja(respaldo, [enc])
+    except Exception: pass
+    return por_anio
 
 def update_full_socio(id_socio, d, user_admin, original_data=None):
-    sh = get_client()
-    ws = sh.worksheet("socios")
-    try:
-        cell = ws.find(str(id_socio))
-        r = cell.row
-        # Mapeo estricto de columnas (Ajustar si cambian en sheet)
-        ws.update_cell(r, 3, d['nombre'])
-        ws.update_cell(r, 4, d['apellido'])
-        ws.update_cell(r, 5, d['dni'])
-        ws.update_cell(r, 6, str(d['nacimiento']))
-        ws.update_cell(r, 7, d['tutor'])    
-        ws.update_cell(r, 8, d['whatsapp']) 
-        ws.update_cell(r, 9, d['email'])    
-        ws.update_cell(r, 10, d['sede'])
-        ws.update_cell(r, 11, d['plan'])
-        ws.update_cell(r, 12, d['notas'])
-        ws.update_cell(r, 14, d['activo'])
-        ws.update_cell(r, 15, d['talle'])
-        ws.update_cell(r, 16, d['grupo']) 
-        ws.update_cell(r, 17, d['peso'])    
-        ws.update_cell(r, 18, d['altura'])
-        
-        cambios = []
-        if original_data:
-            for k, v in d.items():
-                if str(v) != str(original_data.get(k, '')): cambios.append(f"{k}: {v}")
-        if cambios: log_action(id_socio, "Edición Perfil", " | ".join(cambios), user_admin)
-        return True
-    except: return False
+    campos = {c: d[c] for c in ['nombre', 'apellido', 'dni', 'tutor', 'whatsapp', 'email', 'sede', 'plan',
+                                'notas', 'activo', 'talle', 'grupo', 'peso', 'altura']}
+    campos['fecha_nacimiento'] = str(d['nacimiento'])
+    if not actualizar_fila("socios", id_socio, campos): return False
+    
+    cambios = []
+    if original_data:
+        for k, v in d.items():
+            if str(v) != str(original_data.get(k, '')): cambios.append(f"{k}: {v}")
+    if cambios: log_action(id_socio, "Edición Perfil", " | ".join(cambios), user_admin)
+    return True
 
 def update_plan_socio(id_socio, nuevo_plan):
-    return update_cell_val("socios", id_socio, 11, nuevo_plan)
+    return update_cell_val("socios", id_socio, 'plan', nuevo_plan)
 
 def registrar_pago_existente(id_pago, metodo, user_cobrador, estado_final, nuevo_monto=None, nuevo_concepto=None, nota_conciliacion=""):
-    ws = get_client().worksheet("pagos")
-    try:
-        cell = ws.find(str(id_pago))
-        r = cell.row
-        ws.update_cell(r, 2, str(get_today_ar())) 
-        ws.update_cell(r, 7, metodo)
-        ws.update_cell(r, 8, nota_conciliacion) 
-        ws.update_cell(r, 9, estado_final) 
-        ws.update_cell(r, 10, user_cobrador)
-        if nuevo_monto: ws.update_cell(r, 5, nuevo_monto)
-        if nuevo_concepto: ws.update_cell(r, 6, nuevo_concepto)
-        log_action(id_pago, "Cobro Deuda", f"Cobrado por {user_cobrador}. Estado: {estado_final}", user_cobrador)
-        return True
-    except: return False
+    campos = {'fecha_pago': str(get_today_ar()), 'metodo': metodo, 'nota': nota_conciliacion, 'estado': estado_final, 'usuario': user_cobrador}
+    if nuevo_monto: campos['monto'] = nuevo_monto
+    if nuevo_concepto: campos['concepto'] = nuevo_concepto
+    if not actualizar_fila("pagos", id_pago, campos): return False
+    log_action(id_pago, "Cobro Deuda", f"Cobrado por {user_cobrador}. Estado: {estado_final}", user_cobrador)
+    return True
 
 def confirmar_pago_seguro(id_pago, user, nota=""):
-    return update_cell_val("pagos", id_pago, 9, "Confirmado")
+    return update_cell_val("pagos", id_pago, 'estado', "Confirmado")
+
+def reemplazar_hoja_df(sheet_name, df):
+    """Sobrescribe la hoja completa con el DataFrame (encabezado incluido)"""
+    valores = [df.columns.values.tolist()] + [[_a_celda(v) for v in f] for f in df.values.tolist()]
+    _registrar_escritura(sheet_name, 'reemplazar', {'valores': valores})
+    _descartar_indices(sheet_name)
+    invalidar_cache(sheet_name)
 
 def actualizar_tarifas_bulk(df_edited):
-    ws = get_client().worksheet("tarifas")
-    ws.clear()
-    ws.update([df_edited.columns.values.tolist()] + df_edited.values.tolist())
+    reemplazar_hoja_df("tarifas", df_edited)
 
 def calcular_edad(fecha_nac):
     try:
@@ -234,20 +1310,66 @@ def calcular_edad(fecha_nac):
         return hoy.year - fecha_nac.year - ((hoy.month, hoy.day) < (fecha_nac.month, fecha_nac.day))
     except: return "?"
 
-def generar_pdf(datos):
-    pdf = FPDF()
+# --- RECIBOS ---
+# El diseño del comprobante está en un solo lugar (_pagina_recibo). Un lote usa
+# una sola FPDF con una página por pago y el ZIP un PDF por pago; ambos se
+# arman enteros en memoria (y así los sirve download_button), por eso un lote
+# grande se genera en partes de RECIBOS_LOTE_MAX pagos (una por vez) y se
+# descarta al cambiar los filtros.
+RECIBOS_LOTE_MAX = get_ajuste("recibos_lote_max", 300)
+CAMPOS_RECIBO = [("Nº", 'id'), ("Fecha", 'fecha'), ("Alumno", 'alumno'), ("Concepto", 'concepto'),
+                 ("Período", 'mes'), ("Medio", 'metodo')]
+
+def _safe(t): return str(t).encode('latin-1', 'replace').decode('latin-1')
+
+def _nuevo_pdf():
+    from fpdf import FPDF
+    return FPDF()
+
+def _pagina_recibo(pdf, datos):
     pdf.add_page()
-    pdf.set_font("Arial", size=12)
     pdf.set_font("Arial", 'B', 16)
     pdf.cell(200, 10, txt="AREA ARQUEROS - COMPROBANTE", ln=1, align='C')
     pdf.ln(10)
-    def safe(t): return str(t).encode('latin-1', 'replace').decode('latin-1')
     pdf.set_font("Arial", size=12)
-    pdf.cell(200, 10, txt=f"Fecha: {safe(datos['fecha'])}", ln=1)
-    pdf.cell(200, 10, txt=f"Alumno: {safe(datos['alumno'])}", ln=1)
-    pdf.cell(200, 10, txt=f"Concepto: {safe(datos['concepto'])}", ln=1)
+    for etiqueta, clave in CAMPOS_RECIBO:
+        if datos.get(clave) not in (None, ""): pdf.cell(200, 10, txt=f"{etiqueta}: {_safe(datos[clave])}", ln=1)
     pdf.cell(200, 10, txt=f"Monto: ${datos['monto']}", ln=1)
-    return pdf.output(dest="S").encode("latin-1", errors='replace')
+
+def _pdf_bytes(pdf):
+    out = pdf.output(dest="S")
+    return out.encode("latin-1", errors='replace') if isinstance(out, str) else bytes(out)
+
+def generar_pdf(datos):
+    pdf = _nuevo_pdf()
+    _pagina_recibo(pdf, datos)
+    return _pdf_bytes(pdf)
+
+def pagos_para_recibos(df_pag, df_soc, mes=None, sedes=None):
+    """Pagos confirmados del mes (mes_cobrado) y sedes pedidas, como dicts listos para _pagina_recibo"""
+    if df_pag.empty: return []
+    sel = df_pag['estado'] == "Confirmado"
+    if mes: sel &= df_pag['mes_cobrado'] == mes
+    if sedes is not None and not df_soc.empty:
+        sel &= df_pag['id_socio'].map(dict(zip(df_soc['id'], df_soc['sede'].astype(str)))).isin(sedes)
+    pag = df_pag[sel]
+    return [{'id': r.id, 'fecha': r.fecha_pago.date() if pd.notna(r.fecha_pago) else "", 'alumno': r.nombre_socio,
+             'concepto': r.concepto, 'mes': r.mes_cobrado, 'metodo': r.metodo, 'monto': _a_celda(r.monto)}
+            for r in pag.itertuples(index=False)]
+
+def lote_recibos_pdf(recibos):
+    """Un PDF con una página por recibo (todas las páginas en memoria hasta el final)"""
+    pdf = _nuevo_pdf()
+    for d in recibos: _pagina_recibo(pdf, d)
+    return _pdf_bytes(pdf)
+
+def lote_recibos_zip(recibos):
+    """ZIP con un PDF por recibo, en bytes (cada PDF se genera y comprime de a uno)"""
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as z:
+        for d in recibos:
+            z.writestr(f"recibo_{_safe(d['alumno']).replace(' ', '_')}_{d['id']}.pdf", generar_pdf(d))
+    return buf.getvalue()
 
 # ==========================================
 # 3. SEGURIDAD Y AUTENTICACIÓN
@@ -259,59 +1381,99 @@ if "cobro_alumno_id" not in st.session_state: st.session_state["cobro_alumno_id"
 if "selected_group_id" not in st.session_state: st.session_state["selected_group_id"] = None
 
 def check_password(password, hashed):
-    try: return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+    try:
+        import bcrypt
+        return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
     except: return False
 
+def hash_password(password):
+    import bcrypt
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+
 def crear_usuario_real(user, password, rol, nombre, sedes):
-    hashed = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+    hashed = hash_password(password)
     row = [generate_id(), user, hashed, rol, nombre, sedes, 1]
     save_row("usuarios", row)
     return True
 
+# --- PRIMER PINTADO ---
+# Tiempo desde el inicio del rerun hasta que el formulario de login queda
+# dibujado (antes de tocar la base). Se guardan las últimas muestras del proceso.
+PRIMER_PINTADO_MAX = get_ajuste("primer_pintado_max", 0.5)  # seg de presupuesto
+
+@st.cache_resource
+def _tiempos_arranque():
+    return {'lock': threading.Lock(), 'muestras': []}
+
+def registrar_primer_pintado():
+    dt = time.perf_counter() - T_INICIO
+    est = _tiempos_arranque()
+    with est['lock']: est['muestras'] = (est['muestras'] + [dt])[-100:]
+    return dt
+
 def login_page():
     c1, c2, c3 = st.columns([1,1,1])
     with c2:
         try: st.image("logo.png", width=150)
         except: st.markdown("## 🔐 Area Arqueros")
         
-        df_users = get_df("usuarios")
-        if df_users.empty:
+        # Pintar el login no toca la base: usuarios se lee recién al enviar (y ahí se ve si está vacía)
+        with st.form("login"):
+            u = st.text_input("Usuario")
+            p = st.text_input("Contraseña", type="password")
+            enviar = st.form_submit_button("Ingresar")
+        registrar_primer_pintado()
+        
+        df_users = None
+        if enviar:
+            # Siempre del almacén: un cambio de contraseña vale desde ya (y una caída no pasa por "base vacía")
+            try: df_users = df_fresco("usuarios")
+            except Exception: st.error("No se pudo leer la base de usuarios. Reintente.")
+        if df_users is not None: st.session_state["_base_vacia"] = df_users.empty
+        if st.session_state.get("_base_vacia"):
             st.warning("⚠️ Base vacía. Cree el Admin Inicial.")
             with st.form("init"):
-                u = st.text_input("User"); p = st.text_input("Pass", type="password")
+                u_i = st.text_input("User"); p_i = st.text_input("Pass", type="password")
                 if st.form_submit_button("Crear"):
-                    crear_usuario_real(u, p, "Administrador", "Super Admin", "Todas")
+                    crear_usuario_real(u_i, p_i, "Administrador", "Super Admin", "Todas")
+                    st.session_state.pop("_base_vacia", None)
                     st.success("Creado."); time.sleep(2); st.rerun()
-            return
 
-        with st.form("login"):
-            u = st.text_input("Usuario")
-            p = st.text_input("Contraseña", type="password")
-            if st.form_submit_button("Ingresar"):
-                login_ok = False
-                # 1. Login DB Real
-                if not df_users.empty and 'user' in df_users.columns:
-                    match = df_users[df_users['user'] == u]
-                    if not match.empty and check_password(p, match.iloc[0]['pass_hash']):
-                        udata = match.iloc[0]
-                        s = str(udata['sedes_acceso']).split(",") if udata['sedes_acceso'] != "Todas" else get_lista_opciones("sede", DEF_SEDES)
-                        st.session_state.update({"auth": True, "user": udata['nombre_completo'], "rol": udata['rol'], "sedes": s})
-                        login_ok = True; st.rerun()
-                
-                # 2. Fallback Secrets
-                if not login_ok:
-                    try:
-                        B = st.secrets["users"]
-                        if u in B and str(B[u]["p"]) == p:
-                             st.session_state.update({"auth": True, "user": u, "rol": B[u]["r"], "sedes": DEF_SEDES})
-                             st.rerun()
-                        else: st.error("Datos incorrectos")
-                    except: st.error("Error de acceso")
+        if enviar:
+            login_ok = False
+            # 1. Login DB Real
+            if df_users is not None and not df_users.empty and 'user' in df_users.columns:
+                match = df_users[df_users['user'] == u]
+                if not match.empty and check_password(p, match.iloc[0]['pass_hash']):
+                    udata = match.iloc[0]
+                    s = str(udata['sedes_acceso']).split(",") if udata['sedes_acceso'] != "Todas" else get_lista_opciones("sede", DEF_SEDES)
+                    st.session_state.update({"auth": True, "user": udata['nombre_completo'], "rol": udata['rol'], "sedes": s})
+                    precargar_hojas(hojas_de_rol(udata['rol']), storage.FONDO)
+                    login_ok = True; st.rerun()
+            
+            # 2. Fallback Secrets
+            if not login_ok:
+                try:
+                    B = st.secrets["users"]
+                    if u in B and str(B[u]["p"]) == p:
+                         st.session_state.update({"auth": True, "user": u, "rol": B[u]["r"], "sedes": DEF_SEDES})
+                         precargar_hojas(hojas_de_rol(B[u]["r"]), storage.FONDO)
+                         st.rerun()
+                    else: st.error("Datos incorrectos")
+                except: st.error("Error de acceso")
 
 def logout():
     st.session_state["logged_in"] = False; st.session_state["auth"] = False; st.rerun()
 
-if not st.session_state["auth"]: login_page(); st.stop()
+activar_metricas(nuevo_rerun=True)
+
+if not st.session_state["auth"]:
+    with medir_seccion("login"): login_page()
+    st.stop()
+
+# Ya autenticado (pintar el login no toca la base; sólo enviarlo): arranca el replicador,
+# que reenvía lo que haya quedado en el diario (también tras un reinicio)
+get_replicador()
 
 # ==========================================
 # 4. INTERFAZ PRINCIPAL
@@ -339,33 +1501,62 @@ with st.sidebar:
     st.divider()
     if st.button("Cerrar Sesión"): logout()
 
+# --- RERUNS PARCIALES ---
+# Un fragmento se re-ejecuta solo cuando cambia un widget propio (sin login,
+# sidebar ni el resto de la página). Las pestañas se eligen con un selector:
+# st.tabs ejecuta todos los cuerpos, ocultos incluidos.
+_st_fragment = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None) or (lambda f: f)
+
+def fragmento(f):
+    """st.fragment que además mide la sección (un rerun de fragmento no pasa por el inicio del script)"""
+    @functools.wraps(f)
+    def medido(*args, **kwargs):
+        activar_metricas()
+        with medir_seccion(f.__name__): return f(*args, **kwargs)
+    return _st_fragment(medido)
+
+def pestanas(opciones, key):
+    """Reemplazo de st.tabs: devuelve la pestaña elegida y sólo esa se evalúa"""
+    return st.radio("Sección", opciones, horizontal=True, label_visibility="collapsed", key=key)
+
 # ==========================================
 # 5. MÓDULOS
 # ==========================================
+T_PAGINA = time.perf_counter()
 
 # === DASHBOARD ===
 if nav == "Dashboard":
     st.title("📊 Estadísticas")
-    c1, c2 = st.columns(2)
-    fecha_inicio = c1.date_input("Desde", date.today().replace(day=1))
-    fecha_fin = c2.date_input("Hasta", date.today())
+    precargar_hojas(["pagos", "gastos", "socios"])
+    
+    @fragmento
+    def panel_dashboard():
+        import plotly.express as px
+        c1, c2 = st.columns(2)
+        fecha_inicio = c1.date_input("Desde", date.today().replace(day=1))
+        fecha_fin = c2.date_input("Hasta", date.today())
+    
+        res = resumen_dashboard(libro_diario(fecha_inicio), fecha_inicio, fecha_fin)
+        tot = res['tot']
+        # Ingresos = todos los pagos del rango, como siempre; "Por cobrar" es la parte pendiente (incluida)
+        ing, egr = tot['facturado'], tot['egresos']
     
-    df_pagos = get_df("pagos")
-    df_gastos = get_df("gastos")
-    df_s = get_df("socios")
+        k1, k2, k3, k4 = st.columns(4)
+        k1.metric("Ingresos", f"${ing:,.0f}")
+        k2.metric("Gastos", f"${egr:,.0f}")
+        k3.metric("Neto", f"${ing-egr:,.0f}")
+        k4.metric("Por cobrar", f"${tot['pendiente']:,.0f}", help="Pagos pendientes del rango (ya incluidos en Ingresos)")
     
-    ing = 0; egr = 0
-    if not df_pagos.empty:
-        df_pagos['dt'] = pd.to_datetime(df_pagos['fecha_pago'], errors='coerce').dt.date
-        ing = pd.to_numeric(df_pagos[(df_pagos['dt']>=fecha_inicio)&(df_pagos['dt']<=fecha_fin)]['monto'], errors='coerce').fillna(0).sum()
-    if not df_gastos.empty:
-        df_gastos['dt'] = pd.to_datetime(df_gastos['fecha'], errors='coerce').dt.date
-        egr = pd.to_numeric(df_gastos[(df_gastos['dt']>=fecha_inicio)&(df_gastos['dt']<=fecha_fin)]['monto'], errors='coerce').fillna(0).sum()
+        if not res['por_sede'].empty:
+            g1, g2 = st.columns(2)
+            g1.plotly_chart(px.bar(res['por_sede'], x='sede', y='monto', title='Cobrado por Sede'), use_container_width=True)
+            g2.plotly_chart(px.pie(res['por_metodo'], names='metodo', values='monto', title='Cobrado por Método'),
+                            use_container_width=True)
     
-    k1, k2, k3 = st.columns(3)
-    k1.metric("Ingresos", f"${ing:,.0f}")
-    k2.metric("Gastos", f"${egr:,.0f}")
-    k3.metric("Neto", f"${ing-egr:,.0f}")
+        if not res['mensual'].empty:
+            st.plotly_chart(px.line(res['mensual'], x='mes', y='monto', color='tipo', markers=True, title='Evolución Mensual'),
+                            use_container_width=True)
+    panel_dashboard()
 
 # === MIS GRUPOS ===
 elif nav == "Mis Grupos":
@@ -396,6 +1587,7 @@ elif nav == "Mis Grupos":
             else: st.info("No tienes grupos aquí.")
     else:
         gid = st.session_state["selected_group_id"]
+        precargar_hojas(["entrenamientos_plantilla", "inscripciones", "socios", "listas"])
         df_plant = get_df("entrenamientos_plantilla")
         if not df_plant.empty and str(gid) in df_plant['id'].astype(str).values:
             grp = df_plant[df_plant['id'] == str(gid)].iloc[0]
@@ -403,40 +1595,41 @@ elif nav == "Mis Grupos":
             if st.button("⬅️ Volver"): st.session_state["selected_group_id"]=None; st.rerun()
             st.title(f"{grp['grupo']} ({grp['dia']})")
             
-            t_plantel, t_asist = st.tabs(["👥 Plantel", "✅ Planilla"])
+            df_insc = get_df("inscripciones")
+            df_soc = get_df("socios")
+            inscritos = df_insc[df_insc['id_entrenamiento'] == str(gid)] if not df_insc.empty else pd.DataFrame()
+            pest = pestanas(["👥 Plantel", "✅ Planilla", "📅 Semana"], "pest_grupo")
             
-            with t_plantel:
-                df_insc = get_df("inscripciones")
-                df_soc = get_df("socios")
-                inscritos = df_insc[df_insc['id_entrenamiento'] == str(gid)] if not df_insc.empty else pd.DataFrame()
-                
-                st.metric("Alumnos", len(inscritos))
+            @fragmento
+            def plantel(gid, inscritos):
+                libre = cupo_libre(gid)
+                st.metric("Alumnos", len(inscritos) if libre is None else f"{len(inscritos)} / {len(inscritos) + libre}")
                 if not inscritos.empty:
                     for idx, r in inscritos.iterrows():
                         c1, c2 = st.columns([4,1])
                         c1.write(r['nombre_alumno'])
                         if c2.button("Baja", key=f"b_{r['id']}"):
-                             delete_row_by_condition("inscripciones", "id", r['id'])
+                             if delete_row_by_condition("inscripciones", "id", r['id']): ocupacion_baja(r['id'])
                              st.success("Baja OK"); time.sleep(0.5); st.rerun()
                 
                 st.divider()
-                if not df_soc.empty:
-                    act = df_soc[df_soc['activo']==1]
-                    ya = inscritos['id_socio'].tolist() if not inscritos.empty else []
-                    disp = act[~act['id'].isin(ya)]
-                    if not disp.empty:
-                        # CORRECCIÓN: Concatenar Series correctamente antes de convertir a lista para el selectbox
-                        opciones_alumnos = (disp['id'].astype(str) + " - " + disp['nombre'] + " " + disp['apellido']).tolist()
-                        alu_new = st.selectbox("Inscribir", opciones_alumnos)
-                        
-                        if st.button("Agregar"):
-                            uid = int(alu_new.split(" - ")[0]); nom = alu_new.split(" - ")[1] 
-                            if not check_horario_conflict(uid, grp['dia'], grp['horario']):
-                                save_row("inscripciones", [generate_id(), uid, nom, gid, ""])
-                                st.success("Agregado"); time.sleep(1); st.rerun()
-                            else: st.error("Conflicto Horario")
-
-            with t_asist:
+                ya = alumnos_del_grupo(gid)
+                disp = [(i, n) for i, n in socios_activos() if i not in ya]
+                if libre is not None and libre <= 0: st.warning("Cupo completo")
+                elif disp:
+                    nuevos = st.multiselect("Inscribir", disp, format_func=lambda a: f"{a[0]} - {a[1]}")
+                    if libre is not None: st.caption(f"Lugares libres: {libre}")
+                    
+                    if st.button("Agregar", disabled=not nuevos):
+                        reporte = inscribir_lote(gid, nuevos)
+                        st.session_state["reporte_inscripcion"] = reporte
+                        st.rerun()
+                rep_insc = st.session_state.pop("reporte_inscripcion", None)
+                if rep_insc:
+                    st.dataframe(pd.DataFrame(rep_insc, columns=["Alumno", "Resultado"]), use_container_width=True, hide_index=True)
+            
+            @fragmento
+            def planilla(grp, inscritos, df_soc):
                 hoy = get_today_ar()
                 f_sel = st.date_input("Fecha", hoy)
                 
@@ -464,22 +1657,56 @@ elif nav == "Mis Grupos":
                         if inv_sel != "--": inv = inv_sel
 
                     if st.form_submit_button("Guardar"):
-                        cnt = 0
+                        ids_a, id_p = [], None  # operaciones de ESTE guardado: el reporte es sobre ellas
                         for uid, p in checks.items():
                             est = "Presente" if p else "Ausente"
                             n = notas.get(uid, "")
                             nom = inscritos[inscritos['id_socio']==str(uid)].iloc[0]['nombre_alumno']
-                            save_row("asistencias", [str(f_sel), datetime.now().strftime("%H:%M"), uid, nom, grp['sede'], grp['grupo'], est, n])
-                            cnt+=1
+                            ids_a.append(save_row("asistencias", [str(f_sel), datetime.now().strftime("%H:%M"), uid, nom, grp['sede'], grp['grupo'], est, n]))
                         
                         if inv:
                             uid_i = int(inv.split(" - ")[0]); nom_i = inv.split(" - ")[1]
-                            save_row("asistencias", [str(f_sel), datetime.now().strftime("%H:%M"), uid_i, nom_i, grp['sede'], grp['grupo'], "Presente", f"Invitado: {tipo}"])
-                            cnt+=1
+                            ids_a.append(save_row("asistencias", [str(f_sel), datetime.now().strftime("%H:%M"), uid_i, nom_i, grp['sede'], grp['grupo'], "Presente", f"Invitado: {tipo}"]))
                             if "Extra" in tipo:
-                                save_row("pagos", [generate_id(), str(f_sel), uid_i, nom_i, 5000, "Clase Extra", "Pendiente", "", "Pendiente", user, str(f_sel)])
-                                st.toast("Deuda generada.")
-                        st.success(f"{cnt} guardados")
+                                id_p = save_row("pagos", [generate_id(), str(f_sel), uid_i, nom_i, 5000, "Clase Extra", "Pendiente", "", "Pendiente", user, str(f_sel)])
+                        
+                        ok = aplicadas(ids_a + [id_p] * (id_p is not None), "asistencias", "pagos")
+                        ok_a = ok[:len(ids_a)]
+                        if all(ok_a): st.success(f"{len(ok_a)} guardados")
+                        else: st.warning(f"⚠️ {ok_a.count(False)} de {len(ok_a)} filas siguen en el diario local, aún sin confirmar en la base: se reenvían solas.")
+                        if id_p is not None:
+                            if ok[-1]: st.toast("Deuda generada.")
+                            else: st.warning("⚠️ La deuda de la clase extra sigue en el diario local y se reenvía sola.")
+            
+            @fragmento
+            def semana(grp, gid, inscritos):
+                c1, c2 = st.columns(2)
+                desde = c1.date_input("Semana desde", get_today_ar() - timedelta(days=get_today_ar().weekday()), key="sem_desde")
+                semanas = c2.number_input("Semanas", 1, 8, 1, key="sem_n")
+                fechas = fechas_de_clase(grp['dia'], desde, int(semanas))
+                if not fechas: st.error(f"No se reconoce el día del grupo ('{grp['dia']}'). Corríjalo en la plantilla de entrenamientos.")
+                elif inscritos.empty: st.info("Sin alumnos inscriptos.")
+                else:
+                    base = pd.DataFrame({'id_socio': inscritos['id_socio'].values, 'Alumno': inscritos['nombre_alumno'].values})
+                    for f in fechas: base[f.strftime("%d/%m")] = True
+                    base['Motivo'] = ""
+                    grilla = st.data_editor(base, hide_index=True, use_container_width=True, key=f"grilla_{gid}_{desde}_{semanas}",
+                                            disabled=['id_socio', 'Alumno'],
+                                            column_config={'id_socio': None, 'Motivo': st.column_config.SelectboxColumn(
+                                                "Motivo", options=[""] + get_lista_opciones("motivo_ausencia", DEF_MOTIVOS))})
+                    if st.button("💾 Guardar semana", type="primary"):
+                        datos = {r['id_socio']: (r['Alumno'], {f: bool(r[f.strftime("%d/%m")]) for f in fechas})
+                                 for _, r in grilla.iterrows()}
+                        motivos = {r['id_socio']: r['Motivo'] for _, r in grilla.iterrows()}
+                        reporte = pd.DataFrame(asistencia_lote(grp, datos, motivos, user), columns=["Alumno", "Fecha", "Resultado"])
+                        n_ok = (reporte['Resultado'] == "✅").sum()
+                        if n_ok == len(reporte): st.success(f"{n_ok} registros guardados")
+                        else: st.warning(f"{n_ok} de {len(reporte)} registros guardados")
+                        st.dataframe(reporte, use_container_width=True, hide_index=True)
+            
+            if pest == "👥 Plantel": plantel(gid, inscritos)
+            elif pest == "✅ Planilla": planilla(grp, inscritos, df_soc)
+            else: semana(grp, gid, inscritos)
         else:
             st.error("Grupo no encontrado.")
             if st.button("Volver"): st.session_state["selected_group_id"]=None; st.rerun()
@@ -488,9 +1715,10 @@ elif nav == "Mis Grupos":
 elif nav == "Alumnos":
     if st.session_state["view_profile_id"] is None:
         st.title("👥 Gestión de Alumnos")
-        tab_dir, tab_new = st.tabs(["📂 Directorio", "➕ Nuevo Alumno"])
+        pest = pestanas(["📂 Directorio", "➕ Nuevo Alumno"], "pest_alumnos")
         
-        with tab_dir:
+        @fragmento
+        def directorio():
             df = get_df("socios")
             if not df.empty:
                 with st.expander("🔍 Filtros de Búsqueda", expanded=True):
@@ -503,7 +1731,7 @@ elif nav == "Alumnos":
                 if f_sede != "Todas": df_fil = df_fil[df_fil['sede'] == f_sede]
                 if f_act == "Activos": df_fil = df_fil[df_fil['activo'] == 1]
                 elif f_act == "Inactivos": df_fil = df_fil[df_fil['activo'] == 0]
-                if search: df_fil = df_fil[df_fil.astype(str).apply(lambda x: x.str.contains(search, case=False)).any(axis=1)]
+                if search: df_fil = buscar_socios(df_fil, search)
                 
                 st.caption(f"Resultados: {len(df_fil)}")
                 
@@ -512,13 +1740,14 @@ elif nav == "Alumnos":
                 start = (pag-1)*rows
                 
                 for idx, row in df_fil.iloc[start:start+rows].iterrows():
-                    status = "🟢" if row['activo']==1 else "🔴"
+                    status = "🟢" if es_activo(row['activo']) else "🔴"
                     label = f"{status} {row['nombre']} {row['apellido']} | DNI: {row['dni']} | {row['sede']} | Plan: {row.get('plan','-')}"
                     if st.button(label, key=f"r_{row['id']}_{idx}", use_container_width=True):
                         st.session_state["view_profile_id"] = row['id']
                         st.rerun()
         
-        with tab_new:
+        if pest == "📂 Directorio": directorio()
+        else:
             st.subheader("Alta Completa")
             with st.form("alta"):
                 c1, c2 = st.columns(2)
@@ -547,6 +1776,7 @@ elif nav == "Alumnos":
                         st.success("Guardado")
     else:
         uid = st.session_state["view_profile_id"]
+        precargar_hojas(["socios", "tarifas", "asistencias", "logs"])
         df = get_df("socios")
         if not df.empty:
             p_data = df[df['id'] == str(uid)]
@@ -557,9 +1787,9 @@ elif nav == "Alumnos":
                     st.rerun()
                 
                 st.title(f"👤 {p['nombre']} {p['apellido']}")
-                t1, t2, t3 = st.tabs(["✏️ Datos", "📅 Asistencia", "🔒 Historial"])
+                pest = pestanas(["✏️ Datos", "📅 Asistencia", "🔒 Historial"], "pest_perfil")
                 
-                with t1:
+                if pest == "✏️ Datos":
                     if rol == "Administrador":
                         with st.form("edit"):
                             c1,c2 = st.columns(2)
@@ -579,7 +1809,7 @@ elif nav == "Alumnos":
                             n_peso = c3.number_input("Peso", value=float(p.get('peso') or 0))
                             n_alt = c4.number_input("Altura", value=int(p.get('altura') or 0))
                             n_notas = st.text_area("Notas", p.get('notas',''))
-                            n_act = st.checkbox("Activo", value=True if p['activo']==1 else False)
+                            n_act = st.checkbox("Activo", value=es_activo(p['activo']))
                             
                             if st.form_submit_button("Guardar"):
                                 d = {
@@ -587,38 +1817,56 @@ elif nav == "Alumnos":
                                     'email': n_email, 'whatsapp': n_wsp, 'talle': n_talle, 'tutor': n_tutor, 'notas': n_notas,
                                     'nacimiento': p.get('fecha_nacimiento',''), 'peso': n_peso, 'altura': n_alt, 'grupo': p.get('grupo','')
                                 }
-                                update_full_socio(uid, d, user, p.to_dict())
-                                st.success("Ok"); time.sleep(1); st.rerun()
+                                if update_full_socio(uid, d, user, p.to_dict()):
+                                    st.success("Ok"); time.sleep(1); st.rerun()
+                                else: st.error("❌ No se pudo guardar (la base no respondió). Reintente en unos segundos.")
                     else: st.info("Solo lectura")
                 
-                with t2:
-                    df_a = get_df("asistencias")
-                    if not df_a.empty:
-                        mis_a = df_a[df_a['id_socio'] == str(uid)]
-                        if not mis_a.empty:
-                            mis_a['dt'] = pd.to_datetime(mis_a['fecha'], errors='coerce')
-                            mis_a['Dia'] = mis_a['dt'].dt.day_name()
-                            fig = px.pie(mis_a, names='Dia', title='Días de Entreno')
+                elif pest == "📅 Asistencia":
+                    hist = indice_historial()
+                    h = hist['asist'].get(str(uid))
+                    if h:
+                        m1, m2, m3 = st.columns(3)
+                        m1.metric("Asistencia", f"{h['tasa']:.0%}")
+                        m2.metric("Presentes", h['presentes'])
+                        m3.metric("Clases", h['total'])
+                        if not h['dias'].empty:
+                            import plotly.express as px
+                            fig = px.pie(names=h['dias'].index, values=h['dias'].values, title='Días de Entreno')
                             st.plotly_chart(fig, use_container_width=True)
-                            st.dataframe(mis_a[['fecha', 'sede', 'grupo_turno', 'estado', 'nota']], use_container_width=True)
+                        if not h['ausencias'].empty:
+                            st.caption(f"Últimas {ULTIMAS_AUSENCIAS} ausencias")
+                            st.dataframe(h['ausencias'].rename(columns={'nota': 'motivo'}), use_container_width=True, hide_index=True)
+                        mis_a = hist['df_a'].loc[h['pos']]
+                        st.dataframe(mis_a[['fecha', 'sede', 'grupo_turno', 'estado', 'nota']], use_container_width=True)
+                    if anios_archivados("asistencias") and st.checkbox("Ver años archivados", key="arch_asist"):
+                        viejas = historial_archivado("asistencias", 'id_socio', uid)
+                        if viejas.empty: st.info("Sin asistencias archivadas.")
+                        else: st.dataframe(viejas.sort_values('fecha', ascending=False)[['fecha', 'sede', 'grupo_turno', 'estado', 'nota']],
+                                           use_container_width=True, hide_index=True)
                 
-                with t3:
-                    df_l = get_df("logs")
-                    if not df_l.empty and 'id_ref' in df_l.columns:
-                        mis_l = df_l[df_l['id_ref'] == str(uid)]
-                        st.dataframe(mis_l, use_container_width=True)
+                else:
+                    hist = indice_historial()
+                    pos_l = hist['logs'].get(str(uid))
+                    if pos_l is not None:
+                        st.dataframe(hist['df_l'].iloc[pos_l], use_container_width=True)
+                    if anios_archivados("logs") and st.checkbox("Ver años archivados", key="arch_logs"):
+                        viejos = historial_archivado("logs", 'id_ref', uid)
+                        if viejos.empty: st.info("Sin registros archivados.")
+                        else: st.dataframe(viejos, use_container_width=True, hide_index=True)
 
 # === CONTABILIDAD ===
 elif nav == "Contabilidad":
     st.title("📒 Contabilidad")
+    precargar_hojas(["pagos", "gastos", "socios", "tarifas", "config"])
     with st.sidebar:
         st.markdown("### Filtros")
         f_sede = st.multiselect("Sede", DEF_SEDES, default=DEF_SEDES)
         f_mes = st.selectbox("Mes", ["Todos"] + MESES)
     
-    tab_cuotas, tab_ocasional, tab_rep = st.tabs(["📋 Gestión", "🛍️ Ocasional", "📊 Caja"])
+    pest = pestanas(["📋 Gestión", "🛍️ Ocasional", "📊 Caja", "🧾 Recibos"], "pest_conta")
     
-    with tab_cuotas:
+    if pest == "📋 Gestión":
         dia_corte = int(get_config_value("dia_corte", 19))
         hoy = get_today_ar()
         idx_m = hoy.month - 1
@@ -631,31 +1879,17 @@ elif nav == "Contabilidad":
         mes_target = f"{MESES[t_idx]} {yr}"
         st.caption(f"Período: **{mes_target}**")
         
-        # Auto-Gen
-        df_pag = get_df("pagos")
+        # Auto-Gen (una sola vez por período: la marca queda en config)
         df_soc = get_df("socios")
-        df_tar = get_df("tarifas")
-        pagos_gen = []
-        if not df_pag.empty and 'mes_cobrado' in df_pag.columns:
-            pagos_mes = df_pag[(df_pag['mes_cobrado'] == mes_target) & (df_pag['concepto'].astype(str).str.contains("Cuota"))]
-            pagos_gen = pagos_mes['id_socio'].unique()
-        
-        if not df_soc.empty:
-            pendientes = df_soc[(df_soc['activo']==1) & (~df_soc['id'].isin(pagos_gen))]
-            if not pendientes.empty:
-                filas = []
-                for idx, row_s in pendientes.iterrows():
-                    pr = 15000
-                    if not df_tar.empty and row_s['plan'] in df_tar['concepto'].values:
-                        pr = df_tar[df_tar['concepto']==row_s['plan']]['valor'].values[0]
-                    row_p = [generate_id(), str(get_today_ar()), row_s['id'], f"{row_s['nombre']} {row_s['apellido']}", pr, "Cuota Mensual", "Pendiente", f"Plan: {row_s['plan']}", "Pendiente", "System", mes_target]
-                    filas.append(row_p)
-                if save_rows_bulk("pagos", filas):
-                    st.success(f"Auto-Generadas {len(filas)} cuotas."); time.sleep(1); st.rerun()
+        gen = generar_cuotas_periodo(df_soc, mes_target, yr * 100 + t_idx + 1)
+        if gen:
+            filas, oks = gen
+            if filas and all(oks): st.success(f"Auto-Generadas {len(filas)} cuotas.")
+            elif filas: st.warning(f"{len(filas)} cuotas generadas en el diario local; se envían a la base cuando responda.")
 
         # Cobro
-        if st.session_state["cobro_alumno_id"]:
-            uid = st.session_state["cobro_alumno_id"]
+        @fragmento
+        def form_cobro(uid, df_soc, mes_target, yr):
             alu = df_soc[df_soc['id']==str(uid)].iloc[0]
             st.subheader(f"Cobrar a: {alu['nombre']}")
             if st.button("Cancelar"): st.session_state["cobro_alumno_id"]=None; st.rerun()
@@ -680,93 +1914,178 @@ elif nav == "Contabilidad":
             nota = st.text_input("Nota")
             conf = st.checkbox("Confirmar", value=True)
             
-            deuda_id = None
-            if not df_pag.empty:
-                chk = df_pag[(df_pag['id_socio']==str(uid)) & (df_pag['mes_cobrado']==mes_p) & (df_pag['estado']=='Pendiente')]
-                if not chk.empty: deuda_id = chk.iloc[0]['id']
+            deuda_id = indice_estado_pagos()['deuda_id'].get((str(uid), mes_p))
             
             if st.button("PAGAR", type="primary", use_container_width=True):
                 if conc != alu['plan']: update_plan_socio(uid, conc)
                 st_pago = "Confirmado" if conf else "Pendiente"
-                
-                if deuda_id: registrar_pago_existente(deuda_id, met, user, st_pago, mon, conc, nota)
+            
+                if deuda_id:
+                    if not registrar_pago_existente(deuda_id, met, user, st_pago, mon, conc, nota):
+                        st.error("❌ No se pudo registrar el cobro (la base no respondió). Reintente."); st.stop()
                 else: save_row("pagos", [generate_id(), str(get_today_ar()), uid, f"{alu['nombre']} {alu['apellido']}", mon, conc, met, nota, st_pago, user, mes_p])
-                
-                st.success("Listo")
+            
                 d_pdf = {"fecha":str(get_today_ar()), "alumno":f"{alu['nombre']} {alu['apellido']}", "monto":mon, "concepto":conc, "metodo":met, "mes":mes_p, "nota":nota}
-                pdf_b = generar_pdf(d_pdf)
-                b64 = base64.b64encode(pdf_b).decode()
-                href = f'<a href="data:application/octet-stream;base64,{b64}" download="Recibo.pdf"><button>Descargar Recibo</button></a>'
-                st.markdown(href, unsafe_allow_html=True)
-                time.sleep(3); st.session_state["cobro_alumno_id"]=None; st.rerun()
-
-        else:
+                # Los bytes quedan en sesión para ofrecer la descarga después del rerun
+                st.session_state["ultimo_recibo"] = {'nombre': f"Recibo_{alu['apellido']}_{mes_p}.pdf".replace(" ", "_"), 'datos': generar_pdf(d_pdf)}
+                st.session_state["cobro_alumno_id"]=None; st.rerun()
+        
+        @fragmento
+        def listado_cobro(df_soc, mes_target):
+            rec = st.session_state.get("ultimo_recibo")
+            if rec:
+                c1, c2 = st.columns([3,1])
+                c1.success("Pago registrado")
+                c1.download_button("🧾 Descargar Recibo", rec['datos'], file_name=rec['nombre'], mime="application/pdf")
+                if c2.button("Cerrar"): del st.session_state["ultimo_recibo"]; st.rerun()
             st.subheader("Listado de Cobro")
-            col_s, col_r = st.columns([3,1])
+            col_s, col_d, col_o, col_r = st.columns([3,1,1,1])
             search = col_s.text_input("Buscar")
+            solo_deudores = col_d.checkbox("Solo deudores")
+            orden = col_o.selectbox("Orden", ["Planilla", "Mayor deuda"])
             rows = col_r.selectbox("Filas", [25, 50])
             
             if not df_soc.empty:
-                df_show = df_soc[df_soc['activo']==1]
-                if search: df_show = df_show[df_show.astype(str).apply(lambda x: x.str.contains(search, case=False)).any(axis=1)]
-                
+                df_show = grilla_cobro(df_soc, mes_target, search, solo_deudores, orden)
                 subset = df_show.head(rows)
                 cols = st.columns([3, 2, 2, 2])
                 cols[0].markdown("**Alumno**"); cols[1].markdown("**Sede**"); cols[2].markdown(f"**{mes_target}**"); cols[3].markdown("**Acción**")
                 st.markdown("---")
-                
+            
                 # CORRECCIÓN KEY DUPLICADA EN COBRO
                 for i, (idx, row) in enumerate(subset.iterrows()):
-                    st_mes = "⚪"
-                    if not df_pag.empty:
-                        pm = df_pag[(df_pag['id_socio']==row['id']) & (df_pag['mes_cobrado']==mes_target)]
-                        if not pm.empty:
-                            if "Confirmado" in pm['estado'].values: st_mes = "✅"
-                            else: st_mes = "🔴"
-                    
                     c1, c2, c3, c4 = st.columns([3,2,2,2])
                     c1.write(f"{row['nombre']} {row['apellido']}")
                     c2.caption(row['sede'])
-                    c3.write(st_mes)
+                    c3.write(f"{row['st_mes']}  ·  debe ${row['deuda']:,.0f}" if row['deuda'] > 0 else row['st_mes'])
                     if c4.button("Cobrar", key=f"pay_{row['id']}_{i}"):
                         st.session_state["cobro_alumno_id"] = row['id']
                         st.rerun()
                     st.divider()
+        
+        if st.session_state["cobro_alumno_id"]: form_cobro(st.session_state["cobro_alumno_id"], df_soc, mes_target, yr)
+        else: listado_cobro(df_soc, mes_target)
 
-    with tab_ocasional:
+    elif pest == "🛍️ Ocasional":
         st.info("Módulo Ocasional Activo")
     
-    with tab_rep:
+    elif pest == "🧾 Recibos":
+        st.markdown("### Recibos por Lote")
+        
+        @fragmento
+        def recibos_lote(sedes):
+            viejos = bool(anios_archivados("pagos")) and st.checkbox("Incluir años archivados")
+            df_pag = df_historico("pagos") if viejos else get_df("pagos")
+            meses = sorted(df_pag['mes_cobrado'].astype(str).unique().tolist()) if not df_pag.empty else []
+            if not meses: st.info("Sin pagos registrados."); return
+            hoy = get_today_ar()
+            mes_actual = f"{MESES[hoy.month-1]} {hoy.year}"
+            c1, c2 = st.columns(2)
+            mes = c1.selectbox("Período", meses, index=meses.index(mes_actual) if mes_actual in meses else 0)
+            formato = c2.radio("Formato", ["PDF único", "ZIP (un PDF por pago)"], horizontal=True)
+            recibos = pagos_para_recibos(df_pag, get_df("socios"), mes, sedes)
+            st.caption(f"{len(recibos)} pagos confirmados · sedes: {', '.join(sedes)}")
+            # El lote generado sólo vale para estos filtros: si cambian, se libera
+            # Más de RECIBOS_LOTE_MAX: se generan en partes, de a una (en memoria queda sólo la elegida)
+            partes = max(1, -(-len(recibos) // RECIBOS_LOTE_MAX))
+            parte = st.selectbox(f"Parte (de a {RECIBOS_LOTE_MAX} recibos)", range(1, partes + 1),
+                                 format_func=lambda p: f"{p} de {partes}") if partes > 1 else 1
+            firma = (mes, formato, tuple(sedes), viejos, parte)
+            lote = st.session_state.get("lote_recibos")
+            if lote and lote['firma'] != firma: st.session_state.pop("lote_recibos"); lote = None
+            if recibos and st.button("Generar", type="primary"):
+                tramo = recibos[(parte - 1) * RECIBOS_LOTE_MAX:parte * RECIBOS_LOTE_MAX]
+                with st.spinner("Generando..."):
+                    zip_ = formato.startswith("ZIP")
+                    datos = lote_recibos_zip(tramo) if zip_ else lote_recibos_pdf(tramo)
+                sufijo = f"_parte_{parte}_de_{partes}" if partes > 1 else ""
+                lote = st.session_state["lote_recibos"] = {'nombre': f"Recibos_{mes}{sufijo}.{'zip' if zip_ else 'pdf'}".replace(" ", "_"),
+                                                           'datos': datos, 'mime': "application/zip" if zip_ else "application/pdf",
+                                                           'firma': firma}
+            if lote: st.download_button(f"⬇️ {lote['nombre']}", lote['datos'], file_name=lote['nombre'], mime=lote['mime'],
+                                        on_click=lambda: st.session_state.pop("lote_recibos", None))  # descargado: se libera
+        recibos_lote(f_sede)
+    
+    else:
         st.markdown("### Caja Diaria")
-        df_p = get_df("pagos")
-        if not df_p.empty:
-            td = str(get_today_ar())
-            ch = df_p[(df_p['fecha_pago']==td) & (df_p['estado']=='Confirmado')]
-            tot = pd.to_numeric(ch['monto'], errors='coerce').sum()
-            st.metric("Total Hoy", f"${tot:,.0f}")
-            st.dataframe(ch)
+        
+        @fragmento
+        def caja_diaria():
+            libro = libro_diario()
+            hoy = get_today_ar()
+            st.metric("Total Hoy", f"${totales_rango(libro, hoy, hoy)['ingresos']:,.0f}")
+            mov = movimientos_rango(libro, hoy, hoy)
+            mov = mov[(mov['tipo'] == "ingreso") & (mov['estado'] == "Confirmado")]
+            if not mov.empty:
+                st.dataframe(mov.groupby(['sede', 'metodo'], as_index=False)[['monto', 'n']].sum()
+                             .rename(columns={'n': 'cobros'}), use_container_width=True)
+                if st.checkbox("Ver cobros de hoy"):
+                    df_p = get_df("pagos")
+                    st.dataframe(df_p[(df_p['fecha_pago'].dt.normalize()==pd.Timestamp(hoy)) & (df_p['estado']=='Confirmado')])
+        caja_diaria()
 
 elif nav == "Configuración":
     st.title("⚙️ Configuración")
-    t1, t2, t3 = st.tabs(["Parámetros", "Tarifas", "Listas"])
-    with t1:
+    pest = pestanas(["Parámetros", "Tarifas", "Listas"], "pest_config")
+    if pest == "Parámetros":
         d = int(get_config_value("dia_corte", 19))
         nd = st.slider("Día Corte", 1, 28, d)
         if st.button("Guardar"):
             set_config_value("dia_corte", nd)
             st.success("Guardado")
-    with t2:
+        m = _tiempos_arranque()['muestras']
+        if m:
+            txt = f"Login: primer pintado {m[-1]*1000:.0f} ms (máx {max(m)*1000:.0f} ms, presupuesto {PRIMER_PINTADO_MAX*1000:.0f} ms)"
+            if max(m) > PRIMER_PINTADO_MAX: st.warning(txt)
+            else: st.caption(txt)
+        plan = getattr(get_almacen(), 'plan', None)
+        if plan:
+            ps = plan.stats
+            st.caption(f"API: {ps['llamadas']} llamadas · {ps['demoradas']} demoradas por cuota ({ps['espera_seg']:.1f}s) · {ps['reintentos']} reintentos · {ps['fallidas']} fallidas")
+        rep = get_replicador()
+        res_d = rep.diario.resumen()
+        st.caption("Diario de escrituras: " + (" · ".join(f"{n} {e}" for e, n in sorted(res_d['estados'].items())) or "vacío")
+                   + (f" · último error: {rep.ultimo_error}" if rep.ultimo_error else ""))
+        if res_d['problemas']:
+            st.dataframe(pd.DataFrame(res_d['problemas'], columns=['id', 'hoja', 'tipo', 'estado', 'intentos', 'error']),
+                         use_container_width=True, hide_index=True)
+            descartadas = [p[0] for p in res_d['problemas'] if p[3] == 'descartada']
+            if descartadas and rol == "Administrador" and st.button("Reintentar descartadas"):
+                rep.diario.reactivar(descartadas); rep.avisar(); st.rerun()
+        if rol == "Administrador":
+            with st.expander("🗄️ Archivo por año"):
+                st.caption("Mueve los años cerrados de pagos, asistencias y logs a hojas por año. Los pagos pendientes quedan en la hoja actual.")
+                st.dataframe(pd.DataFrame([{'hoja': h, 'filas actuales': len(get_df(h)),
+                                            'años archivados': ", ".join(map(str, anios_archivados(h))) or "-"} for h in HOJAS_ARCHIVO]),
+                             use_container_width=True, hide_index=True)
+                corte = st.number_input("Archivar años anteriores a", 2000, get_today_ar().year, get_today_ar().year)
+                if st.button("Archivar"):
+                    with st.spinner("Archivando..."):
+                        for h in HOJAS_ARCHIVO:
+                            try:
+                                movidas = archivar_hoja(h, int(corte))
+                                st.write(f"{h}: " + (", ".join(f"{a} ({n})" for a, n in movidas.items()) or "nada para archivar"))
+                            except Exception as e: st.error(f"{h}: {e}")
+        if rol == "Administrador" and get_ajuste("almacen", "sheets") == "sqlite":
+            with st.expander("📥 Importar desde Google Sheets"):
+                st.caption("Reemplaza TODAS las hojas locales por las de la planilla de Google configurada en secrets.")
+                if st.checkbox("Entiendo que se pisan los datos locales") and st.button("Importar"):
+                    with st.spinner("Importando..."):
+                        try:
+                            copiadas = importar_desde_sheets()
+                            st.success(" · ".join(f"{h}: {n}" for h, n in copiadas.items()) or "La planilla está vacía")
+                        except Exception as e: st.error(f"No se pudo importar: {e}")
+    elif pest == "Tarifas":
         df = get_df("tarifas")
         ed = st.data_editor(df, num_rows="dynamic")
         if st.button("Guardar Tarifas"):
             actualizar_tarifas_bulk(ed)
             st.success("Guardado")
-    with t3:
+    else:
         df = get_df("listas")
         ed = st.data_editor(df, num_rows="dynamic")
         if st.button("Guardar Listas"):
-            sh = get_client(); ws = sh.worksheet("listas"); ws.clear();
-            ws.update([ed.columns.values.tolist()] + ed.values.tolist())
+            reemplazar_hoja_df("listas", ed)
             st.success("Guardado")
 
 # === USUARIOS ===
@@ -780,7 +2099,63 @@ elif nav == "Usuarios":
             r = st.selectbox("Rol", ["Administrador", "Entrenador"])
             s = st.multiselect("Sedes", DEF_SEDES)
             if st.form_submit_button("Crear"):
-                h = bcrypt.hashpw(p.encode(), bcrypt.gensalt()).decode()
+                h = hash_password(p)
                 save_row("usuarios", [generate_id(), u, h, r, n, ",".join(s), 1])
                 st.success("Creado")
     else: st.error("Restringido")
+
+# ==========================================
+# 6. CIERRE DEL RERUN
+# ==========================================
+storage.registrar('seccion', f"página {nav}", (time.perf_counter() - T_PAGINA) * 1000)
+if escrituras_pendientes():
+    st.sidebar.warning(f"⚠️ {escrituras_pendientes()} escrituras guardadas en el diario local, sin sincronizar con la base. Se reenvían solas.")
+
+# --- PANEL DE RENDIMIENTO (sólo Administrador) ---
+def _tabla_hist(hists, clave):
+    filas = [{clave: k, 'n': h['n'], 'prom_ms': round(h['total_ms'] / h['n'], 1) if h['n'] else 0.0,
+              'p95_ms': storage.Metricas.percentil(h, 0.95), 'max_ms': round(h['max_ms'], 1), 'total_ms': round(h['total_ms'])}
+             for k, h in hists.items()]
+    return pd.DataFrame(filas, columns=[clave, 'n', 'prom_ms', 'p95_ms', 'max_ms', 'total_ms']).sort_values('total_ms', ascending=False)
+
+def metricas_csv(ambitos):
+    """Todas las métricas en formato largo: ámbito, tipo, clave, métrica, valor"""
+    filas = []
+    for amb, d in ambitos.items():
+        for tipo in ('ops', 'secciones'):
+            for k, h in d[tipo].items():
+                filas += [[amb, tipo, k, m, h[m]] for m in ('n', 'total_ms', 'max_ms')]
+                filas.append([amb, tipo, k, 'p95_ms', storage.Metricas.percentil(h, 0.95)])
+        for k, h in d['hojas'].items(): filas += [[amb, 'hojas', k, m, v] for m, v in h.items()]
+        for k, c in d['cache'].items(): filas += [[amb, 'cache', k, m, v] for m, v in c.items()]
+        filas += [[amb, 'total', '', m, d[m]] for m in ('reintentos', 'errores')]
+    return pd.DataFrame(filas, columns=['ambito', 'tipo', 'clave', 'metrica', 'valor']).to_csv(index=False)
+
+def panel_rendimiento():
+    ambitos = {'rerun': st.session_state["_met_rerun"].exportar(), 'sesión': st.session_state["_met_sesion"].exportar(),
+               'proceso': storage.METRICAS_PROCESO.exportar()}
+    with st.sidebar.expander("⏱️ Rendimiento"):
+        d = ambitos[st.radio("Ámbito", list(ambitos), horizontal=True, key="met_ambito")]
+        n_api = sum(h['n'] for h in d['ops'].values())
+        st.caption(f"API: {n_api} llamadas · {sum(h['total_ms'] for h in d['ops'].values())/1000:.2f}s · "
+                   f"{d['reintentos']} reintentos · {d['errores']} errores")
+        for tipo, c in d['cache'].items():
+            tot = c['aciertos'] + c['fallos']
+            if tot: st.caption(f"Caché {tipo}: {c['aciertos']/tot:.0%} aciertos de {tot}")
+        if d['secciones']:
+            st.markdown("**Secciones más lentas**")
+            st.dataframe(_tabla_hist(d['secciones'], 'seccion').head(8), hide_index=True, use_container_width=True)
+        if d['hojas']:
+            st.markdown("**Hojas más leídas**")
+            hojas = pd.DataFrame([{'hoja': k, **v} for k, v in d['hojas'].items()]).sort_values('lecturas', ascending=False)
+            hojas['kb'] = (hojas.pop('bytes') / 1024).round(1)
+            hojas['ms'] = hojas['ms'].round()
+            st.dataframe(hojas, hide_index=True, use_container_width=True)
+        if d['ops']:
+            st.markdown("**Latencia por operación**")
+            st.dataframe(_tabla_hist(d['ops'], 'op'), hide_index=True, use_container_width=True)
+        c1, c2 = st.columns(2)
+        c1.download_button("JSON", json.dumps({'limites_ms': storage.LIMITES_MS, **ambitos}, ensure_ascii=False, indent=1), file_name="metricas.json", mime="application/json")
+        c2.download_button("CSV", metricas_csv(ambitos), file_name="metricas.csv", mime="text/csv")
+
+if rol == "Administrador": panel_rendimiento()
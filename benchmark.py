@@ -0,0 +1,306 @@
+"""Benchmark de los caminos calientes de app.py con datos sintéticos del club.
+
+Genera socios, tarifas, grupos, inscripciones, pagos, asistencias y logs a la
+escala pedida, los carga en un AlmacenSimulado (latencia inyectable) y corre
+cada camino con streamlit.testing (AppTest), que da session_state y caché como
+en un rerun real. Se ejecutan las secciones 1-2 de app.py (motor de datos y
+lógica) sin la interfaz. Por camino se informa:
+
+    frio_s      primera ejecución en una sesión nueva (incluye las descargas)
+    tibio_s     repetición inmediata (caché de sesión e índices ya armados)
+    llamadas    llamadas a la API simulada en la ejecución en frío
+    pico_mb     memoria pico de Python (tracemalloc) en una corrida en frío
+
+Uso:
+    python benchmark.py --escala chico
+    python benchmark.py --socios 20000 --anios 5 --latencia 0.2
+    python benchmark.py --comparar .bench/a1b2c3d_chico.json .bench/d4e5f6a_chico.json
+
+El resultado se guarda en .bench/<commit>_<escala>.json para comparar commits.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+import storage
+
+RAIZ = os.path.dirname(os.path.abspath(__file__))
+CORTE_APP = "# ==========================================\n# 3. SEGURIDAD Y AUTENTICACIÓN"
+
+ESCALAS = {
+    'chico': {'socios': 500, 'anios': 1},
+    'mediano': {'socios': 5000, 'anios': 2},
+    'grande': {'socios': 20000, 'anios': 5},  # millones de filas: varios GB de RAM
+}
+SEDES = ["Sede C1", "Sede Saa"]
+DIAS = ["Lunes", "Martes", "Miércoles", "Jueves", "Viernes", "Sábado"]
+HORARIOS = ["17:00", "18:00", "19:00", "20:00"]
+PLANES = {"General": 15000, "Plan 2x": 22000, "Plan 3x": 28000, "Arquero Pro": 35000}
+METODOS = ["Efectivo", "Transferencia", "MP"]
+MESES = ["Enero", "Febrero", "Marzo", "Abril", "Mayo", "Junio", "Julio", "Agosto", "Septiembre", "Octubre",
+         "Noviembre", "Diciembre"]
+NOMBRES = ["Juan", "Martina", "Lucas", "Sofía", "Mateo", "Valentina", "Tomás", "Camila", "Benjamín", "Lucía",
+           "Joaquín", "Julieta", "Santiago", "Catalina", "Nicolás", "Agustina", "Thiago", "Milagros"]
+APELLIDOS = ["González", "Rodríguez", "Gómez", "Fernández", "López", "Díaz", "Martínez", "Pérez", "García",
+             "Sánchez", "Romero", "Sosa", "Álvarez", "Torres", "Ruiz", "Ramírez", "Flores", "Benítez"]
+
+
+# --- DATOS SINTÉTICOS ---
+def generar_datos(socios, anios, seed=7):
+    """{hoja: [encabezado] + filas} con la forma de las hojas reales"""
+    rnd = random.Random(seed)
+    hoy = date.today()
+    inicio = hoy.replace(day=1) - timedelta(days=365 * anios)
+
+    soc = [['id', 'fecha_alta', 'nombre', 'apellido', 'dni', 'fecha_nacimiento', 'tutor', 'whatsapp', 'email',
+            'sede', 'plan', 'notas', 'usuario_alta', 'activo', 'talle', 'grupo', 'peso', 'altura']]
+    for i in range(socios):
+        nom, ape = rnd.choice(NOMBRES), rnd.choice(APELLIDOS)
+        soc.append([100000 + i, str(inicio + timedelta(days=rnd.randrange(365 * anios or 1))), nom, ape,
+                    30000000 + i, str(date(2005 + rnd.randrange(14), rnd.randrange(1, 13), rnd.randrange(1, 28))),
+                    "", f"11{rnd.randrange(10**8):08d}", f"{nom.lower()}.{i}@mail.com", rnd.choice(SEDES),
+                    rnd.choice(list(PLANES)), "", "admin", 1 if rnd.random() < 0.85 else 0,
+                    rnd.choice(["S", "M", "L"]), "Infantil", 40, 150])
+
+    n_grupos = max(4, socios // 15)
+    plant = [['id', 'sede', 'dia', 'horario', 'grupo', 'entrenador_asignado', 'cupo_max']]
+    for g in range(n_grupos):
+        plant.append([500000 + g, SEDES[g % 2], DIAS[g % len(DIAS)], HORARIOS[(g // len(DIAS)) % len(HORARIOS)],
+                      f"Grupo {g}", "profe", 20])
+
+    insc = [['id', 'id_socio', 'nombre_alumno', 'id_entrenamiento', 'fecha']]
+    grupo_de = {}
+    for fila in soc[1:]:
+        g = plant[1 + rnd.randrange(n_grupos)]
+        grupo_de[fila[0]] = g
+        insc.append([len(insc) + 700000, fila[0], f"{fila[2]} {fila[3]}", g[0], ""])
+
+    pag = [['id', 'fecha_pago', 'id_socio', 'nombre_socio', 'monto', 'concepto', 'metodo', 'nota', 'estado',
+            'usuario', 'mes_cobrado']]
+    asis = [['fecha', 'hora', 'id_socio', 'nombre_alumno', 'sede', 'grupo_turno', 'estado', 'nota']]
+    logs = [['fecha', 'usuario', 'id_ref', 'accion', 'detalle']]
+    for m in range(12 * anios):
+        anio, mes = inicio.year + (inicio.month - 1 + m) // 12, (inicio.month - 1 + m) % 12
+        mes_txt = f"{MESES[mes]} {anio}"
+        for fila in soc[1:]:
+            if not fila[13]: continue
+            conf = rnd.random() < 0.9
+            f_pago = date(anio, mes + 1, rnd.randrange(1, 28))
+            pag.append([len(pag) + 10**7, str(f_pago), fila[0], f"{fila[2]} {fila[3]}", PLANES[fila[10]],
+                        "Cuota Mensual", rnd.choice(METODOS) if conf else "Pendiente", "",
+                        "Confirmado" if conf else "Pendiente", "admin", mes_txt])
+    dia_idx = {d: i for i, d in enumerate(["Lunes", "Martes", "Miércoles", "Jueves", "Viernes", "Sábado", "Domingo"])}
+    for semana in range(52 * anios):
+        lunes = inicio + timedelta(days=7 * semana - inicio.weekday())
+        for fila in soc[1:]:
+            if not fila[13]: continue
+            g = grupo_de[fila[0]]
+            pres = rnd.random() < 0.8
+            asis.append([str(lunes + timedelta(days=dia_idx[g[2]])), g[3], fila[0], f"{fila[2]} {fila[3]}", g[1],
+                         g[4], "Presente" if pres else "Ausente", "" if pres else rnd.choice(["Enfermedad", "Viaje", "Sin Aviso"])])
+    for i in range(socios * 3):
+        fila = soc[1 + rnd.randrange(socios)]
+        logs.append([str(inicio + timedelta(days=rnd.randrange(365 * anios or 1))), "admin", fila[0],
+                     rnd.choice(["Edición Perfil", "Cambio Plan", "Cobro"]), "bench"])
+
+    gastos = [['fecha', 'concepto', 'monto', 'sede']]
+    for d in range(365 * anios):
+        if rnd.random() < 0.3:
+            gastos.append([str(inicio + timedelta(days=d)), "Insumos", rnd.randrange(5, 80) * 1000, rnd.choice(SEDES)])
+
+    return {
+        'socios': soc, 'entrenamientos_plantilla': plant, 'inscripciones': insc, 'pagos': pag, 'asistencias': asis,
+        'logs': logs, 'gastos': gastos, 'tarifas': [['concepto', 'valor']] + [[k, v] for k, v in PLANES.items()],
+        'config': [['clave', 'valor'], ['dia_corte', 19]], 'listas': [['tipo', 'valor']] + [['sede', s] for s in SEDES],
+        'usuarios': [['id', 'user', 'pass_hash', 'rol', 'nombre_completo', 'sedes_acceso', 'activo']],
+    }
+
+
+# --- CAMINOS CALIENTES (corren dentro del script de AppTest, junto a app.py) ---
+DRIVER = r'''
+# ===== DRIVER DE BENCHMARK =====
+import tracemalloc
+import random as _rnd
+
+_MES = st.session_state.get("_bench_mes", "")
+_ids = lambda n: _rnd.Random(1).sample(list(_df_hoja("socios")['id']), min(n, len(_df_hoja("socios"))))
+
+def _camino_get_df():
+    for h in ["socios", "tarifas", "entrenamientos_plantilla", "inscripciones", "pagos", "asistencias", "logs", "gastos"]:
+        get_df(h)
+
+def _camino_cuotas():
+    # El mismo punto de entrada que Contabilidad: marca de período en config + lote idempotente en el diario
+    if generar_cuotas_periodo(get_df("socios"), st.session_state["_bench_mes_nuevo"], st.session_state["_bench_periodo"]) is None:
+        raise RuntimeError("cuotas_periodo ya marcado: el almacén no se restauró entre corridas")
+
+def _camino_grilla_cobro():
+    # La misma función que usa listado_cobro, ordenada por deuda
+    grilla_cobro(get_df("socios"), _MES, orden="Mayor deuda").head(50)
+
+def _camino_busqueda():
+    df = get_df("socios")
+    for q in ["gonz", "martina lopez", "3000012", "sof", "ramirez tom", "zzz"]: buscar_socios(df, q)
+
+def _camino_conflicto():
+    plant = _df_hoja("entrenamientos_plantilla")
+    r = _rnd.Random(2)
+    occ = indice_ocupacion()  # como inscribir_lote: el índice se resuelve una vez por lote
+    for uid in _ids(200):
+        g = plant.iloc[r.randrange(len(plant))]
+        check_horario_conflict(uid, g['dia'], g['horario'], occ)
+
+def _camino_dashboard():
+    # Como la página Dashboard con tres rangos: mes, año y diez años (éste alcanza las particiones)
+    hoy = get_today_ar()
+    for desde in [hoy.replace(day=1), hoy.replace(month=1, day=1), hoy - timedelta(days=3650)]:
+        resumen_dashboard(libro_diario(desde), desde, hoy)
+
+def _camino_perfil():
+    for uid in _ids(50):
+        hist = indice_historial()
+        h = hist['asist'].get(str(uid))
+        if h: hist['df_a'].loc[h['pos']][['fecha', 'sede', 'grupo_turno', 'estado', 'nota']]
+        pos = hist['logs'].get(str(uid))
+        if pos is not None: hist['df_l'].iloc[pos]
+
+CAMINOS = {'get_df': _camino_get_df, 'grilla_cobro': _camino_grilla_cobro, 'busqueda': _camino_busqueda,
+           'conflicto_horario': _camino_conflicto, 'dashboard': _camino_dashboard, 'perfil': _camino_perfil,
+           'cuotas': _camino_cuotas}
+
+_orden = st.session_state.pop("_bench_orden", None)
+if _orden:
+    _camino, _modo = _orden
+    if _modo != "tibio":
+        # Sesión nueva en un proceso nuevo: sin caché propia ni compartida, índices ni instantáneas en disco
+        for _k in [k for k in st.session_state if not k.startswith("_bench")]: del st.session_state[_k]
+        _estado_snapshots.clear(); _compartido.clear()
+        get_replicador.clear()  # diario en memoria nuevo: la clave del lote de cuotas no se arrastra entre corridas
+        SNAPSHOT_DIR = os.path.join(st.session_state["_bench_tmp"], str(uuid.uuid4()))
+    _alm = get_almacen()
+    _antes = dict(_alm.llamadas)
+    if _modo == "memoria": tracemalloc.start()
+    _t0 = time.perf_counter()
+    CAMINOS[_camino]()
+    _dt = time.perf_counter() - _t0
+    flush_escrituras()  # fuera de la medición: nada del diario llega al almacén después de restaurarlo
+    _pico = tracemalloc.get_traced_memory()[1] if _modo == "memoria" else None
+    if _modo == "memoria": tracemalloc.stop()
+    st.session_state["_bench_res"] = {'seg': _dt, 'pico': _pico,
+                                      'llamadas': {k: _alm.llamadas[k] - _antes.get(k, 0) for k in _alm.llamadas}}
+'''
+
+
+def _script():
+    with open(os.path.join(RAIZ, "app.py"), encoding="utf-8") as f: fuente = f.read()
+    if CORTE_APP not in fuente: sys.exit("No se encontró el inicio de la sección 3 en app.py")
+    return fuente[:fuente.index(CORTE_APP)] + DRIVER
+
+
+def _commit():
+    try:
+        rev = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=RAIZ, capture_output=True, text=True).stdout.strip()
+        sucio = subprocess.run(["git", "status", "--porcelain", "app.py", "storage.py"], cwd=RAIZ,
+                               capture_output=True, text=True).stdout.strip()
+        return rev + ("-sucio" if sucio else "")
+    except OSError: return "sin-git"
+
+
+def correr(socios, anios, latencia=0.0, jitter=0.0, caminos=None, seed=7):
+    from streamlit.testing.v1 import AppTest
+    import pandas as pd
+
+    t0 = time.perf_counter()
+    datos = generar_datos(socios, anios, seed)
+    t_gen = time.perf_counter() - t0
+    storage.ALMACEN_FORZADO = storage.AlmacenSimulado(latencia=latencia, jitter=jitter, datos=datos)
+    del datos
+    hoy = date.today()
+    mes, mes_nuevo = f"{MESES[hoy.month - 1]} {hoy.year}", f"{MESES[hoy.month - 1]} {hoy.year + 1}"
+
+    os.chdir(RAIZ)  # style.css / logo.png relativos
+    at = AppTest.from_string(_script(), default_timeout=3600)
+    at.session_state["_bench_tmp"] = tempfile.mkdtemp(prefix="bench_snap_")
+    at.session_state["_bench_mes"] = mes
+    at.session_state["_bench_mes_nuevo"] = mes_nuevo
+    at.session_state["_bench_periodo"] = (hoy.year + 1) * 100 + hoy.month
+    at.run()  # primera pasada: define funciones y calienta imports
+
+    resultados = {}
+    for camino in caminos or ['get_df', 'grilla_cobro', 'busqueda', 'conflicto_horario', 'dashboard', 'perfil', 'cuotas']:
+        res = {}
+        alm = storage.ALMACEN_FORZADO
+        n_pagos, n_config = len(alm.hojas['pagos']), len(alm.hojas['config'])
+        # 'cuotas' escribe en el almacén: sin corrida tibia, y cada corrida arranca de los pagos y la config originales
+        for modo in (["frio", "memoria"] if camino == "cuotas" else ["frio", "tibio", "memoria"]):
+            if camino == "cuotas": alm.hojas['pagos'], alm.hojas['config'] = alm.hojas['pagos'][:n_pagos], alm.hojas['config'][:n_config]
+            at.session_state["_bench_orden"] = (camino, modo)
+            at.run()
+            if at.exception: raise RuntimeError(f"{camino}/{modo}: {at.exception[0].message}")
+            r = at.session_state["_bench_res"]
+            if modo == "frio": res.update(frio_s=round(r['seg'], 4), llamadas=r['llamadas'])
+            elif modo == "tibio": res.update(tibio_s=round(r['seg'], 4))
+            else: res.update(pico_mb=round(r['pico'] / 2**20, 2))
+        resultados[camino] = res
+        print(f"  {camino:<18} frío {res['frio_s']:>8.3f}s  tibio {res.get('tibio_s', float('nan')):>8.3f}s  "
+              f"API {res['llamadas']}  pico {res['pico_mb']:>8.1f} MB", flush=True)
+
+    filas = {h: len(v) - 1 for h, v in storage.ALMACEN_FORZADO.hojas.items()}
+    storage.ALMACEN_FORZADO = None
+    return {
+        'commit': _commit(), 'fecha': time.strftime("%Y-%m-%d %H:%M:%S"),
+        'entorno': {'python': platform.python_version(), 'pandas': pd.__version__, 'plataforma': platform.platform()},
+        'parametros': {'socios': socios, 'anios': anios, 'latencia': latencia, 'jitter': jitter, 'seed': seed},
+        'filas': filas, 'generacion_s': round(t_gen, 2), 'resultados': resultados,
+    }
+
+
+def comparar(ruta_a, ruta_b):
+    """Tabla B vs A (tiempos y memoria; < 1.00 es mejora)"""
+    with open(ruta_a) as f: a = json.load(f)
+    with open(ruta_b) as f: b = json.load(f)
+    if a['parametros'] != b['parametros']: print(f"⚠️ parámetros distintos: {a['parametros']} vs {b['parametros']}")
+    print(f"{'camino':<18} {'métrica':<8} {a['commit']:>12} {b['commit']:>12}  razón")
+    for camino in a['resultados']:
+        if camino not in b['resultados']: continue
+        for m in ['frio_s', 'tibio_s', 'pico_mb']:
+            va, vb = a['resultados'][camino].get(m), b['resultados'][camino].get(m)
+            if va is None or vb is None: continue
+            print(f"{camino:<18} {m:<8} {va:>12.3f} {vb:>12.3f}  {vb / va if va else float('nan'):.2f}")
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    ap.add_argument("--escala", choices=list(ESCALAS), default="chico")
+    ap.add_argument("--socios", type=int, help="pisa la cantidad de socios de la escala")
+    ap.add_argument("--anios", type=int, help="pisa los años de historia (pagos/asistencias)")
+    ap.add_argument("--latencia", type=float, default=0.0, help="seg por llamada a la API simulada")
+    ap.add_argument("--jitter", type=float, default=0.0)
+    ap.add_argument("--caminos", nargs="*", help="subconjunto de caminos a medir")
+    ap.add_argument("--seed", type=int, default=7)
+    ap.add_argument("--salida", help="archivo JSON (por defecto .bench/<commit>_<escala>.json)")
+    ap.add_argument("--comparar", nargs=2, metavar=("A.json", "B.json"))
+    args = ap.parse_args()
+
+    if args.comparar: return comparar(*args.comparar)
+    esc = dict(ESCALAS[args.escala])
+    if args.socios: esc['socios'] = args.socios
+    if args.anios: esc['anios'] = args.anios
+    nombre = args.escala if not (args.socios or args.anios) else f"{esc['socios']}x{esc['anios']}"
+    print(f"Benchmark {nombre}: {esc['socios']} socios, {esc['anios']} años, latencia {args.latencia}s")
+    res = correr(esc['socios'], esc['anios'], args.latencia, args.jitter, args.caminos, args.seed)
+    salida = args.salida or os.path.join(RAIZ, ".bench", f"{res['commit']}_{nombre}.json")
+    os.makedirs(os.path.dirname(salida), exist_ok=True)
+    with open(salida, "w") as f: json.dump(res, f, indent=2, ensure_ascii=False)
+    print(f"→ {salida}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,834 @@
+"""Motores de almacenamiento de la app.
+
+Todos exponen las mismas operaciones, las únicas que usa app.py:
+leer una hoja, agregar filas, actualizar/borrar una fila y reemplazar una hoja.
+Las filas se numeran como en Google Sheets: la fila 1 es el encabezado y los
+datos empiezan en la 2, así el índice de filas de app.py sirve para todos.
+"""
+import bisect
+import copy
+import json
+import random
+import re
+import sqlite3
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager, nullcontext
+
+
+class ErrorAlmacen(Exception):
+    """Fallo de lectura/escritura en el motor de datos"""
+
+
+class CuotaExcedida(ErrorAlmacen):
+    """Equivalente al 429 de la API de Sheets"""
+
+
+class HojaInexistente(ErrorAlmacen):
+    """Alta en una hoja que no existe (en Sheets: WorksheetNotFound). Se crea antes con asegurar_hoja"""
+
+
+# Si se fija, app.py usa este almacén en lugar del configurado (lo usa benchmark.py)
+ALMACEN_FORZADO = None
+
+# Carriles de prioridad del planificador (por hilo)
+INTERACTIVA, FONDO = 0, 1
+_local = threading.local()
+
+
+def prioridad_actual():
+    return getattr(_local, 'prioridad', INTERACTIVA)
+
+
+@contextmanager
+def prioridad(p):
+    """Las llamadas hechas dentro del bloque (en este hilo) usan el carril p"""
+    previa = prioridad_actual()
+    _local.prioridad = p
+    try: yield
+    finally: _local.prioridad = previa
+
+
+@contextmanager
+def sin_reintentos():
+    """Las llamadas del bloque (en este hilo) no reintentan: el error vuelve enseguida"""
+    previo = getattr(_local, 'sin_reintentos', False)
+    _local.sin_reintentos = True
+    try: yield
+    finally: _local.sin_reintentos = previo
+
+
+class Almacen:
+    """Interfaz común. `valores` es una lista de filas (listas de celdas)."""
+    nombre = "base"
+
+    def leer(self, hoja):
+        """Todas las filas de la hoja, encabezado incluido ([] si no existe o está vacía)"""
+        raise NotImplementedError
+
+    def leer_desde(self, hoja, fila, ncols):
+        """Filas desde `fila` (inclusive) hasta el final, de las primeras ncols columnas"""
+        raise NotImplementedError
+
+    def agregar_filas(self, hoja, filas):
+        """Agrega al final; devuelve el nº de la primera fila escrita (o None si no se sabe)"""
+        raise NotImplementedError
+
+    def actualizar_fila(self, hoja, fila, valores):
+        """Escribe {nº de columna (1-based): valor} de una fila en una sola operación"""
+        raise NotImplementedError
+
+    def borrar_fila(self, hoja, fila):
+        raise NotImplementedError
+
+    def reemplazar_hoja(self, hoja, valores):
+        raise NotImplementedError
+
+    def asegurar_hoja(self, hoja, encabezado):
+        """Crea la hoja con su encabezado si no existe"""
+        raise NotImplementedError
+
+    def leer_celda(self, hoja, fila, col):
+        raise NotImplementedError
+
+
+# ==========================================
+# GOOGLE SHEETS
+# ==========================================
+class AlmacenSheets(Almacen):
+    nombre = "sheets"
+
+    def __init__(self, spreadsheet):
+        self.sh = spreadsheet
+        self._ws = {}
+
+    def _hoja(self, hoja):
+        # worksheet() hace un fetch de metadata en cada llamada: se reutiliza el handle
+        if hoja not in self._ws: self._ws[hoja] = self.sh.worksheet(hoja)
+        return self._ws[hoja]
+
+    def leer(self, hoja):
+        return self._hoja(hoja).get_all_values()
+
+    def leer_desde(self, hoja, fila, ncols):
+        from gspread.utils import rowcol_to_a1
+        letra = re.sub(r'\d', '', rowcol_to_a1(1, max(1, ncols)))
+        return [list(f) for f in self._hoja(hoja).get(f"A{fila}:{letra}")]
+
+    def agregar_filas(self, hoja, filas):
+        resp = self._hoja(hoja).append_rows(filas)
+        try: return int(re.search(r'![A-Z]+(\d+)', resp['updates']['updatedRange']).group(1))
+        except: return None
+
+    def actualizar_fila(self, hoja, fila, valores):
+        from gspread.utils import rowcol_to_a1
+        datos = [{'range': rowcol_to_a1(fila, c), 'values': [[v]]} for c, v in valores.items()]
+        self._hoja(hoja).batch_update(datos, value_input_option='USER_ENTERED')
+
+    def borrar_fila(self, hoja, fila):
+        self._hoja(hoja).delete_rows(fila)
+
+    def reemplazar_hoja(self, hoja, valores):
+        ws = self._hoja(hoja)
+        ws.clear()
+        ws.update(valores)
+
+    def asegurar_hoja(self, hoja, encabezado):
+        from gspread.exceptions import WorksheetNotFound
+        try: self._hoja(hoja)
+        except WorksheetNotFound:  # un 429 o un corte sube tal cual, para que el planificador reintente
+            ws = self.sh.add_worksheet(hoja, 100, len(encabezado))
+            ws.append_row(encabezado)
+            self._ws[hoja] = ws
+
+    def leer_celda(self, hoja, fila, col):
+        return self._hoja(hoja).cell(fila, col).value
+
+
+# ==========================================
+# PLANIFICADOR DE LLAMADAS (cuota + reintentos)
+# ==========================================
+def _codigo_http(e):
+    return getattr(getattr(e, 'response', None), 'status_code', None)
+
+
+def es_cuota(e):
+    """429: la llamada fue rechazada sin escribir nada"""
+    return isinstance(e, CuotaExcedida) or _codigo_http(e) == 429
+
+
+def es_reintentable(e):
+    """429 / 5xx de la API (o del simulado) y cortes de red: sockets, requests y el transporte de google-auth"""
+    code = _codigo_http(e)
+    if code is not None: return code == 429 or 500 <= code < 600
+    if isinstance(e, (CuotaExcedida, OSError)): return True  # requests.RequestException hereda de OSError
+    try: from google.auth.exceptions import TransportError
+    except ImportError: return False
+    return isinstance(e, TransportError)
+
+
+class Planificador:
+    """Cubeta de tokens por tipo de llamada, dimensionada a la cuota por minuto.
+
+    Las llamadas de FONDO ceden el paso mientras haya INTERACTIVAS esperando (en su cubeta) y
+    no consumen la reserva de la cubeta. Ante 429/5xx reintenta con espera
+    exponencial con jitter y vacía la cubeta para frenar al resto.
+    """
+    RESERVA = 0.2  # fracción de la cubeta que sólo pueden usar las interactivas
+
+    def __init__(self, cuota_lectura=60, cuota_escritura=60, reintentos=5, espera_base=1.0, espera_max=32.0):
+        ahora = time.monotonic()
+        self.cubetas = {t: {'cap': float(c), 'tokens': float(c), 'tasa': c / 60.0, 'ts': ahora}
+                        for t, c in (('lectura', cuota_lectura), ('escritura', cuota_escritura))}
+        self.reintentos, self.espera_base, self.espera_max = reintentos, espera_base, espera_max
+        self.cond = threading.Condition()
+        self.esperando = {t: {INTERACTIVA: 0, FONDO: 0} for t in self.cubetas}  # por cubeta: una lectura en cola no frena escrituras
+        self.stats = {'llamadas': 0, 'demoradas': 0, 'reintentos': 0, 'fallidas': 0, 'espera_seg': 0.0}
+
+    def _recargar(self, c):
+        ahora = time.monotonic()
+        c['tokens'] = min(c['cap'], c['tokens'] + (ahora - c['ts']) * c['tasa'])
+        c['ts'] = ahora
+
+    def _tomar(self, tipo, prio):
+        t0 = time.monotonic()
+        with self.cond:
+            self.esperando[tipo][prio] += 1
+            try:
+                while True:
+                    c = self.cubetas[tipo]
+                    self._recargar(c)
+                    minimo = 1 if prio == INTERACTIVA else 1 + c['cap'] * self.RESERVA
+                    if c['tokens'] >= minimo and (prio == INTERACTIVA or not self.esperando[tipo][INTERACTIVA]):
+                        c['tokens'] -= 1
+                        break
+                    self.cond.wait(timeout=min(1.0, max(0.05, (minimo - c['tokens']) / c['tasa'])))
+            finally:
+                self.esperando[tipo][prio] -= 1
+            espera = time.monotonic() - t0
+            if espera > 0.01:
+                self.stats['demoradas'] += 1
+                self.stats['espera_seg'] += espera
+
+    def ejecutar(self, tipo, fn, *args):
+        prio = prioridad_actual()
+        reintentos = 0 if getattr(_local, 'sin_reintentos', False) else self.reintentos
+        for intento in range(reintentos + 1):
+            self._tomar(tipo, prio)
+            try:
+                r = fn(*args)
+                with self.cond: self.stats['llamadas'] += 1
+                return r
+            except Exception as e:
+                if not es_reintentable(e) or intento == reintentos:
+                    with self.cond: self.stats['fallidas'] += 1
+                    raise
+                _local.reintentos = getattr(_local, 'reintentos', 0) + 1  # para AlmacenMedido
+                with self.cond:
+                    self.stats['reintentos'] += 1
+                    self.cubetas[tipo]['tokens'] = 0.0  # todos frenan hasta que se recargue
+                time.sleep(min(self.espera_max, self.espera_base * 2 ** intento) * random.uniform(0.5, 1.0))
+
+
+class AlmacenPlanificado(Almacen):
+    """Envuelve otro almacén y pasa cada llamada por el planificador"""
+
+    def __init__(self, base, planificador):
+        self.base, self.plan = base, planificador
+        self.nombre = base.nombre
+
+    def leer(self, hoja): return self.plan.ejecutar('lectura', self.base.leer, hoja)
+    def leer_desde(self, hoja, fila, ncols): return self.plan.ejecutar('lectura', self.base.leer_desde, hoja, fila, ncols)
+    def leer_celda(self, hoja, fila, col): return self.plan.ejecutar('lectura', self.base.leer_celda, hoja, fila, col)
+    def agregar_filas(self, hoja, filas): return self.plan.ejecutar('escritura', self.base.agregar_filas, hoja, filas)
+    def actualizar_fila(self, hoja, fila, valores): return self.plan.ejecutar('escritura', self.base.actualizar_fila, hoja, fila, valores)
+    def borrar_fila(self, hoja, fila): return self.plan.ejecutar('escritura', self.base.borrar_fila, hoja, fila)
+    def reemplazar_hoja(self, hoja, valores): return self.plan.ejecutar('escritura', self.base.reemplazar_hoja, hoja, valores)
+    def asegurar_hoja(self, hoja, encabezado): return self.plan.ejecutar('escritura', self.base.asegurar_hoja, hoja, encabezado)
+
+
+# ==========================================
+# MÉTRICAS
+# ==========================================
+LIMITES_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000)  # cubetas del histograma de latencia
+
+
+class Metricas:
+    """Contadores e histogramas de latencia (llamadas al almacén, secciones de la app, aciertos de caché)"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.datos = {'ops': {}, 'hojas': {}, 'secciones': {}, 'cache': {}, 'reintentos': 0, 'errores': 0}
+
+    @staticmethod
+    def _hist():
+        return {'n': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'cubetas': [0] * (len(LIMITES_MS) + 1)}
+
+    @staticmethod
+    def _sumar(h, ms):
+        h['n'] += 1
+        h['total_ms'] += ms
+        h['max_ms'] = max(h['max_ms'], ms)
+        h['cubetas'][bisect.bisect_left(LIMITES_MS, ms)] += 1
+
+    @staticmethod
+    def percentil(h, q):
+        """Cota superior (ms) de la cubeta donde cae el percentil q; max_ms para la última"""
+        objetivo, acum = q * h['n'], 0
+        for i, c in enumerate(h['cubetas']):
+            acum += c
+            if acum >= objetivo and c: return LIMITES_MS[i] if i < len(LIMITES_MS) else h['max_ms']
+        return 0.0
+
+    def llamada(self, op, hoja, ms, filas, bytes_, reintentos, error):
+        with self.lock:
+            d = self.datos
+            self._sumar(d['ops'].setdefault(op, self._hist()), ms)
+            h = d['hojas'].setdefault(hoja, {'lecturas': 0, 'escrituras': 0, 'filas': 0, 'bytes': 0, 'ms': 0.0})
+            h['lecturas' if op.startswith('leer') else 'escrituras'] += 1
+            h['filas'] += filas
+            h['bytes'] += bytes_
+            h['ms'] += ms
+            d['reintentos'] += reintentos
+            d['errores'] += int(error)
+
+    def seccion(self, nombre, ms):
+        with self.lock: self._sumar(self.datos['secciones'].setdefault(nombre, self._hist()), ms)
+
+    def cache(self, tipo, acierto):
+        with self.lock:
+            c = self.datos['cache'].setdefault(tipo, {'aciertos': 0, 'fallos': 0})
+            c['aciertos' if acierto else 'fallos'] += 1
+
+    def exportar(self):
+        with self.lock: return copy.deepcopy(self.datos)
+
+
+METRICAS_PROCESO = Metricas()
+
+
+def metricas_activas():
+    return getattr(_local, 'metricas', ())
+
+
+def fijar_metricas(*metricas):
+    """Colectores adicionales (p.ej. del rerun y de la sesión) para las llamadas de este hilo"""
+    _local.metricas = metricas
+
+
+@contextmanager
+def midiendo(*metricas):
+    previas = metricas_activas()
+    _local.metricas = metricas
+    try: yield
+    finally: _local.metricas = previas
+
+
+def registrar(tipo, *args):
+    """Anota en el colector del proceso y en los activos del hilo: tipo = 'llamada' | 'seccion' | 'cache'"""
+    for m in (METRICAS_PROCESO, *metricas_activas()): getattr(m, tipo)(*args)
+
+
+def _bytes_estimados(filas, muestra=50):
+    if not filas: return 0
+    parte = filas[:muestra]
+    return int(sum(len(str(c)) for f in parte for c in f) / len(parte) * len(filas))
+
+
+class AlmacenMedido(Almacen):
+    """Envuelve otro almacén y registra latencia, filas, bytes (estimados), reintentos y errores de cada llamada"""
+
+    def __init__(self, base):
+        self.base = base
+        self.nombre = base.nombre
+
+    def __getattr__(self, attr):
+        return getattr(self.__dict__['base'], attr)  # plan, llamadas, hojas... del almacén envuelto
+
+    def _medir(self, op, hoja, fn, *args, escritas=None):
+        r0, t0 = getattr(_local, 'reintentos', 0), time.perf_counter()
+        res, error = None, False
+        try:
+            res = fn(*args)
+            return res
+        except Exception:
+            error = True
+            raise
+        finally:
+            filas = escritas if escritas is not None else (res if isinstance(res, list) else [])
+            registrar('llamada', op, hoja, (time.perf_counter() - t0) * 1000, len(filas), _bytes_estimados(filas),
+                      getattr(_local, 'reintentos', 0) - r0, error)
+
+    def leer(self, hoja): return self._medir('leer', hoja, self.base.leer, hoja)
+    def leer_desde(self, hoja, fila, ncols): return self._medir('leer_desde', hoja, self.base.leer_desde, hoja, fila, ncols)
+    def leer_celda(self, hoja, fila, col): return self._medir('leer_celda', hoja, self.base.leer_celda, hoja, fila, col)
+    def agregar_filas(self, hoja, filas): return self._medir('agregar_filas', hoja, self.base.agregar_filas, hoja, filas, escritas=filas)
+    def actualizar_fila(self, hoja, fila, valores):
+        return self._medir('actualizar_fila', hoja, self.base.actualizar_fila, hoja, fila, valores, escritas=[list(valores.values())])
+    def borrar_fila(self, hoja, fila): return self._medir('borrar_fila', hoja, self.base.borrar_fila, hoja, fila, escritas=[])
+    def reemplazar_hoja(self, hoja, valores): return self._medir('reemplazar_hoja', hoja, self.base.reemplazar_hoja, hoja, valores, escritas=valores)
+    def asegurar_hoja(self, hoja, encabezado): return self._medir('asegurar_hoja', hoja, self.base.asegurar_hoja, hoja, encabezado, escritas=[])
+
+
+# ==========================================
+# SQLITE (local / producción sin Google)
+# ==========================================
+class AlmacenSQLite(Almacen):
+    """Una tabla `filas` con (hoja, fila) como clave y un índice por la primera celda (id)"""
+    nombre = "sqlite"
+
+    def __init__(self, ruta):
+        self.con = sqlite3.connect(ruta, check_same_thread=False, isolation_level=None)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.con.execute("PRAGMA journal_mode=WAL")
+            self.con.execute("CREATE TABLE IF NOT EXISTS filas (hoja TEXT, fila INTEGER, clave TEXT, datos TEXT, PRIMARY KEY (hoja, fila))")
+            self.con.execute("CREATE INDEX IF NOT EXISTS ix_filas_clave ON filas (hoja, clave)")
+
+    @staticmethod
+    def _celdas(fila):
+        return ["" if v is None else str(v) for v in fila]
+
+    def leer(self, hoja):
+        with self.lock:
+            cur = self.con.execute("SELECT datos FROM filas WHERE hoja=? ORDER BY fila", (hoja,))
+            return [json.loads(d) for (d,) in cur]
+
+    def leer_desde(self, hoja, fila, ncols):
+        with self.lock:
+            cur = self.con.execute("SELECT datos FROM filas WHERE hoja=? AND fila>=? ORDER BY fila", (hoja, fila))
+            return [json.loads(d)[:ncols] for (d,) in cur]
+
+    def _insertar(self, hoja, desde, filas):
+        regs = []
+        for i, f in enumerate(filas):
+            c = self._celdas(f)
+            regs.append((hoja, desde + i, c[0] if c else "", json.dumps(c)))
+        self.con.executemany("INSERT INTO filas VALUES (?,?,?,?)", regs)
+
+    def agregar_filas(self, hoja, filas):
+        with self.lock:
+            self.con.execute("BEGIN")
+            (ult,) = self.con.execute("SELECT COALESCE(MAX(fila), 0) FROM filas WHERE hoja=?", (hoja,)).fetchone()
+            if not ult:  # la primera fila sería el encabezado
+                self.con.execute("ROLLBACK")
+                raise HojaInexistente(f"{hoja}: la hoja no existe")
+            self._insertar(hoja, ult + 1, filas)
+            self.con.execute("COMMIT")
+        return ult + 1
+
+    def actualizar_fila(self, hoja, fila, valores):
+        with self.lock:
+            self.con.execute("BEGIN")
+            r = self.con.execute("SELECT datos FROM filas WHERE hoja=? AND fila=?", (hoja, fila)).fetchone()
+            if r is None:
+                self.con.execute("ROLLBACK")
+                raise ErrorAlmacen(f"{hoja}: fila {fila} inexistente")
+            c = json.loads(r[0])
+            for col, v in valores.items():
+                c.extend([""] * (col - len(c)))
+                c[col - 1] = "" if v is None else str(v)
+            self.con.execute("UPDATE filas SET datos=?, clave=? WHERE hoja=? AND fila=?", (json.dumps(c), c[0], hoja, fila))
+            self.con.execute("COMMIT")
+
+    def borrar_fila(self, hoja, fila):
+        with self.lock:
+            self.con.execute("BEGIN")
+            self.con.execute("DELETE FROM filas WHERE hoja=? AND fila=?", (hoja, fila))
+            # Corre las filas siguientes en dos pasos para no chocar con la clave primaria
+            self.con.execute("UPDATE filas SET fila=-(fila-1) WHERE hoja=? AND fila>?", (hoja, fila))
+            self.con.execute("UPDATE filas SET fila=-fila WHERE hoja=? AND fila<0", (hoja,))
+            self.con.execute("COMMIT")
+
+    def reemplazar_hoja(self, hoja, valores):
+        with self.lock:
+            self.con.execute("BEGIN")
+            self.con.execute("DELETE FROM filas WHERE hoja=?", (hoja,))
+            self._insertar(hoja, 1, valores)
+            self.con.execute("COMMIT")
+
+    def asegurar_hoja(self, hoja, encabezado):
+        with self.lock:
+            if self.con.execute("SELECT 1 FROM filas WHERE hoja=? LIMIT 1", (hoja,)).fetchone(): return
+            self._insertar(hoja, 1, [encabezado])
+
+    def leer_celda(self, hoja, fila, col):
+        with self.lock:
+            r = self.con.execute("SELECT datos FROM filas WHERE hoja=? AND fila=?", (hoja, fila)).fetchone()
+        c = json.loads(r[0]) if r else []
+        return c[col - 1] if col <= len(c) else None
+
+
+def copiar_almacen(origen, destino, hojas):
+    """Copia esas hojas tal cual (encabezado incluido) de un almacén a otro; devuelve {hoja: filas de datos}"""
+    copiadas = {}
+    for h in hojas:
+        valores = origen.leer(h)
+        if not valores: continue
+        destino.reemplazar_hoja(h, valores)
+        copiadas[h] = len(valores) - 1
+    return copiadas
+
+
+# ==========================================
+# DIARIO DE ESCRITURAS (write-ahead local)
+# ==========================================
+ABIERTAS = ('pendiente', 'enviando')
+INTENTOS_MAX = 5  # errores permanentes (no 429/5xx/red) antes de descartar una operación; los transitorios no cuentan
+
+
+class Diario:
+    """Bitácora durable de escrituras: cada una se anota acá antes de mandarla al almacén.
+
+    Estados: pendiente -> enviando -> aplicada | descartada. Un 'enviando' que
+    sobrevive a un reinicio es un envío incierto y se verifica antes de repetirlo.
+    """
+
+    def __init__(self, ruta):
+        self.con = sqlite3.connect(ruta, check_same_thread=False, isolation_level=None)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.con.execute("PRAGMA journal_mode=WAL")
+            self.con.execute("PRAGMA synchronous=FULL")  # registrada = en disco
+            self.con.execute("CREATE TABLE IF NOT EXISTS ops (id INTEGER PRIMARY KEY AUTOINCREMENT, clave TEXT UNIQUE, hoja TEXT, "
+                             "tipo TEXT, datos TEXT, estado TEXT, intentos INTEGER DEFAULT 0, error TEXT, ts REAL, cierre_ts REAL)")
+            self.con.execute("CREATE INDEX IF NOT EXISTS ix_ops_estado ON ops (estado, id)")
+            # Espejo en memoria de lo abierto por hoja: se consulta en cada lectura
+            self.abiertas = dict(self.con.execute("SELECT hoja, COUNT(*) FROM ops WHERE estado IN (?, ?) GROUP BY hoja", ABIERTAS).fetchall())
+
+    def registrar(self, hoja, tipo, datos, clave=None):
+        """Anota la operación; con la misma `clave` no se anota dos veces. Devuelve su id"""
+        clave = clave or uuid.uuid4().hex
+        with self.lock:
+            cur = self.con.execute("INSERT OR IGNORE INTO ops (clave, hoja, tipo, datos, estado, ts) VALUES (?, ?, ?, ?, 'pendiente', ?)",
+                                   (clave, hoja, tipo, json.dumps(datos), time.time()))
+            if cur.rowcount:
+                self.abiertas[hoja] = self.abiertas.get(hoja, 0) + 1
+                return cur.lastrowid
+            return self.con.execute("SELECT id FROM ops WHERE clave=?", (clave,)).fetchone()[0]
+
+    def abiertas_de(self, *hojas):
+        with self.lock: return sum(n for h, n in self.abiertas.items() if not hojas or h in hojas)
+
+    def abiertas_entre(self, ids):
+        """Cuáles de esas operaciones siguen sin aplicar"""
+        ids = list(ids)
+        if not ids: return set()
+        with self.lock:
+            cur = self.con.execute(f"SELECT id FROM ops WHERE estado IN (?, ?) AND id IN ({','.join('?' * len(ids))})", ABIERTAS + tuple(ids))
+            return {r[0] for r in cur}
+
+    def pendientes(self, hojas=(), limite=500):
+        filtro = f" AND hoja IN ({','.join('?' * len(hojas))})" if hojas else ""
+        with self.lock:
+            cur = self.con.execute(f"SELECT id, hoja, tipo, datos, estado, intentos FROM ops WHERE estado IN (?, ?){filtro} ORDER BY id LIMIT ?",
+                                   ABIERTAS + tuple(hojas) + (limite,))
+            return [{'id': i, 'hoja': h, 'tipo': t, 'datos': json.loads(d), 'estado': e, 'intentos': n} for i, h, t, d, e, n in cur]
+
+    def marcar(self, ops, estado=None, error=None, contar=False):
+        """Cambia el estado (None: lo deja como está) y anota el error; `contar` suma un intento fallido"""
+        cierre = time.time() if estado and estado not in ABIERTAS else None
+        with self.lock:
+            self.con.execute("BEGIN")
+            for op in ops:
+                self.con.execute("UPDATE ops SET estado=COALESCE(?, estado), error=?, intentos=intentos+?, cierre_ts=? WHERE id=?",
+                                 (estado, error, int(contar), cierre, op['id']))
+                if cierre and op['estado'] in ABIERTAS: self.abiertas[op['hoja']] -= 1
+                if contar: op['intentos'] += 1
+                op['estado'] = estado or op['estado']
+            self.con.execute("COMMIT")
+
+    def reactivar(self, ids):
+        """Vuelve a poner en cola operaciones descartadas"""
+        with self.lock:
+            for i in ids:
+                r = self.con.execute("SELECT hoja FROM ops WHERE id=? AND estado='descartada'", (i,)).fetchone()
+                if not r: continue
+                self.con.execute("UPDATE ops SET estado='pendiente', intentos=0, cierre_ts=NULL WHERE id=?", (i,))
+                self.abiertas[r[0]] = self.abiertas.get(r[0], 0) + 1
+
+    def resumen(self, limite=20):
+        """{'estados': {estado: n}, 'problemas': [(id, hoja, tipo, estado, intentos, error)]} para el panel"""
+        with self.lock:
+            estados = dict(self.con.execute("SELECT estado, COUNT(*) FROM ops GROUP BY estado").fetchall())
+            problemas = self.con.execute("SELECT id, hoja, tipo, estado, intentos, error FROM ops WHERE error IS NOT NULL "
+                                         "AND estado != 'aplicada' ORDER BY id DESC LIMIT ?", (limite,)).fetchall()
+        return {'estados': estados, 'problemas': problemas}
+
+    def purgar(self, dias=7):
+        """Borra las aplicadas hace más de `dias`"""
+        with self.lock:
+            self.con.execute("DELETE FROM ops WHERE estado='aplicada' AND cierre_ts < ?", (time.time() - dias * 86400,))
+
+
+class OperacionInvalida(ErrorAlmacen):
+    """La operación ya no se puede aplicar (p. ej. la fila a actualizar no existe)"""
+
+
+class Replicador:
+    """Aplica en orden lo pendiente del diario: desde un hilo de fondo y a pedido desde el script.
+
+    Las altas consecutivas a una misma hoja se mandan en un solo append. Ante
+    un error se corta ahí (para no alterar el orden) y se reintenta con espera
+    creciente; las operaciones sólo se descartan tras INTENTOS_MAX errores
+    permanentes: los de cuota/red no cuentan.
+    """
+
+    def __init__(self, diario, alm, al_aplicar=None, al_editar=None, ventana=2.0, espera_max=60.0):
+        self.diario, self.alm, self.al_aplicar, self.al_editar = diario, alm, al_aplicar, al_editar
+        self.ventana, self.espera_max = ventana, espera_max
+        self.lock = threading.RLock()  # un solo aplicador a la vez (reentrante: el archivado lo toma y drena)
+        self.evento = threading.Event()
+        self.ultimo_error = None
+        # Filas "sin correr": cada baja/reemplazo sube el contador de la hoja y vence las filas anotadas antes
+        self.epoca, self.cortes, self.ubicadas, self.aseguradas = uuid.uuid4().hex[:8], {}, {}, set()
+        self._lock_cortes = threading.Lock()
+        threading.Thread(target=self._bucle, daemon=True).start()
+
+    def avisar(self):
+        self.evento.set()
+
+    def sello(self, hoja):
+        """Marca de la hoja para las filas anotadas: mientras no cambie, la fila de un índice armado con ella es la actual"""
+        return [self.epoca, self.cortes.get(hoja, 0)]
+
+    def cortar(self, *hojas):
+        """Las filas de esas hojas pudieron correrse (baja, reemplazo, archivo, otra réplica): se verifican antes de usarlas"""
+        with self._lock_cortes:
+            for h in hojas:
+                self.cortes[h] = self.cortes.get(h, 0) + 1
+                for k in [k for k in self.ubicadas if k[0] == h]: del self.ubicadas[k]
+
+    def _bucle(self):
+        fallos = 0  # al arrancar drena lo que haya quedado de antes de un reinicio
+        while True:
+            if not self.diario.abiertas_de(): self.evento.wait()
+            self.evento.clear()
+            # Junta lo que llegue durante la ventana; tras un fallo espera más
+            time.sleep(min(self.espera_max, self.ventana * 2 ** fallos))
+            # Carril INTERACTIVA: lo del diario son escrituras de usuarios (cobros, asistencias), no refrescos de fondo
+            try: self.drenar()
+            except Exception: pass
+            fallos = min(fallos + 1, 10) if self.ultimo_error else 0
+
+    @staticmethod
+    def _agrupar(ops):
+        grupos = []
+        for op in ops:
+            g = grupos[-1] if grupos else None
+            if g and op['tipo'] == 'agregar' and g[0]['tipo'] == 'agregar' and g[0]['hoja'] == op['hoja']: g.append(op)
+            else: grupos.append([op])
+        return grupos
+
+    def drenar(self, hojas=(), espera=None):
+        """Aplica hasta vaciar el diario (o lo de `hojas`) o hasta el primer fallo. Devuelve {hoja: [(filas, fila_inicial)]} de las altas.
+
+        Con `espera` (lecturas): espera el turno y aplica como mucho esos segundos, y sin reintentos; de eso se ocupa el fondo.
+        """
+        altas, editadas = {}, set()
+        if not self.lock.acquire(timeout=-1 if espera is None else espera): return altas
+        fin = None if espera is None else time.monotonic() + espera
+        try:
+            with sin_reintentos() if espera is not None else nullcontext():
+                self.ultimo_error = None
+                while True:
+                    ops = self.diario.pendientes(hojas)
+                    if not ops: return altas
+                    for grupo in self._agrupar(ops):
+                        if fin and time.monotonic() > fin: return altas
+                        try: enviadas, fila_ini = self._aplicar(grupo)
+                        except Exception as e:
+                            error = f"{type(e).__name__}: {e}"
+                            if es_reintentable(e):
+                                # Cuota/red: no cuenta como intento. Un 429 no escribió nada; ante un corte las
+                                # altas quedan 'enviando' y se verifican antes de repetirlas
+                                self.diario.marcar(grupo, 'pendiente' if es_cuota(e) else None, error)
+                                self.ultimo_error = error
+                                return altas
+                            definitivo = isinstance(e, OperacionInvalida) or grupo[0]['intentos'] + 1 >= INTENTOS_MAX
+                            self.diario.marcar(grupo, 'descartada' if definitivo else 'pendiente', error, contar=True)
+                            if definitivo: continue
+                            self.ultimo_error = error
+                            return altas
+                        self.diario.marcar(grupo, 'aplicada')
+                        hoja, tipo = grupo[0]['hoja'], grupo[0]['tipo']
+                        if enviadas: altas.setdefault(hoja, []).append((enviadas, fila_ini))
+                        if tipo != 'agregar': editadas.add(hoja)
+                        if self.al_aplicar:
+                            try: self.al_aplicar(hoja)
+                            except Exception: pass
+                        if tipo in ('borrar', 'reemplazar'): self.cortar(hoja)  # después de avisar: ver app._indice
+        finally:
+            self.lock.release()
+            # Una vez por drenado (no por operación): p. ej. la app sube la revisión de las hojas editadas
+            if editadas and self.al_editar:
+                try: self.al_editar(editadas)
+                except Exception: pass
+                self.avisar()
+
+    def _aplicar(self, grupo):
+        """Aplica el grupo; devuelve (filas agregadas, fila inicial) de las altas, ([], None) en el resto"""
+        op, alm = grupo[0], self.alm
+        hoja, d = op['hoja'], op['datos']
+        if op['tipo'] == 'agregar':
+            # Envío incierto (corte de red o reinicio): una lectura para no duplicar lo que ya llegó
+            if any(o['estado'] == 'enviando' for o in grupo): grupo = self._sin_agregadas(hoja, grupo)
+            filas = [f for o in grupo for f in o['datos']['filas']]
+            if not filas: return [], None
+            self.diario.marcar(grupo, 'enviando')
+            return filas, alm.agregar_filas(hoja, filas)
+        if op['tipo'] == 'reemplazar':
+            alm.reemplazar_hoja(hoja, d['valores'])
+            return [], None
+        if d.get('encabezado') and hoja not in self.aseguradas:
+            alm.asegurar_hoja(hoja, d['encabezado'])
+            self.aseguradas.add(hoja)
+        fila, confiada = self._ubicar(hoja, d)
+        try: self._en_fila(op['tipo'], hoja, d, fila)
+        except Exception as e:
+            if not confiada or es_reintentable(e): raise
+            self._en_fila(op['tipo'], hoja, d, self._ubicar(hoja, d, verificar=True)[0])  # la fila no servía: se verifica
+        return [], None
+
+    def _en_fila(self, tipo, hoja, d, fila):
+        valores = {int(c): v for c, v in d.get('valores', {}).items()}
+        if tipo == 'borrar':
+            if fila is not None: self.alm.borrar_fila(hoja, fila)  # si ya no está, la baja ya se aplicó
+        elif fila is not None: self.alm.actualizar_fila(hoja, fila, valores)
+        elif tipo == 'upsert':
+            nueva = [""] * max([d['col']] + list(valores))
+            nueva[d['col'] - 1] = d['clave']
+            for c, v in valores.items(): nueva[c - 1] = v
+            sello = self.sello(hoja)
+            ini = self.alm.agregar_filas(hoja, [nueva])
+            if ini: self.ubicadas[(hoja, d['col'], str(d['clave']))] = (ini, sello)
+        else: raise OperacionInvalida(f"{hoja}: clave {d['clave']} no encontrada")
+
+    def _ubicar(self, hoja, d, verificar=False):
+        """(fila actual de la clave, si se usó sin verificar). Sin lecturas si la fila anotada (o la ya ubicada) es
+        de un índice con el sello vigente; si no, una lectura de celda y en último caso la hoja entera"""
+        col, clave, fila = d['col'], str(d['clave']), d.get('fila')
+        sello = self.sello(hoja)
+        if not verificar:
+            if fila and d.get('sello') == sello: return fila, True
+            conocida = self.ubicadas.get((hoja, col, clave))
+            if conocida and conocida[1] == sello: return conocida[0], True
+        if not (fila and str(self.alm.leer_celda(hoja, fila, col)) == clave):
+            fila = next((i for i, f in enumerate(self.alm.leer(hoja)[1:], start=2) if len(f) >= col and str(f[col - 1]) == clave), None)
+        if fila: self.ubicadas[(hoja, col, clave)] = (fila, sello)
+        return fila, False
+
+    def _sin_agregadas(self, hoja, grupo):
+        """Saca del grupo las altas 'enviando' que ya están en la hoja. Compara las primeras celdas (id/fecha/socio), que distinguen cada alta"""
+        firma = lambda f: tuple("" if v is None else str(v) for v in list(f)[:3])
+        hay = {firma(f) for f in self.alm.leer(hoja)[1:]}
+        return [o for o in grupo if o['estado'] != 'enviando' or not all(firma(f) in hay for f in o['datos']['filas'])]
+
+
+# ==========================================
+# AVISOS DE CAMBIO ENTRE RÉPLICAS (mismo host)
+# ==========================================
+class FeedCambios:
+    """Contador de versión por hoja en un SQLite que comparten los procesos del host"""
+
+    def __init__(self, ruta):
+        self.ruta = ruta
+        with self._conectar() as con:
+            con.execute("PRAGMA journal_mode=WAL")
+            con.execute("CREATE TABLE IF NOT EXISTS cambios (hoja TEXT PRIMARY KEY, version INTEGER NOT NULL, ts REAL NOT NULL)")
+
+    def _conectar(self):
+        # Una conexión por llamada: se usa desde el hilo del script y desde hilos de fondo
+        return sqlite3.connect(self.ruta, timeout=5)
+
+    def publicar(self, hojas):
+        """Sube la versión de cada hoja; devuelve {hoja: versión nueva}"""
+        with self._conectar() as con:
+            for h in hojas:
+                con.execute("INSERT INTO cambios VALUES (?, 1, ?) ON CONFLICT(hoja) DO UPDATE SET version=version+1, ts=excluded.ts",
+                            (h, time.time()))
+            marca = ",".join("?" * len(hojas))
+            return dict(con.execute(f"SELECT hoja, version FROM cambios WHERE hoja IN ({marca})", list(hojas)).fetchall())
+
+    def versiones(self):
+        with self._conectar() as con: return dict(con.execute("SELECT hoja, version FROM cambios").fetchall())
+
+
+# ==========================================
+# SHEETS SIMULADO (pruebas de carga / offline)
+# ==========================================
+class AlmacenSimulado(Almacen):
+    """Hojas en memoria con la latencia y la cuota por minuto de la API de Sheets"""
+    nombre = "simulado"
+
+    def __init__(self, latencia=0.0, jitter=0.0, cuota_lectura=None, cuota_escritura=None, datos=None):
+        self.latencia, self.jitter = latencia, jitter
+        self.cuotas = {'lectura': cuota_lectura, 'escritura': cuota_escritura}
+        self._ventanas = {'lectura': deque(), 'escritura': deque()}
+        self.hojas = {h: [self._celdas(f) for f in v] for h, v in (datos or {}).items()}
+        self.llamadas = {'lectura': 0, 'escritura': 0, 'rechazadas': 0}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _celdas(fila):
+        # Sheets devuelve todo como texto formateado
+        return ["" if v is None else str(v) for v in fila]
+
+    def _llamada(self, tipo):
+        with self.lock:
+            ahora = time.monotonic()
+            ventana, cuota = self._ventanas[tipo], self.cuotas[tipo]
+            while ventana and ahora - ventana[0] >= 60: ventana.popleft()
+            if cuota is not None and len(ventana) >= cuota:
+                self.llamadas['rechazadas'] += 1
+                raise CuotaExcedida(f"429: cuota de {tipo} por minuto agotada")
+            ventana.append(ahora)
+            self.llamadas[tipo] += 1
+        if self.latencia or self.jitter: time.sleep(self.latencia + random.uniform(0, self.jitter))
+
+    def leer(self, hoja):
+        self._llamada('lectura')
+        with self.lock: return [list(f) for f in self.hojas.get(hoja, [])]
+
+    def leer_desde(self, hoja, fila, ncols):
+        self._llamada('lectura')
+        with self.lock: return [f[:ncols] for f in self.hojas.get(hoja, [])[fila - 1:]]
+
+    def agregar_filas(self, hoja, filas):
+        self._llamada('escritura')
+        with self.lock:
+            h = self.hojas.get(hoja)
+            if not h: raise HojaInexistente(f"{hoja}: la hoja no existe")
+            h.extend(self._celdas(f) for f in filas)
+            return len(h) - len(filas) + 1
+
+    def actualizar_fila(self, hoja, fila, valores):
+        self._llamada('escritura')
+        with self.lock:
+            h = self.hojas.get(hoja, [])
+            if not 1 <= fila <= len(h): raise ErrorAlmacen(f"{hoja}: fila {fila} inexistente")
+            c = h[fila - 1]
+            for col, v in valores.items():
+                c.extend([""] * (col - len(c)))
+                c[col - 1] = "" if v is None else str(v)
+
+    def borrar_fila(self, hoja, fila):
+        self._llamada('escritura')
+        with self.lock: del self.hojas[hoja][fila - 1]
+
+    def reemplazar_hoja(self, hoja, valores):
+        self._llamada('escritura')
+        with self.lock: self.hojas[hoja] = [self._celdas(f) for f in valores]
+
+    def asegurar_hoja(self, hoja, encabezado):
+        with self.lock:
+            if self.hojas.get(hoja): return
+        self.reemplazar_hoja(hoja, [encabezado])
+
+    def leer_celda(self, hoja, fila, col):
+        self._llamada('lectura')
+        with self.lock:
+            h = self.hojas.get(hoja, [])
+            return h[fila - 1][col - 1] if fila <= len(h) and col <= len(h[fila - 1]) else None
@@ -0,0 +1,195 @@
+"""Diario, replicador y planificador contra AlmacenSimulado (storage no depende de pandas ni de streamlit)"""
+import os
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import storage
+from storage import (AlmacenSimulado, CuotaExcedida, Diario, ErrorAlmacen, FONDO, INTERACTIVA,
+                     Planificador, Replicador, prioridad)
+
+ENCABEZADO = ['id', 'fecha', 'id_socio', 'monto']
+
+
+def _replicador(diario, alm, **kw):
+    # Ventana enorme: el hilo de fondo no drena durante la prueba, sólo lo hace drenar()
+    return Replicador(diario, alm, ventana=3600, **kw)
+
+
+class AlmacenConFallas(AlmacenSimulado):
+    """Simulado que falla las próximas escrituras con los errores de `fallas`"""
+
+    def __init__(self, *a, **kw):
+        super().__init__(*a, **kw)
+        self.fallas, self.escribe_y_falla = [], False
+
+    def agregar_filas(self, hoja, filas):
+        if self.fallas:
+            e = self.fallas.pop(0)
+            # Corte de red con el append ya aplicado: la respuesta se perdió
+            if self.escribe_y_falla: super().agregar_filas(hoja, filas)
+            raise e
+        return super().agregar_filas(hoja, filas)
+
+
+class TestDiario(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.ruta = os.path.join(self.dir.name, "diario.db")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_clave_de_idempotencia(self):
+        diario, alm = Diario(self.ruta), AlmacenSimulado(datos={'pagos': [ENCABEZADO]})
+        a = diario.registrar('pagos', 'agregar', {'filas': [[1, '2026-01-01', 7, 100]]}, clave="cuotas:2026-01")
+        b = diario.registrar('pagos', 'agregar', {'filas': [[1, '2026-01-01', 7, 100]]}, clave="cuotas:2026-01")
+        self.assertEqual(a, b)
+        self.assertEqual(diario.abiertas_de('pagos'), 1)
+        _replicador(diario, alm).drenar()
+        # Reintentar el lote ya aplicado tampoco lo vuelve a escribir
+        diario.registrar('pagos', 'agregar', {'filas': [[1, '2026-01-01', 7, 100]]}, clave="cuotas:2026-01")
+        _replicador(diario, alm).drenar()
+        self.assertEqual(len(alm.hojas['pagos']), 2)
+        self.assertEqual(diario.abiertas_de(), 0)
+
+    def test_altas_consecutivas_en_un_append(self):
+        diario, alm = Diario(self.ruta), AlmacenSimulado(datos={'pagos': [ENCABEZADO]})
+        for i in range(3): diario.registrar('pagos', 'agregar', {'filas': [[i, '2026-01-01', 7, 100]]})
+        altas = _replicador(diario, alm).drenar()
+        self.assertEqual(alm.llamadas['escritura'], 1)
+        self.assertEqual(altas['pagos'], [([[0, '2026-01-01', 7, 100], [1, '2026-01-01', 7, 100], [2, '2026-01-01', 7, 100]], 2)])
+
+    def test_reinicio_con_envios_inciertos(self):
+        diario = Diario(self.ruta)
+        ya = diario.registrar('pagos', 'agregar', {'filas': [[1, '2026-01-01', 7, 100]]})
+        falta = diario.registrar('pagos', 'agregar', {'filas': [[2, '2026-01-01', 8, 100]]})
+        diario.marcar([o for o in diario.pendientes() if o['id'] in (ya, falta)], 'enviando')
+        # El primero llegó a la hoja antes del corte; el segundo no
+        alm = AlmacenSimulado(datos={'pagos': [ENCABEZADO, [1, '2026-01-01', 7, 100]]})
+        diario.con.close()
+
+        diario = Diario(self.ruta)  # reinicio: lo 'enviando' sigue abierto
+        self.assertEqual(diario.abiertas_de('pagos'), 2)
+        _replicador(diario, alm).drenar()
+        self.assertEqual([f[0] for f in alm.hojas['pagos'][1:]], ['1', '2'])
+        self.assertEqual(alm.llamadas['lectura'], 1)  # una lectura para verificar, no una por op
+        self.assertEqual(diario.abiertas_de(), 0)
+
+    def test_sin_agregadas_tras_corte_de_red(self):
+        diario, alm = Diario(self.ruta), AlmacenConFallas(datos={'pagos': [ENCABEZADO]})
+        alm.fallas, alm.escribe_y_falla = [ConnectionError("respuesta perdida")], True
+        diario.registrar('pagos', 'agregar', {'filas': [[1, '2026-01-01', 7, 100]]})
+        rep = _replicador(diario, alm)
+        rep.drenar()
+        self.assertEqual(diario.pendientes()[0]['estado'], 'enviando')
+        self.assertEqual(diario.pendientes()[0]['intentos'], 0)
+        # Una alta nueva en el mismo grupo sí se manda; la que ya llegó no se repite
+        diario.registrar('pagos', 'agregar', {'filas': [[2, '2026-01-01', 8, 100]]})
+        rep.drenar()
+        self.assertEqual([f[0] for f in alm.hojas['pagos'][1:]], ['1', '2'])
+
+    def test_cuota_no_cuenta_intentos(self):
+        diario, alm = Diario(self.ruta), AlmacenConFallas(datos={'pagos': [ENCABEZADO]})
+        alm.fallas = [CuotaExcedida("429")] * (storage.INTENTOS_MAX + 2)
+        diario.registrar('pagos', 'agregar', {'filas': [[1, '2026-01-01', 7, 100]]})
+        rep = _replicador(diario, alm)
+        for _ in range(storage.INTENTOS_MAX + 2): rep.drenar()
+        op = diario.pendientes()[0]
+        self.assertEqual((op['estado'], op['intentos']), ('pendiente', 0))
+        rep.drenar()
+        self.assertEqual(len(alm.hojas['pagos']), 2)
+
+    def test_error_permanente_descarta_tras_intentos_max(self):
+        diario, alm = Diario(self.ruta), AlmacenConFallas(datos={'pagos': [ENCABEZADO]})
+        alm.fallas = [ErrorAlmacen("400: valor inválido")] * storage.INTENTOS_MAX
+        op = diario.registrar('pagos', 'agregar', {'filas': [[1, '2026-01-01', 7, 100]]})
+        rep = _replicador(diario, alm)
+        for i in range(storage.INTENTOS_MAX - 1):
+            rep.drenar()
+            self.assertEqual(diario.pendientes()[0]['intentos'], i + 1)
+        rep.drenar()
+        self.assertEqual(diario.abiertas_de(), 0)
+        self.assertEqual(diario.resumen()['estados'], {'descartada': 1})
+        diario.reactivar([op])
+        rep.drenar()
+        self.assertEqual(len(alm.hojas['pagos']), 2)
+
+    def test_fila_con_sello_vigente_sin_lecturas(self):
+        diario = Diario(self.ruta)
+        alm = AlmacenSimulado(datos={'socios': [['id', 'nombre'], ['5', 'Ana'], ['7', 'Luz']]})
+        rep = _replicador(diario, alm)
+        diario.registrar('socios', 'actualizar', {'col': 1, 'clave': '7', 'fila': 3, 'sello': rep.sello('socios'), 'valores': {2: 'Luz M'}})
+        rep.drenar()
+        self.assertEqual(alm.hojas['socios'][2], ['7', 'Luz M'])
+        self.assertEqual(alm.llamadas['lectura'], 0)
+
+    def test_sello_vencido_verifica_la_fila(self):
+        diario = Diario(self.ruta)
+        alm = AlmacenSimulado(datos={'socios': [['id', 'nombre'], ['5', 'Ana'], ['7', 'Luz']]})
+        rep = _replicador(diario, alm)
+        sello = rep.sello('socios')
+        diario.registrar('socios', 'borrar', {'col': 1, 'clave': '5', 'fila': 2, 'sello': sello})
+        diario.registrar('socios', 'actualizar', {'col': 1, 'clave': '7', 'fila': 3, 'sello': sello, 'valores': {2: 'Luz M'}})
+        rep.drenar()
+        # La baja corrió las filas: la fila 3 anotada ya no existe y se ubicó de nuevo
+        self.assertEqual(alm.hojas['socios'], [['id', 'nombre'], ['7', 'Luz M']])
+        self.assertGreater(alm.llamadas['lectura'], 0)
+
+
+class TestPlanificador(unittest.TestCase):
+    def _en_hilo(self, plan, tipo, prio):
+        hecho = threading.Event()
+
+        def correr():
+            with prioridad(prio): plan.ejecutar(tipo, hecho.set)
+        threading.Thread(target=correr, daemon=True).start()
+        return hecho
+
+    def _liberar(self, plan):
+        with plan.cond:
+            for t in plan.esperando: plan.esperando[t][INTERACTIVA] = 0
+            for c in plan.cubetas.values(): c['tokens'] = c['cap']
+            plan.cond.notify_all()
+
+    def test_fondo_cede_a_interactiva_en_su_cubeta(self):
+        plan = Planificador(cuota_lectura=60, cuota_escritura=60)
+        plan.esperando['escritura'][INTERACTIVA] = 1  # una interactiva en cola
+        fondo = self._en_hilo(plan, 'escritura', FONDO)
+        self.assertFalse(fondo.wait(0.3))
+        self._liberar(plan)
+        self.assertTrue(fondo.wait(2))
+
+    def test_lectura_en_cola_no_frena_escrituras(self):
+        plan = Planificador(cuota_lectura=60, cuota_escritura=60)
+        plan.esperando['lectura'][INTERACTIVA] = 1
+        self.assertTrue(self._en_hilo(plan, 'escritura', FONDO).wait(2))
+        self._liberar(plan)
+
+    def test_reserva_solo_para_interactivas(self):
+        plan = Planificador(cuota_escritura=10)
+        plan.cubetas['escritura']['tokens'] = 2.0  # por debajo de 1 + 20% de la cubeta
+        fondo = self._en_hilo(plan, 'escritura', FONDO)
+        self.assertTrue(self._en_hilo(plan, 'escritura', INTERACTIVA).wait(2))
+        self.assertFalse(fondo.wait(0.3))
+        self._liberar(plan)
+        self.assertTrue(fondo.wait(2))
+
+    def test_sin_reintentos_devuelve_el_error(self):
+        plan = Planificador(cuota_lectura=6000, espera_base=0.01)
+        llamadas = []
+
+        def falla():
+            llamadas.append(1)
+            raise CuotaExcedida("429")
+        with storage.sin_reintentos(), self.assertRaises(CuotaExcedida): plan.ejecutar('lectura', falla)
+        self.assertEqual(len(llamadas), 1)
+        with self.assertRaises(CuotaExcedida): plan.ejecutar('lectura', falla)
+        self.assertEqual(len(llamadas), 1 + 1 + plan.reintentos)
+
+
+if __name__ == "__main__":
+    unittest.main()